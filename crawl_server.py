@@ -1,7 +1,9 @@
-import os, re, time, subprocess
+import os, time, json, shutil, csv
 import sys
 import asyncio
-from datetime import datetime
+import threading
+import concurrent.futures
+from datetime import datetime, timedelta
 from mcp.server import FastMCP
 
 # 参数配置
@@ -18,75 +20,540 @@ log_file = open(log_file_path, 'w', encoding='utf-8')
 sys.stdout = log_file
 sys.stderr = log_file
 
-result_file_path = os.path.join(BASE_DIR, "weibo-search", "结果文件","东方精工","东方精工.csv")
+CRAWL_DIR = os.path.join(BASE_DIR, "weibo-search")
+RESULT_ROOT = os.path.join(CRAWL_DIR, "结果文件")
+# 每个关键词爬到过的全部微博，去重库跨多次爬取共享，之前爬到过的微博从这里取回
+HISTORY_DIR = os.path.join(RESULT_ROOT, "汇总")
+# 单次爬取的最长时间（秒），到时后爬虫正常关闭并保存已爬到的结果
+CRAWL_TIMEOUT = 60
+# 这些原因结束的爬取视为成功
+SUCCESS_REASONS = ("finished", "closespider_timeout", "closespider_itemcount")
+# 决定爬虫待爬队列的设置，与SearchSpider.get_crawl_id相同，这些设置相同的爬取共用一个待爬队列
+FRONTIER_SETTINGS = ("KEYWORD_LIST", "START_DATE", "END_DATE", "REGION", "WEIBO_TYPE",
+                     "CONTAIN_TYPE", "INCREMENTAL", "SEARCH_MODE")
+# 可以是相对路径的设置及其默认值，在本进程中爬取时都相对于weibo-search目录
+PATH_SETTINGS = {
+    "CACHE_DIR": "缓存文件",
+    "IMAGES_STORE": None,
+    "FILES_STORE": None,
+    "KEYWORD_LIST": None,
+    "COOKIE_POOL": None,
+    "METRICS_FILE": None,
+    "PARQUET_DIR": None,
+    "SQLITE_PATH": None,
+}
 
-def update_settings(file_path: str):
-    """更新settings.py中的START_DATE和END_DATE"""
-    if not os.path.exists(file_path):
-        # log.append(f"[ERR] 配置文件不存在: {file_path}")
-        print(f"[ERR] 配置文件不存在: {file_path}")
-        return False
+# 在本进程中运行爬虫，使用weibo-search中的Scrapy项目配置
+sys.path.insert(0, CRAWL_DIR)
+os.environ.setdefault("SCRAPY_SETTINGS_MODULE", "weibo.settings")
 
-    with open(file_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+from weibo.pipelines import CSV_HEADER
+from weibo.utils.util import escape_keyword
 
-    yesterday = time.strftime("%Y-%m-%d", time.localtime(time.time() - 86400))
-    date_str = f"'{yesterday}'"
-
-    pattern = lambda var: re.compile(rf"^\s*{var}\s*=\s*\S+", re.MULTILINE)
-    new_content = pattern("START_DATE").sub(f"START_DATE = {date_str}", content)
-    new_content = pattern("END_DATE").sub(f"END_DATE = {date_str}", new_content)
+# 汇总csv同时只由一次爬取更新
+history_lock = threading.Lock()
 
-    with open(file_path, 'w', encoding='utf-8') as f:
-        f.write(new_content)
-    # log.append(f"[INFO] 成功更新 START_DATE 和 END_DATE 为 {date_str}")
-    print(f"[INFO] 成功更新 START_DATE 和 END_DATE 为 {date_str}")
-    return True
 
-def run_spider(crawl_dir: str) -> bool:
-    """运行爬虫脚本（同步）"""
+def load_metrics(metrics_file_path):
+    """读取爬虫写入的性能指标，爬虫未写入时返回None"""
+    if not os.path.exists(metrics_file_path):
+        return None
     try:
-        cmd = ["scrapy", "crawl", "search"]
-        # log.append(f" 执行命令: {' '.join(cmd)}")
-        print(f"[INFO] 执行命令: {' '.join(cmd)}")
-        result = subprocess.run(cmd, cwd=crawl_dir, stdout=log_file, stderr=log_file, timeout=60)
-        # log.append(f"[INFO] 爬虫执行完成，状态码：{result.returncode}")
-        print(f"[INFO] 爬虫执行完成，状态码：{result.returncode}")
-        return result.returncode == 0
-    except Exception as e:
-        # log.append(f"[ERR] 执行爬虫失败: {str(e)}")
-        print(f"[ERR] 执行爬虫失败: {str(e)}")
-        return False
+        with open(metrics_file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"[ERR] 读取性能指标失败: {str(e)}")
+        return None
 
-@mcp.tool()
-async def start_crawler():
+
+def keyword_file_paths(files, keywords):
+    """{结果目录名: csv路径}转为{关键词: csv路径}，话题关键词的目录名为%23话题%23"""
+    if not keywords:
+        return dict(files)
+    return {
+        keyword: files[escape_keyword(keyword)]
+        for keyword in keywords if escape_keyword(keyword) in files
+    }
+
+
+def read_csv(file_path):
+    """返回csv中除表头外的行，文件不存在时返回空列表"""
+    if not os.path.isfile(file_path):
+        return []
+    with open(file_path, encoding='utf-8-sig', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        return list(reader)
+
+
+def write_csv(file_path, rows, mode='w'):
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    is_first_write = mode == 'w' or not os.path.isfile(file_path)
+    with open(file_path, mode, encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f)
+        if is_first_write:
+            writer.writerow(CSV_HEADER)
+        writer.writerows(rows)
+
+
+def merge_history(file_path, start_date=None, end_date=None):
+    """把本次爬取写入file_path的微博追加到该关键词的汇总csv，返回(结果行数, 新增行数)
+
+    本次爬取之前爬到过的微博被去重库过滤，不在file_path中。给出日期范围时，file_path改写为
+    汇总中发布日期在范围内的全部微博；增量爬取不给出日期范围，只保留本次新爬到的微博。
+    本次没有爬到微博时也写入只有表头的file_path。
     """
-    调用本地的爬虫服务获取微博平台当天的企业相关舆情信息
-    :return: dict 包括爬虫状态"status"和结果csv文件路径""result_file_path"
+    name = os.path.basename(file_path)
+    history_path = os.path.join(HISTORY_DIR, name)
+    created_at = CSV_HEADER.index("发布时间")
+    with history_lock:
+        rows = read_csv(file_path)
+        history = read_csv(history_path)
+        seen = {row[0] for row in history}
+        new_rows = [row for row in rows if row[0] not in seen]
+        write_csv(history_path, new_rows, mode='a')
+        if start_date is not None:
+            rows = [row for row in history + new_rows
+                    if start_date <= row[created_at][:10] <= end_date]
+        write_csv(file_path, rows)
+    return len(rows), len(new_rows)
+
+
+def simple_stats(stats):
+    """爬虫统计信息中的数值和字符串项，可直接返回给调用方"""
+    return {
+        key: value for key, value in stats.items()
+        if isinstance(value, (int, float, str))
+    }
+
+
+class CrawlRunner:
+    """常驻的爬虫运行器，代替修改settings.py后启动scrapy子进程
+
+    Twisted reactor在后台线程中一直运行，每次爬取在本进程中启动，不再重复付出解释器和Scrapy的启动开销。
+    关键词、日期和限制等以本次爬取的设置传入，不修改settings.py；多次爬取可同时进行，
+    结果分别写入结果文件下以run_id命名的目录。设置完全相同的爬取正在进行时，直接等待它的结果；
+    只有待爬队列的设置相同时，等它结束后再开始，两次爬取不同时使用一个待爬队列。
     """
-    settings_path = os.path.join(BASE_DIR, "weibo-search", "weibo", "settings.py")
-    crawl_dir = os.path.join(BASE_DIR, "weibo-search")
 
-    # 1. 修改设置文件
-    success_config = update_settings(settings_path)
-    if not success_config:
-        print("[ERR]设置文件更新失败")
+    def __init__(self, crawl_dir):
+        self.crawl_dir = crawl_dir
+        self.lock = threading.Lock()
+        self.runs = {}
+        # {待爬队列的设置: 最后开始的使用该队列的爬取}
+        self.frontier_runs = {}
+        self.runner = None
+        self.reactor = None
+
+    def ensure_started(self):
+        """第一次爬取时启动reactor线程，之后的爬取都复用它"""
+        with self.lock:
+            if self.reactor is not None:
+                return
+            started = concurrent.futures.Future()
+            threading.Thread(target=self._run_reactor, args=(started,),
+                             name="crawler-reactor", daemon=True).start()
+            started.result()
+
+    def _run_reactor(self, started):
+        try:
+            from scrapy.crawler import CrawlerRunner
+            from scrapy.utils.log import configure_logging
+            from scrapy.utils.project import get_project_settings
+            from scrapy.utils.reactor import install_reactor
+            settings = get_project_settings()
+            if settings.get("TWISTED_REACTOR"):
+                install_reactor(settings.get("TWISTED_REACTOR"),
+                                settings.get("ASYNCIO_EVENT_LOOP"))
+            from twisted.internet import reactor
+            configure_logging(settings)
+            self.runner = CrawlerRunner(settings)
+        except Exception as e:
+            started.set_exception(e)
+            return
+        self.reactor = reactor
+        reactor.callWhenRunning(started.set_result, None)
+        reactor.run(installSignalHandlers=False)
+
+    def crawl(self, overrides):
+        """开始一次爬取，overrides为本次爬取的设置，返回爬取记录，爬取结束时其中的future完成"""
+        self.ensure_started()
+        key = json.dumps(overrides, sort_keys=True, ensure_ascii=False)
+        with self.lock:
+            for run in self.runs.values():
+                if run["key"] == key and not run["future"].done():
+                    print(f"[INFO] 相同设置的爬取{run['run_id']}正在进行，等待其结果")
+                    return run
+            run_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+            run = {
+                "run_id": run_id,
+                "key": key,
+                "overrides": overrides,
+                "result_dir": os.path.join(RESULT_ROOT, run_id),
+                "started_at": time.time(),
+                "crawler": None,
+                "error": None,
+                "future": concurrent.futures.Future(),
+            }
+            self.runs[run_id] = run
+            frontier_key = self.frontier_key(overrides)
+            previous = self.frontier_runs.get(frontier_key)
+            self.frontier_runs[frontier_key] = run
+        if previous is not None and not previous["future"].done():
+            print(f"[INFO] 爬取{run_id}与{previous['run_id']}使用同一待爬队列，等其结束后开始")
+            previous["future"].add_done_callback(
+                lambda _: self.reactor.callFromThread(self._crawl, run))
+        else:
+            print(f"[INFO] 开始爬取{run_id}，设置：{key}")
+            self.reactor.callFromThread(self._crawl, run)
+        return run
+
+    def frontier_key(self, overrides):
+        from scrapy.utils.project import get_project_settings
+        settings = get_project_settings()
+        settings.setdict(overrides, priority="cmdline")
+        return json.dumps([settings.get(name) for name in FRONTIER_SETTINGS],
+                          sort_keys=True, ensure_ascii=False)
+
+    def _crawl(self, run):
+        from scrapy.crawler import Crawler
+        from scrapy.utils.project import get_project_settings
+        settings = get_project_settings()
+        settings.setdict(run["overrides"], priority="cmdline")
+        # 同时进行的爬取共用缓存目录，各自的结果写入单独的目录
+        settings.setdict({
+            "RESULT_DIR": run["result_dir"],
+            "CACHE_SHARED": True,
+        }, priority="cmdline")
+        self.absolute_paths(settings)
+        try:
+            crawler = Crawler(self.runner.spider_loader.load("search"),
+                              settings)
+            run["crawler"] = crawler
+            d = self.runner.crawl(crawler)
+        except Exception as e:
+            run["error"] = str(e)
+            self._finish(run)
+            return
+        d.addCallbacks(lambda _: self._finish(run), lambda failure: self._fail(run, failure))
+
+    def absolute_paths(self, settings):
+        """与在weibo-search目录中运行scrapy crawl相同，相对路径的设置都相对于该目录
+
+        不切换工作目录，切换会影响本进程中的所有线程。
+        """
+        for name, default in PATH_SETTINGS.items():
+            value = settings.get(name, default)
+            if isinstance(value, str) and value and "://" not in value \
+                    and not os.path.isabs(value):
+                settings.set(name, os.path.join(self.crawl_dir, value),
+                             priority=settings.getpriority(name) or "cmdline")
+
+    def _fail(self, run, failure):
+        run["error"] = failure.getErrorMessage() or failure.type.__name__
+        self._finish(run)
+
+    def _finish(self, run):
+        run["finished_at"] = time.time()
+        print(f"[INFO] 爬取{run['run_id']}结束，错误：{run['error']}")
+        run["future"].set_result(run)
+
+    def progress(self, run):
+        """爬取的状态和当前的统计信息，爬取进行中也可调用"""
+        crawler = run["crawler"]
+        stats = {}
+        if crawler is not None and crawler.stats is not None:
+            stats = simple_stats(dict(crawler.stats.get_stats()))
+        if not run["future"].done():
+            status = "running" if crawler is not None else "queued"
+        elif run["error"] is None and stats.get("finish_reason") in SUCCESS_REASONS:
+            status = "success"
+        else:
+            status = "failed"
+        end = run.get("finished_at", time.time())
         return {
-            "status": "failed",
+            "run_id": run["run_id"],
+            "status": status,
+            "error": run["error"],
+            "elapsed_seconds": round(end - run["started_at"], 1),
+            "result_dir": run["result_dir"],
+            "stats": stats,
+        }
+
+    def merge_results(self, run, file_paths):
+        """爬取成功时并入之前爬到过的微博，返回每个关键词的结果行数和本次新爬到的行数"""
+        if run["crawler"] is None or self.progress(run)["status"] != "success":
+            return {}
+        if "item_counts" not in run:
+            settings = run["crawler"].settings
+            dates = (None, None)
+            if not settings.getbool("INCREMENTAL"):
+                dates = (settings.get("START_DATE"), settings.get("END_DATE"))
+            counts = {keyword: merge_history(file_path, *dates)
+                      for keyword, file_path in file_paths.items()}
+            run["item_counts"] = {keyword: count[0] for keyword, count in counts.items()}
+            run["new_item_counts"] = {keyword: count[1] for keyword, count in counts.items()}
+        return {
+            "item_counts": run["item_counts"],
+            "new_item_counts": run["new_item_counts"],
         }
-    
-    # 2. 运行爬虫
-    success = await asyncio.to_thread(run_spider, crawl_dir)
 
-    if not success:
+    def result(self, run):
+        """爬取结束后返回给调用方的结果"""
+        result = self.progress(run)
+        keywords = run["overrides"].get("KEYWORD_LIST")
+        if keywords is None and run["crawler"] is not None:
+            keywords = run["crawler"].settings.get("KEYWORD_LIST")
+        if isinstance(keywords, list) and keywords:
+            # 结果目录和文件名与管道相同，话题关键词写作%23话题%23
+            result["result_file_paths"] = {
+                keyword: os.path.join(run["result_dir"], escape_keyword(keyword),
+                                      f"{escape_keyword(keyword)}.csv")
+                for keyword in keywords
+            }
+            if len(keywords) == 1:
+                result["result_file_path"] = result["result_file_paths"][keywords[0]]
+            result.update(self.merge_results(run, result["result_file_paths"]))
+        # 爬虫每次运行结束时写入的性能指标，同目录下还有Prometheus文本格式的metrics.prom
+        metrics_file_path = os.path.join(run["result_dir"], "metrics.json")
+        result["metrics_file_path"] = metrics_file_path
+        result["metrics"] = load_metrics(metrics_file_path)
+        return result
+
+
+crawl_runner = CrawlRunner(CRAWL_DIR)
+# 按天分片爬取的记录，键为run_id，值为写入manifest.json的内容
+backfills = {}
+
+
+def get_days(start_date, end_date):
+    """返回[start_date, end_date]中的每一天，日期格式为YYYY-MM-DD"""
+    start = datetime.strptime(start_date, "%Y-%m-%d")
+    end = datetime.strptime(end_date, "%Y-%m-%d")
+    if start > end:
+        raise ValueError(f"开始日期{start_date}晚于结束日期{end_date}")
+    return [(start + timedelta(days=i)).strftime("%Y-%m-%d")
+            for i in range((end - start).days + 1)]
+
+
+async def run_shard(semaphore, manifest, shard, keywords_path, timeout):
+    """在单独的scrapy进程中爬取一天，结果写入该天的目录，输出写入该天的日志文件
+
+    进程正常退出且爬取结束的原因（写入了性能指标时）为SUCCESS_REASONS之一时视为成功。
+    """
+    day = shard["date"]
+    cmd = [sys.executable, "-m", "scrapy", "crawl", "search",
+           "-s", f"START_DATE={day}", "-s", f"END_DATE={day}",
+           "-s", f"RESULT_DIR={shard['result_dir']}",
+           "-s", "CACHE_SHARED=True",
+           "-s", f"CLOSESPIDER_TIMEOUT={timeout}"]
+    if keywords_path:
+        cmd += ["-s", f"KEYWORD_LIST={keywords_path}"]
+    async with semaphore:
+        shard["status"] = "running"
+        start = time.time()
+        print(f"[INFO] 执行命令: {' '.join(cmd)}")
+        try:
+            with open(shard["log_path"], 'w', encoding='utf-8') as shard_log:
+                process = await asyncio.create_subprocess_exec(
+                    *cmd, cwd=CRAWL_DIR, stdout=shard_log,
+                    stderr=asyncio.subprocess.STDOUT)
+                returncode = await process.wait()
+        except Exception as e:
+            print(f"[ERR] 执行爬虫失败: {str(e)}")
+            returncode = None
+    shard["elapsed_seconds"] = round(time.time() - start, 1)
+    shard["returncode"] = returncode
+    # METRICS_ENABLED为False时没有性能指标，只看进程的退出码
+    metrics = load_metrics(os.path.join(shard["result_dir"], "metrics.json"))
+    success = returncode == 0
+    if metrics:
+        shard["finish_reason"] = metrics.get("finish_reason")
+        shard["item_count"] = metrics["stats"].get("item_scraped_count", 0)
+        shard["summary"] = metrics["summary"]
+        success = success and shard["finish_reason"] in SUCCESS_REASONS
+    shard["status"] = "success" if success else "failed"
+    print(f"[INFO] {day}爬取完成，状态码：{returncode}")
+
+
+def merge_shards(run_dir, shards):
+    """按日期顺序合并各天每个关键词的结果csv，返回{关键词: 合并后的csv路径}"""
+    parts = {}
+    for shard in shards:
+        if not os.path.isdir(shard["result_dir"]):
+            continue
+        for keyword in sorted(os.listdir(shard["result_dir"])):
+            part_path = os.path.join(shard["result_dir"], keyword, f"{keyword}.csv")
+            if os.path.isfile(part_path):
+                parts.setdefault(keyword, []).append(part_path)
+    files = {}
+    for keyword, part_paths in parts.items():
+        file_path = os.path.join(run_dir, keyword, f"{keyword}.csv")
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w', encoding='utf-8-sig', newline='') as dst:
+            for i, part_path in enumerate(part_paths):
+                with open(part_path, encoding='utf-8-sig', newline='') as src:
+                    header = src.readline()
+                    if i == 0:
+                        dst.write(header)
+                    shutil.copyfileobj(src, dst)
+        files[keyword] = file_path
+    return files
+
+
+async def run_backfill(keywords, days, parallelism, timeout):
+    """将日期范围按天分片，最多parallelism个scrapy进程同时爬取，结束后合并结果并写入manifest.json"""
+    run_id = datetime.now().strftime("%Y%m%d_%H%M%S_%f")
+    run_dir = os.path.join(RESULT_ROOT, run_id)
+    os.makedirs(run_dir, exist_ok=True)
+    keywords_path = None
+    if keywords:
+        keywords_path = os.path.join(run_dir, "keywords.txt")
+        with open(keywords_path, 'w', encoding='utf-8') as f:
+            f.write("\n".join(keywords) + "\n")
+    manifest = {
+        "run_id": run_id,
+        "status": "running",
+        "keywords": keywords,
+        "start_date": days[0],
+        "end_date": days[-1],
+        "parallelism": parallelism,
+        "result_dir": run_dir,
+        "shards": [{
+            "date": day,
+            "status": "pending",
+            "result_dir": os.path.join(run_dir, day),
+            "log_path": os.path.join(run_dir, f"{day}.log"),
+        } for day in days],
+    }
+    backfills[run_id] = manifest
+    start = time.time()
+    semaphore = asyncio.Semaphore(parallelism)
+    await asyncio.gather(*[
+        run_shard(semaphore, manifest, shard, keywords_path, timeout)
+        for shard in manifest["shards"]
+    ])
+    files = merge_shards(run_dir, manifest["shards"])
+    for keyword in keywords or []:
+        name = escape_keyword(keyword)
+        files.setdefault(name, os.path.join(run_dir, name, f"{name}.csv"))
+    succeeded = sum(shard["status"] == "success" for shard in manifest["shards"])
+    if succeeded == len(days):
+        manifest["status"] = "success"
+    else:
+        manifest["status"] = "partial" if succeeded else "failed"
+    manifest["elapsed_seconds"] = round(time.time() - start, 1)
+    manifest["item_count"] = sum(shard.get("item_count", 0) for shard in manifest["shards"])
+    manifest["result_file_paths"] = keyword_file_paths(files, keywords)
+    counts = {keyword: merge_history(file_path, days[0], days[-1])
+              for keyword, file_path in manifest["result_file_paths"].items()}
+    manifest["item_counts"] = {keyword: count[0] for keyword, count in counts.items()}
+    manifest["new_item_counts"] = {keyword: count[1] for keyword, count in counts.items()}
+    if len(manifest["result_file_paths"]) == 1:
+        manifest["result_file_path"] = next(iter(manifest["result_file_paths"].values()))
+    manifest_path = os.path.join(run_dir, "manifest.json")
+    manifest["manifest_path"] = manifest_path
+    with open(manifest_path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+    print(f"[INFO] 分片爬取{run_id}结束，状态：{manifest['status']}")
+    return manifest
+
+
+async def run_crawl(overrides):
+    """在常驻的爬虫运行器中爬取并等待结束"""
+    try:
+        run = await asyncio.to_thread(crawl_runner.crawl, overrides)
+        await asyncio.wrap_future(run["future"])
+    except Exception as e:
+        print(f"[ERR] 执行爬虫失败: {str(e)}")
+        return {
+            "status": "failed",
+            "error": str(e),
+        }
+    result = crawl_runner.result(run)
+    if result["status"] != "success":
         print("[ERR]爬虫执行失败")
+    return result
+
+
+@mcp.tool()
+async def start_crawler(keywords: list[str] = None, start_date: str = "",
+                        end_date: str = "", parallelism: int = 1,
+                        timeout: int = CRAWL_TIMEOUT):
+    """
+    调用本地的爬虫服务获取微博平台指定日期范围内的企业相关舆情信息，默认获取昨天的
+    :param keywords: 搜索关键词列表，为空时使用爬虫配置中的关键词
+    :param start_date: 开始日期，格式为YYYY-MM-DD，默认为昨天
+    :param end_date: 结束日期，格式为YYYY-MM-DD，默认与开始日期相同
+    :param parallelism: 同时运行的爬虫进程数，日期范围按天分片，每天由一个进程爬取
+    :param timeout: 每天的最长爬取秒数，未爬完的部分再次以相同参数调用时继续
+    :return: dict 包括爬虫状态"status"、每个关键词的结果csv文件路径"result_file_paths"（只有一个关键词时
+        另有"result_file_path"），csv中是日期范围内的全部微博，包括之前的爬取已爬到的；每个关键词的微博数
+        "item_counts"和其中本次新爬到的微博数"new_item_counts"；只爬一天时包括统计信息"stats"和性能指标"metrics"，
+        分片爬取时包括各天的状态和日志路径"shards"以及"manifest_path"
+    """
+    yesterday = time.strftime("%Y-%m-%d", time.localtime(time.time() - 86400))
+    start_date = start_date or yesterday
+    end_date = end_date or start_date
+    try:
+        days = get_days(start_date, end_date)
+    except ValueError as e:
+        print(f"[ERR] 日期参数错误: {str(e)}")
         return {
             "status": "failed",
+            "error": str(e),
         }
+    parallelism = max(1, parallelism)
+    if len(days) > 1 or parallelism > 1:
+        return await run_backfill(keywords, days, parallelism, timeout)
+    overrides = {
+        "START_DATE": start_date,
+        "END_DATE": end_date,
+        "CLOSESPIDER_TIMEOUT": timeout,
+    }
+    if keywords:
+        overrides["KEYWORD_LIST"] = keywords
+    return await run_crawl(overrides)
+
+
+@mcp.tool()
+async def poll_crawler():
+    """
+    增量获取微博平台昨天至今的企业相关舆情信息，只爬取上次爬取之后新发布的微博，可在一天内多次调用
+    :return: dict 包括爬虫状态"status"、结果csv文件路径"result_file_path"（只包括本次新爬到的微博）、
+        新爬到的微博数"new_item_counts"、本次运行的统计信息"stats"和性能指标"metrics"
+    """
+    yesterday = time.strftime("%Y-%m-%d", time.localtime(time.time() - 86400))
+    today = time.strftime("%Y-%m-%d", time.localtime())
+    return await run_crawl({
+        "START_DATE": yesterday,
+        "END_DATE": today,
+        "INCREMENTAL": True,
+        "CLOSESPIDER_TIMEOUT": CRAWL_TIMEOUT,
+    })
+
+
+@mcp.tool()
+async def crawl_progress(run_id: str = ""):
+    """
+    查询爬取的进度
+    :param run_id: start_crawler等返回的run_id，为空时返回所有爬取
+    :return: dict 包括爬取状态"status"、已用时间"elapsed_seconds"和当前的统计信息"stats"，
+        分片爬取返回各天的状态"shards"
+    """
+    runs = list(crawl_runner.runs.values())
+    if run_id:
+        if run_id in backfills:
+            return backfills[run_id]
+        runs = [run for run in runs if run["run_id"] == run_id]
+        if not runs:
+            return {"status": "not_found", "run_id": run_id}
+        return crawl_runner.progress(runs[0])
     return {
-        "status": "success" if success else "failed",
-        "result_file_path": result_file_path,
+        "runs": [crawl_runner.progress(run) for run in runs],
+        "backfills": list(backfills.values()),
     }
 
+
 if __name__ == "__main__":
     mcp.run(transport="sse")
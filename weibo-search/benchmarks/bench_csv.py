@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""测试CsvPipeline每秒写入的行数
+
+用fixtures目录中搜索结果页解析出的微博，按--keywords个关键词轮流写入--rows行，
+分别用每行打开、关闭一次文件的旧写法和缓冲写入的CsvPipeline写入临时目录，
+比较两者每秒写入的行数，并检查写出的文件完全相同。在weibo-search目录下运行：
+
+    python benchmarks/bench_csv.py
+    python benchmarks/bench_csv.py --rows 100000 --keywords 10
+"""
+import argparse
+import csv
+import filecmp
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from scrapy.http import HtmlResponse
+from scrapy.settings import Settings
+
+import weibo.utils.lxml_parser as lxml_parser
+from weibo.pipelines import CSV_HEADER, CsvPipeline, get_csv_row
+
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'fixtures')
+
+
+class LegacyCsvPipeline(object):
+    """缓冲写入之前的CsvPipeline，每行都检查目录、打开并关闭一次文件"""
+
+    def open_spider(self, spider):
+        self.result_dir = spider.settings.get('RESULT_DIR', '结果文件')
+
+    def process_item(self, item, spider):
+        base_dir = self.result_dir + os.sep + item['keyword']
+        if not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+        file_path = base_dir + os.sep + item['keyword'] + '.csv'
+        is_first_write = not os.path.isfile(file_path)
+        with open(file_path, 'a', encoding='utf-8-sig', newline='') as f:
+            writer = csv.writer(f)
+            if is_first_write:
+                writer.writerow(CSV_HEADER)
+            writer.writerow(get_csv_row(item['weibo']))
+        return item
+
+    def close_spider(self, spider):
+        pass
+
+
+def load_weibos():
+    """解析fixtures目录中的搜索结果页，返回其中的微博和被转发的微博"""
+    weibos = []
+    for file_name in sorted(os.listdir(FIXTURE_DIR)):
+        if not file_name.endswith('.html'):
+            continue
+        with open(os.path.join(FIXTURE_DIR, file_name), 'rb') as f:
+            response = HtmlResponse(url='https://s.weibo.com/weibo',
+                                    body=f.read(),
+                                    encoding='utf-8')
+        for weibo, retweet in lxml_parser.parse_cards(response.selector.root):
+            weibos.append(weibo)
+            if retweet is not None:
+                weibos.append(retweet)
+    return weibos
+
+
+def write_rows(pipeline, result_dir, weibos, rows, keywords):
+    spider = SimpleNamespace(settings=Settings({'RESULT_DIR': result_dir}))
+    items = [{
+        'weibo': weibos[i % len(weibos)],
+        'keyword': 'keyword%d' % (i % keywords)
+    } for i in range(rows)]
+    start = time.perf_counter()
+    pipeline.open_spider(spider)
+    for item in items:
+        pipeline.process_item(item, spider)
+    pipeline.close_spider(spider)
+    return rows / (time.perf_counter() - start)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='csv写入性能测试')
+    arg_parser.add_argument('--rows', type=int, default=20000)
+    arg_parser.add_argument('--keywords', type=int, default=3)
+    args = arg_parser.parse_args()
+
+    weibos = load_weibos()
+    with tempfile.TemporaryDirectory() as legacy_dir, \
+            tempfile.TemporaryDirectory() as buffered_dir:
+        legacy = write_rows(LegacyCsvPipeline(), legacy_dir, weibos,
+                            args.rows, args.keywords)
+        buffered = write_rows(CsvPipeline(), buffered_dir, weibos, args.rows,
+                              args.keywords)
+        names = [
+            os.path.join('keyword%d' % i, 'keyword%d.csv' % i)
+            for i in range(args.keywords)
+        ]
+        _, mismatch, errors = filecmp.cmpfiles(legacy_dir,
+                                               buffered_dir,
+                                               names,
+                                               shallow=False)
+    print('rows %d, keywords %d' % (args.rows, args.keywords))
+    print('  %-20s %10.1f' % ('legacy_rows_per_sec', legacy))
+    print('  %-20s %10.1f' % ('rows_per_sec', buffered))
+    print('  %-20s %10.2f' % ('speedup', buffered / legacy))
+    if mismatch or errors:
+        print('写出的文件与旧写法不同: %s' % ', '.join(mismatch + errors))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
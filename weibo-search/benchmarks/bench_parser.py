@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""离线测试搜索结果页的解析性能
+
+用fixtures目录中保存的搜索结果页离线运行SearchSpider.parse_weibo，不发送任何请求，
+计时时IP属地补全被替换为空操作。--parser ajax测试SEARCH_MODE为ajax时的解析，
+详情和长微博全文接口的返回从fixtures/ajax目录中读取。在weibo-search目录下运行：
+
+    python benchmarks/bench_parser.py
+    python benchmarks/bench_parser.py --parser lxml --rounds 50
+    python benchmarks/bench_parser.py --save-baseline
+
+输出每秒解析的微博卡片数、每秒输出的微博数、每个卡片需要下载的字节数和请求数、内存峰值和
+各字段的提取耗时。lxml和ajax的速度以同一次运行中xpath的速度为1计算speedup，与baseline.json
+中的speedup比较，下降超过--max-regression时以状态码1退出。每秒解析数等绝对值随机器不同，
+基线中的只供参考，不做比较。
+"""
+import argparse
+import contextlib
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from urllib.parse import parse_qs, urlparse
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from scrapy.crawler import Crawler
+from scrapy.http import HtmlResponse, Request, TextResponse
+from scrapy.statscollectors import StatsCollector
+from scrapy.utils.project import get_project_settings
+
+import weibo.utils.ajax_parser as ajax_parser
+import weibo.utils.lxml_parser as lxml_parser
+import weibo.utils.util as util
+from weibo.spiders.search import SearchSpider
+
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'fixtures')
+BASELINE_PATH = os.path.join(BENCH_DIR, 'baseline.json')
+AJAX_DIR = os.path.join(FIXTURE_DIR, 'ajax')
+PARSERS = ['xpath', 'lxml', 'ajax']
+# 计算speedup时作为1的解析方式
+REFERENCE_PARSER = 'xpath'
+# 各解析方式中负责提取单个字段的函数：(所属对象, 函数名, 字段名)
+FIELD_FUNCTIONS = {
+    'xpath': [
+        (SearchSpider, 'get_article_url', 'article_url'),
+        (SearchSpider, 'get_location', 'location'),
+        (SearchSpider, 'get_at_users', 'at_users'),
+        (SearchSpider, 'get_topics', 'topics'),
+        (util, 'standardize_date', 'created_at'),
+    ],
+    'lxml': [
+        (lxml_parser.Card, 'walk', 'walk'),
+        (lxml_parser.Card, 'get_article_url', 'article_url'),
+        (lxml_parser.Card, 'get_location', 'location'),
+        (lxml_parser.Card, 'get_at_users_and_topics', 'at_users,topics'),
+        (util, 'standardize_date', 'created_at'),
+    ],
+    'ajax': [
+        (json, 'loads', 'json'),
+        (ajax_parser, 'set_text', 'text'),
+        (ajax_parser, 'get_pics', 'pics'),
+        (ajax_parser, 'get_user_authentication', 'user_authentication'),
+        (ajax_parser, 'get_created_at', 'created_at'),
+    ]
+}
+
+
+def load_pages():
+    """读取fixtures目录中的搜索结果页"""
+    pages = []
+    for file_name in sorted(os.listdir(FIXTURE_DIR)):
+        if file_name.endswith('.html'):
+            with open(os.path.join(FIXTURE_DIR, file_name), 'rb') as f:
+                pages.append(f.read())
+    return pages
+
+
+def load_details():
+    """读取fixtures/ajax目录中的详情和长微博全文接口返回，按bid保存为原始字节"""
+    details = {'show': {}, 'longtext': {}}
+    for file_name in sorted(os.listdir(AJAX_DIR)):
+        if file_name.endswith('.json'):
+            with open(os.path.join(AJAX_DIR, file_name), encoding='utf-8') as f:
+                for kind, payloads in json.load(f).items():
+                    for bid, payload in payloads.items():
+                        details[kind][bid] = json.dumps(
+                            payload, ensure_ascii=False).encode('utf-8')
+    return details
+
+
+def create_spider(parser, cache_dir):
+    settings = get_project_settings()
+    if parser == 'ajax':
+        settings.set('SEARCH_MODE', 'ajax')
+    else:
+        settings.set('PARSER', parser)
+    settings.set('CACHE_DIR', cache_dir)
+    crawler = Crawler(SearchSpider, settings)
+    crawler.stats = StatsCollector(crawler)
+    spider = SearchSpider.from_crawler(crawler)
+    # 离线测试，不查询IP属地
+    spider.fill_ip = lambda item: item
+    return spider
+
+
+def count_items(output, details, requests=None):
+    """统计输出的微博数，ajax模式下用fixtures中的接口返回代替请求并解析，
+    给出requests时在其中记录接口请求的(接口, bid)"""
+    if not isinstance(output, Request):
+        return 1
+    kind = 'longtext' if '/longtext' in output.url else 'show'
+    bid = parse_qs(urlparse(output.url).query)['id'][0]
+    if requests is not None:
+        requests.append((kind, bid))
+    response = TextResponse(url=output.url,
+                            body=details[kind][bid],
+                            encoding='utf-8',
+                            request=output)
+    return sum(
+        count_items(o, details, requests) for o in output.callback(response))
+
+
+def parse_pages(spider, pages, details=None, requests=None):
+    """解析所有页面，返回输出的微博数"""
+    items = 0
+    for body in pages:
+        request = Request('https://s.weibo.com/weibo?q=benchmark',
+                          meta={'keyword': 'benchmark'})
+        response = HtmlResponse(url=request.url,
+                                body=body,
+                                encoding='utf-8',
+                                request=request)
+        for output in spider.parse_weibo(response):
+            items += count_items(output, details, requests)
+    return items
+
+
+def count_downloads(spider, pages, details):
+    """解析一遍所有页面需要下载的字节数和请求数
+
+    包括搜索结果页、ajax模式的详情和长微博全文接口，以及html模式每条微博查询IP属地的
+    详情接口请求（详情缓存未命中时），fixtures中没有的详情按平均大小计算。
+    """
+    requests = []
+    lookups = []
+    fill_ip = spider.fill_ip
+    spider.fill_ip = lambda item: lookups.append(item['weibo']['bid']) or item
+    try:
+        parse_pages(spider, pages,
+                    details if spider.search_mode == 'ajax' else None,
+                    requests)
+    finally:
+        spider.fill_ip = fill_ip
+    shows = details['show']
+    average_show = sum(len(body) for body in shows.values()) / len(shows)
+    downloaded = sum(len(body) for body in pages)
+    downloaded += sum(len(details[kind][bid]) for kind, bid in requests)
+    downloaded += sum(len(shows.get(bid, b'')) or average_show
+                      for bid in lookups)
+    return downloaded, len(pages) + len(requests) + len(lookups)
+
+
+def count_cards(spider, pages):
+    cards = 0
+    for body in pages:
+        response = HtmlResponse(url='https://s.weibo.com/weibo',
+                                body=body,
+                                encoding='utf-8')
+        cards += sum(1 for _ in spider.parse_cards(response))
+    return cards
+
+
+class FieldTimer(object):
+    """临时替换字段提取函数，累计每个字段的耗时"""
+
+    def __init__(self, functions):
+        self.functions = functions
+        self.seconds = {field: 0.0 for _, _, field in functions}
+        self.originals = []
+
+    def wrap(self, func, field):
+
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.seconds[field] += time.perf_counter() - start
+
+        return timed
+
+    def __enter__(self):
+        for owner, name, field in self.functions:
+            func = getattr(owner, name)
+            self.originals.append((owner, name, func))
+            setattr(owner, name, self.wrap(func, field))
+        return self
+
+    def __exit__(self, *exc_info):
+        for owner, name, func in self.originals:
+            setattr(owner, name, func)
+
+
+def bench(parser, pages, rounds, cache_dir):
+    spider = create_spider(parser, cache_dir)
+    all_details = load_details()
+    details = all_details if parser == 'ajax' else None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        cards = count_cards(spider, pages)
+        downloaded, requests = count_downloads(spider, pages, all_details)
+        # 预热
+        parse_pages(spider, pages, details)
+        start = time.perf_counter()
+        items = 0
+        for _ in range(rounds):
+            items += parse_pages(spider, pages, details)
+        seconds = time.perf_counter() - start
+
+        tracemalloc.start()
+        parse_pages(spider, pages, details)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        with FieldTimer(FIELD_FUNCTIONS[parser]) as timer:
+            for _ in range(rounds):
+                parse_pages(spider, pages, details)
+    spider.closed('finished')
+    return {
+        'cards_per_sec': round(cards * rounds / seconds, 1),
+        'items_per_sec': round(items / seconds, 1),
+        'bytes_per_card': round(downloaded / cards),
+        'requests_per_card': round(requests / cards, 2),
+        'peak_memory_kb': round(peak_memory / 1024, 1),
+        'field_us_per_card': {
+            field: round(total / (cards * rounds) * 1e6, 2)
+            for field, total in timer.seconds.items()
+        }
+    }
+
+
+def print_result(parser, result, baseline):
+    print('[%s]' % parser)
+    for key in [
+            'cards_per_sec', 'speedup', 'items_per_sec', 'bytes_per_card',
+            'requests_per_card', 'peak_memory_kb'
+    ]:
+        if key not in result:
+            continue
+        line = '  %-16s %10s' % (key, result[key])
+        if baseline and key in baseline:
+            line += '  (baseline %s)' % baseline[key]
+        print(line)
+    print('  field_us_per_card')
+    for field, us in result['field_us_per_card'].items():
+        print('    %-16s %8s' % (field, us))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='搜索结果页解析性能测试')
+    arg_parser.add_argument('--parser', choices=PARSERS + ['all'],
+                            default='all')
+    arg_parser.add_argument('--rounds', type=int, default=20)
+    arg_parser.add_argument('--baseline', default=BASELINE_PATH)
+    arg_parser.add_argument('--save-baseline', action='store_true',
+                            help='将本次结果保存为新的基线')
+    arg_parser.add_argument('--max-regression', type=float, default=0.2,
+                            help='允许的speedup下降比例')
+    args = arg_parser.parse_args()
+
+    pages = load_pages()
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+    parsers = PARSERS if args.parser == 'all' else [args.parser]
+    if REFERENCE_PARSER not in parsers:
+        parsers = [REFERENCE_PARSER] + parsers
+    results = {}
+    regressed = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for parser in parsers:
+            results[parser] = bench(parser, pages, args.rounds, cache_dir)
+    reference = results[REFERENCE_PARSER]['cards_per_sec']
+    for parser, result in results.items():
+        if parser != REFERENCE_PARSER:
+            result['speedup'] = round(result['cards_per_sec'] / reference, 2)
+        print_result(parser, result, baseline.get(parser))
+        expected = baseline.get(parser, {}).get('speedup')
+        if expected and result['speedup'] < expected * (
+                1 - args.max_regression):
+            regressed.append(parser)
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baseline, f, ensure_ascii=False, indent=4)
+        print('基线已保存到%s' % args.baseline)
+    elif regressed:
+        print('相对%s的解析速度低于基线：%s' %
+              (REFERENCE_PARSER, ','.join(regressed)))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
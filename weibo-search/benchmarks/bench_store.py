@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""测试WeiboStore的写入速度和历史微博查询耗时
+
+用fixtures目录中搜索结果页解析出的微博，改写id和发布时间后生成--rows条分布在
+--days天、--keywords个关键词中的微博，批量写入临时目录中的数据库，再测试常见查询
+每次的耗时。在weibo-search目录下运行：
+
+    python benchmarks/bench_store.py
+    python benchmarks/bench_store.py --rows 1000000 --days 365
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from bench_csv import load_weibos
+
+from weibo.utils.weibo_store import WeiboStore
+
+
+def make_weibos(weibos, rows, days, keywords):
+    latest = datetime(2025, 10, 1)
+    step = days * 86400 / rows
+    for i in range(rows):
+        weibo = dict(weibos[i % len(weibos)])
+        weibo['id'] = str(5000000000000000 + i)
+        weibo['user_id'] = str(1000 + i % 5000)
+        weibo['created_at'] = (latest - timedelta(seconds=i * step)
+                               ).strftime('%Y-%m-%d %H:%M')
+        yield 'keyword%d' % (i % keywords), weibo
+
+
+def time_query(store, rounds, **kwargs):
+    """返回查询耗时的中位数（毫秒）和结果条数"""
+    times = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        result = store.search(**kwargs)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times), len(result)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='SQLite存储性能测试')
+    arg_parser.add_argument('--rows', type=int, default=200000)
+    arg_parser.add_argument('--days', type=int, default=180)
+    arg_parser.add_argument('--keywords', type=int, default=5)
+    arg_parser.add_argument('--rounds', type=int, default=20)
+    args = arg_parser.parse_args()
+
+    weibos = load_weibos()
+    # 取样例微博正文中的词作为查询词
+    text = max((weibo['text'] for weibo in weibos), key=len)
+    long_word, short_word = text[10:14], text[20:22]
+    with tempfile.TemporaryDirectory() as store_dir:
+        store = WeiboStore(os.path.join(store_dir, 'weibo.db'))
+        start = time.perf_counter()
+        for keyword, weibo in make_weibos(weibos, args.rows, args.days,
+                                          args.keywords):
+            store.add(keyword, weibo)
+        store.flush()
+        rows_per_sec = args.rows / (time.perf_counter() - start)
+        queries = [
+            ('keyword_30_days', {
+                'keyword': 'keyword0',
+                'since': '2025-09-01'
+            }),
+            ('match', {
+                'match': long_word
+            }),
+            ('keyword_match_30_days', {
+                'keyword': 'keyword0',
+                'match': long_word,
+                'since': '2025-09-01'
+            }),
+            ('keyword_short_match_30_days', {
+                'keyword': 'keyword0',
+                'match': short_word,
+                'since': '2025-09-01'
+            }),
+            ('user_id', {
+                'user_id': '1000'
+            }),
+        ]
+        print('rows %d, days %d, keywords %d' %
+              (args.rows, args.days, args.keywords))
+        print('  %-30s %10.1f' % ('rows_per_sec', rows_per_sec))
+        for name, kwargs in queries:
+            ms, count = time_query(store, args.rounds, **kwargs)
+            print('  %-30s %8.2fms %6d条' % (name, ms, count))
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""用本地的stub_server端到端运行一次crawl_server的分片爬取，检查返回的状态
+
+启动stub_server，以crawl_server.run_backfill按天分片爬取--days天，每天一个scrapy进程，
+进程使用stub_settings.py中的设置并开启性能指标。检查每个分片和整体的状态都为success、
+微博数与服务生成的相同、合并后的csv行数相同，不满足时返回非0。需要安装crawl_server
+依赖的mcp。在weibo-search目录下运行：
+
+    python benchmarks/smoke_backfill.py
+    python benchmarks/smoke_backfill.py --days 3 --parallelism 3
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+CRAWL_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, CRAWL_DIR)
+sys.path.insert(0, os.path.dirname(CRAWL_DIR))
+
+import stub_settings
+from stub_server import StubServer
+
+KEYWORD = stub_settings.KEYWORD_LIST[0]
+
+
+def count_rows(path):
+    if not path or not os.path.isfile(path):
+        return 0
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        return sum(1 for _ in csv.reader(f)) - 1
+
+
+def import_crawl_server(work_dir):
+    """crawl_server导入时把输出重定向到当前目录下logs中的日志文件，并读取端口参数"""
+    stdout, stderr, argv = sys.stdout, sys.stderr, sys.argv
+    cwd = os.getcwd()
+    sys.argv = argv[:1]
+    os.chdir(work_dir)
+    try:
+        import crawl_server
+    finally:
+        os.chdir(cwd)
+        sys.stdout, sys.stderr, sys.argv = stdout, stderr, argv
+    crawl_server.CRAWL_DIR = CRAWL_DIR
+    crawl_server.RESULT_ROOT = os.path.join(work_dir, '结果文件')
+    crawl_server.HISTORY_DIR = os.path.join(crawl_server.RESULT_ROOT, '汇总')
+    return crawl_server
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='分片爬取冒烟测试')
+    arg_parser.add_argument('--days', type=int, default=2)
+    arg_parser.add_argument('--parallelism', type=int, default=2)
+    arg_parser.add_argument('--rate', type=int, default=5, help='每小时的微博数')
+    args = arg_parser.parse_args()
+
+    server = StubServer(rate=args.rate,
+                        bad_cookies=[stub_settings.BAD_COOKIE]).start()
+    with tempfile.TemporaryDirectory() as work_dir:
+        # scrapy进程继承这些环境变量
+        os.environ['SCRAPY_SETTINGS_MODULE'] = 'stub_settings'
+        os.environ['PYTHONPATH'] = os.pathsep.join(
+            filter(None, [BENCH_DIR, os.environ.get('PYTHONPATH')]))
+        os.environ['STUB_SERVER_URL'] = server.url
+        os.environ['STUB_WORK_DIR'] = work_dir
+        crawl_server = import_crawl_server(work_dir)
+        start_date = date(2025, 10, 1)
+        days = [(start_date + timedelta(days=i)).isoformat()
+                for i in range(args.days)]
+        manifest = asyncio.run(
+            crawl_server.run_backfill([KEYWORD], days, args.parallelism, 300))
+        rows = count_rows(manifest.get('result_file_path'))
+    server.stop()
+
+    expected = args.rate * 24 * args.days
+    shards = [(shard['date'], shard['status'], shard.get('finish_reason'),
+               shard.get('item_count')) for shard in manifest['shards']]
+    checks = [
+        ('status', manifest['status'] == 'success'),
+        ('shards', all(shard[1] == 'success' for shard in shards)),
+        ('item_count', manifest['item_count'] == expected),
+        ('csv_rows', rows == expected),
+    ]
+    print(
+        json.dumps(
+            {
+                'expected_items': expected,
+                'status': manifest['status'],
+                'item_count': manifest['item_count'],
+                'csv_rows': rows,
+                'shards': shards,
+            },
+            ensure_ascii=False,
+            indent=4))
+    failed = [name for name, ok in checks if not ok]
+    if failed:
+        print('失败：%s' % ', '.join(failed))
+        sys.exit(1)
+    print('通过')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""用本地的stub_server端到端运行一次搜索爬虫，检查爬取结果
+
+启动stub_server，以池中有一个失效cookie的cookie池在临时目录中爬取--days天的微博，
+检查爬虫正常结束、搜索单元全部爬完、输出和写入csv的微博数与服务生成的相同、失效的
+cookie被隔离、每个cookie同时进行的请求数不超过SESSION_CONCURRENT_REQUESTS，不满足时
+返回非0。不读取weibo/settings.py，使用stub_settings.py中的设置。
+在weibo-search目录下运行：
+
+    python benchmarks/smoke_crawl.py
+    python benchmarks/smoke_crawl.py --mode ajax --days 2
+"""
+import argparse
+import contextlib
+import csv
+import io
+import json
+import os
+import sys
+import tempfile
+from datetime import date, timedelta
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from scrapy.crawler import CrawlerProcess
+from scrapy.settings import Settings
+
+import stub_settings
+from stub_server import StubServer
+
+from weibo.spiders.search import SearchSpider
+
+KEYWORD = stub_settings.KEYWORD_LIST[0]
+
+
+def get_settings(server, mode, days, work_dir):
+    start_date = date(2025, 10, 1)
+    end_date = start_date + timedelta(days=days - 1)
+    settings = Settings()
+    settings.setmodule(stub_settings, priority='project')
+    settings.setdict(
+        {
+            'STUB_SERVER_URL': server.url,
+            'START_DATE': start_date.isoformat(),
+            'END_DATE': end_date.isoformat(),
+            'SEARCH_MODE': mode,
+            'CACHE_DIR': os.path.join(work_dir, '缓存文件'),
+            'RESULT_DIR': os.path.join(work_dir, '结果文件'),
+        },
+        priority='cmdline')
+    return settings
+
+
+def count_rows(path):
+    if not os.path.isfile(path):
+        return 0
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        return sum(1 for _ in csv.reader(f)) - 1
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='搜索爬虫冒烟测试')
+    arg_parser.add_argument('--mode', choices=['html', 'ajax'], default='html')
+    arg_parser.add_argument('--days', type=int, default=1)
+    arg_parser.add_argument('--rate', type=int, default=5, help='每小时的微博数')
+    arg_parser.add_argument('--delay',
+                            type=float,
+                            default=0.02,
+                            help='本地服务每个请求的延迟秒数，使同时进行的请求重叠')
+    args = arg_parser.parse_args()
+
+    server = StubServer(rate=args.rate,
+                        delay=args.delay,
+                        bad_cookies=[stub_settings.BAD_COOKIE]).start()
+    with tempfile.TemporaryDirectory() as work_dir:
+        settings = get_settings(server, args.mode, args.days, work_dir)
+        process = CrawlerProcess(settings, install_root_handler=False)
+        crawler = process.create_crawler(SearchSpider)
+        process.crawl(crawler)
+        # 爬虫会打印每条微博，只输出检查结果
+        with contextlib.redirect_stdout(io.StringIO()):
+            process.start()
+        stats = crawler.stats.get_stats()
+        rows = count_rows(
+            os.path.join(settings.get('RESULT_DIR'), KEYWORD, KEYWORD + '.csv'))
+    server.stop()
+
+    expected = args.rate * 24 * args.days
+    # 每个cookie同时进行的请求，包括IP属地和详情请求
+    max_active = max(cookie['max_active']
+                     for cookie in server.stats['cookies'].values())
+    concurrency = settings.getint('SESSION_CONCURRENT_REQUESTS', 2)
+    checks = [
+        ('finish_reason', stats.get('finish_reason') == 'finished'),
+        ('frontier/finished', stats.get('frontier/finished') is True),
+        ('item_scraped_count',
+         stats.get('item_scraped_count', 0) == expected),
+        ('csv_rows', rows == expected),
+        ('session/quarantined', stats.get('session/quarantined', 0) >= 1),
+        ('max_active_per_cookie', max_active <= concurrency),
+    ]
+    print(
+        json.dumps(
+            {
+                'expected_items': expected,
+                'item_scraped_count': stats.get('item_scraped_count', 0),
+                'csv_rows': rows,
+                'finish_reason': stats.get('finish_reason'),
+                'session/quarantined': stats.get('session/quarantined', 0),
+                'session/reissued': stats.get('session/reissued', 0),
+                'max_active_per_cookie': max_active,
+                'server': server.stats,
+            },
+            ensure_ascii=False,
+            indent=4))
+    failed = [name for name, ok in checks if not ok]
+    if failed:
+        print('失败：%s' % ', '.join(failed))
+        sys.exit(1)
+    print('通过')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""检查MysqlPipeline在一批中有一条微博写入出错时只丢弃这一条
+
+在MySQL中新建临时数据库，用fixtures目录中的微博改写id后生成--rows条，其中一条的id为空，
+按MYSQL_BATCH_SIZE分批写入。检查表中的微博数、mysql/rows和mysql/failed_rows，不满足时
+返回非0，结束后删除临时数据库。需要可连接的MySQL（默认的严格模式下空id写入出错）。
+在weibo-search目录下运行：
+
+    python benchmarks/smoke_mysql.py --password 123456
+    python benchmarks/smoke_mysql.py --host 127.0.0.1 --rows 1000 --batch-size 300
+"""
+import argparse
+import json
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from scrapy import Spider
+from scrapy.crawler import Crawler
+from scrapy.settings import Settings
+from scrapy.statscollectors import StatsCollector
+from twisted.internet import defer, task
+
+from bench_csv import load_weibos
+
+from weibo.pipelines import MysqlPipeline
+
+
+def make_items(weibos, rows):
+    """生成rows条微博，第rows // 2条的id为空"""
+    items = []
+    for i in range(rows):
+        weibo = dict(weibos[i % len(weibos)])
+        weibo['id'] = None if i == rows // 2 else str(5000000000000000 + i)
+        items.append({'keyword': 'smoke', 'weibo': weibo})
+    return items
+
+
+def create_spider(args, database):
+    settings = Settings({
+        'MYSQL_HOST': args.host,
+        'MYSQL_PORT': args.port,
+        'MYSQL_USER': args.user,
+        'MYSQL_PASSWORD': args.password,
+        'MYSQL_DATABASE': database,
+        'MYSQL_BATCH_SIZE': args.batch_size,
+    })
+    crawler = Crawler(Spider, settings)
+    crawler.stats = StatsCollector(crawler)
+    spider = Spider('smoke')
+    spider._set_crawler(crawler)
+    spider.mysql_error = False
+    spider.pymysql_error = False
+    return spider
+
+
+def count_table(args, database):
+    import pymysql
+    db = pymysql.connect(host=args.host,
+                         port=args.port,
+                         user=args.user,
+                         password=args.password,
+                         db=database)
+    try:
+        cursor = db.cursor()
+        cursor.execute('SELECT COUNT(*) FROM weibo')
+        count = cursor.fetchone()[0]
+        cursor.execute('DROP DATABASE %s' % database)
+        return count
+    finally:
+        db.close()
+
+
+@defer.inlineCallbacks
+def run(reactor, args, result):
+    database = 'weibo_smoke_%d' % os.getpid()
+    spider = create_spider(args, database)
+    pipeline = MysqlPipeline()
+    pipeline.open_spider(spider)
+    if pipeline.dbpool is None:
+        raise RuntimeError('无法连接MySQL')
+    for item in make_items(load_weibos(), args.rows):
+        output = pipeline.process_item(item, spider)
+        if isinstance(output, defer.Deferred):
+            yield output
+    yield pipeline.close_spider(spider)
+    result['stats'] = spider.crawler.stats.get_stats()
+    result['table_rows'] = count_table(args, database)
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='MySQL批量写入出错测试')
+    arg_parser.add_argument('--host', default='localhost')
+    arg_parser.add_argument('--port', type=int, default=3306)
+    arg_parser.add_argument('--user', default='root')
+    arg_parser.add_argument('--password', default='123456')
+    arg_parser.add_argument('--rows', type=int, default=450)
+    arg_parser.add_argument('--batch-size', type=int, default=200)
+    args = arg_parser.parse_args()
+
+    result = {}
+    try:
+        task.react(run, (args, result))
+    except SystemExit as e:
+        if e.code:
+            raise
+    stats = result['stats']
+    expected = args.rows - 1
+    checks = [
+        ('table_rows', result['table_rows'] == expected),
+        ('mysql/rows', stats.get('mysql/rows') == expected),
+        ('mysql/failed_rows', stats.get('mysql/failed_rows') == 1),
+    ]
+    print(
+        json.dumps(
+            {
+                'expected_rows': expected,
+                'table_rows': result['table_rows'],
+                'mysql/rows': stats.get('mysql/rows'),
+                'mysql/failed_rows': stats.get('mysql/failed_rows'),
+                'mysql/row_by_row_flushes':
+                stats.get('mysql/row_by_row_flushes'),
+            },
+            indent=4))
+    failed = [name for name, ok in checks if not ok]
+    if failed:
+        print('失败：%s' % ', '.join(failed))
+        sys.exit(1)
+    print('通过')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""代替微博的本地HTTP服务，离线测试搜索爬虫、cookie池和反爬处理
+
+搜索结果页用fixtures/mixed.html中的第一条微博改写id和发布时间生成，每小时--rate条，
+每页10条；详情接口的返回用fixtures/ajax/mixed.json改写，长微博全文接口返回固定正文。
+--bad-cookies中的cookie被重定向到登录页，--captcha-cookies中的cookie得到418；
+/stats返回按cookie统计的请求数和最大并发数。爬虫以StubDownloadHandler下载并把
+STUB_SERVER_URL设为本服务的地址后，所有weibo.com的请求都发到本服务。在weibo-search
+目录下运行：
+
+    python benchmarks/stub_server.py --port 8765
+    python benchmarks/stub_server.py --port 8765 --rate 50 --bad-cookies SUB=bad
+"""
+import argparse
+import json
+import math
+import os
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from scrapy.core.downloader.handlers.http11 import HTTP11DownloadHandler
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = os.path.join(BENCH_DIR, 'fixtures')
+# 样例微博的id、bid和发布时间，生成的微博替换这些值
+FIXTURE_ID = '5210000000000001'
+FIXTURE_BID = 'PabcDEF01'
+FIXTURE_DATE = '10月17日 09:30'
+LOGIN_PAGE = ('<html><head><title>Sina Visitor System</title></head>'
+              '<body><div class="login">登录</div></body></html>')
+LOGIN_URL = 'https://passport.weibo.com/visitor/visitor?entry=miniblog'
+
+
+def load_templates():
+    """返回搜索结果页的开头、结尾、一条微博的html和详情接口的返回"""
+    with open(os.path.join(FIXTURE_DIR, 'mixed.html'), encoding='utf-8') as f:
+        page = f.read()
+    card = re.search(
+        r'<div class="card-wrap".*?\n</div>\n(?=<div class="card-wrap")', page,
+        re.S).group(0)
+    head = page[:page.index('<div class="card-wrap"')]
+    tail = '</div>\n</div>\n</body>\n</html>\n'
+    with open(os.path.join(FIXTURE_DIR, 'ajax', 'mixed.json'),
+              encoding='utf-8') as f:
+        status = json.load(f)['show'][FIXTURE_BID]
+    return head, tail, card, status
+
+
+def parse_hour(value):
+    """解析timescope中的'2025-10-01-0'"""
+    date, hour = value.rsplit('-', 1)
+    return datetime.strptime(date, '%Y-%m-%d') + timedelta(hours=int(hour))
+
+
+def get_mid(hour, index):
+    """第hour小时第index条微博的id，bid为'B'加id"""
+    return '4%010d%05d' % (int(hour.timestamp()) // 3600, index)
+
+
+def get_created_at(mid):
+    hour = datetime.fromtimestamp(int(mid[1:11]) * 3600)
+    return hour + timedelta(minutes=int(mid[11:]) % 60)
+
+
+class StubServer(object):
+    """在后台线程中运行的本地服务，port为0时使用任一空闲端口"""
+
+    def __init__(self,
+                 port=0,
+                 rate=5,
+                 delay=0,
+                 bad_cookies=(),
+                 captcha_cookies=()):
+        self.rate = rate
+        self.delay = delay
+        self.bad_cookies = set(bad_cookies)
+        self.captcha_cookies = set(captcha_cookies)
+        self.head, self.tail, self.card, self.status = load_templates()
+        self.lock = threading.Lock()
+        self.active = {}
+        self.stats = {'search': 0, 'show': 0, 'longtext': 0, 'cookies': {}}
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', port), StubHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.stub = self
+        self.url = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever,
+                         name='stub-server',
+                         daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def enter(self, cookie):
+        with self.lock:
+            self.active[cookie] = self.active.get(cookie, 0) + 1
+            stats = self.stats['cookies'].setdefault(cookie, {
+                'requests': 0,
+                'max_active': 0
+            })
+            stats['requests'] += 1
+            stats['max_active'] = max(stats['max_active'], self.active[cookie])
+
+    def leave(self, cookie):
+        with self.lock:
+            self.active[cookie] -= 1
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def search_page(self, query, path):
+        """搜索结果页，每页10条，最多50页"""
+        start, end = query['timescope'][0][len('custom:'):].split(':')
+        start, end = parse_hour(start), parse_hour(end)
+        mids = []
+        hour = end - timedelta(hours=1)
+        while hour >= start:
+            mids.extend(get_mid(hour, i) for i in range(self.rate))
+            hour -= timedelta(hours=1)
+        if not mids:
+            return (self.head + '<div class="card card-no-result s-pt20b40">'
+                    '无结果</div>' + self.tail)
+        page = int(query.get('page', ['1'])[0])
+        pages = min(50, math.ceil(len(mids) / 10))
+        cards = ''.join(
+            self.card.replace(FIXTURE_ID, mid).replace(
+                FIXTURE_BID, 'B' + mid).replace(
+                    FIXTURE_DATE,
+                    get_created_at(mid).strftime('%Y年%m月%d日 %H:%M'))
+            for mid in mids[(page - 1) * 10:page * 10])
+        base = path.split('&page=')[0]
+        pager = '<div class="m-page"><div><span class="list"><ul class="s-scroll">'
+        if pages > 1:
+            pager += ''.join('<li><a href="%s&page=%d">第%d页</a></li>' %
+                             (base, p, p) for p in range(1, pages + 1))
+        pager += '</ul></span>'
+        if page < pages:
+            pager += '<a class="next" href="%s&page=%d">下一页</a>' % (base,
+                                                                     page + 1)
+        pager += '</div></div>'
+        return self.head + cards + pager + self.tail
+
+    def show(self, bid):
+        """详情接口的返回"""
+        mid = bid[1:]
+        status = dict(self.status,
+                      id=int(mid),
+                      idstr=mid,
+                      mid=mid,
+                      mblogid=bid,
+                      created_at=get_created_at(mid).strftime(
+                          '%a %b %d %H:%M:%S +0800 %Y'))
+        return json.dumps(status, ensure_ascii=False)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """按路径和cookie返回搜索结果页、接口返回或异常页面"""
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        stub = self.server.stub
+        cookie = self.headers.get('Cookie', '')
+        stub.enter(cookie)
+        try:
+            if stub.delay:
+                time.sleep(stub.delay)
+            response = self.respond(stub, cookie)
+        finally:
+            # 发出响应前结束计数，爬虫收到响应后立即发出的下一个请求不会被算作同时进行
+            stub.leave(cookie)
+        self.send(*response)
+
+    def respond(self, stub, cookie):
+        """返回(正文, Content-Type, 状态码, 重定向地址)"""
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        if url.path == '/stats':
+            with stub.lock:
+                body = json.dumps(stub.stats)
+            return self.response(body, 'application/json')
+        if url.path.startswith('/visitor'):
+            return self.response(LOGIN_PAGE)
+        if cookie in stub.captcha_cookies:
+            return self.response('', status=418)
+        if cookie in stub.bad_cookies:
+            return self.response('', status=302, location=LOGIN_URL)
+        if url.path.startswith('/ajax/statuses/show'):
+            stub.count('show')
+            return self.response(stub.show(query['id'][0]), 'application/json')
+        if url.path.startswith('/ajax/statuses/longtext'):
+            stub.count('longtext')
+            return self.response(
+                json.dumps({
+                    'ok': 1,
+                    'data': {
+                        'longTextContent': '长微博全文 #东方精工# @投资者小王 ' * 5
+                    }
+                }), 'application/json')
+        stub.count('search')
+        return self.response(stub.search_page(query, self.path))
+
+    def response(self,
+                 body,
+                 content_type='text/html; charset=utf-8',
+                 status=200,
+                 location=None):
+        return body, content_type, status, location
+
+    def send(self,
+             body,
+             content_type='text/html; charset=utf-8',
+             status=200,
+             location=None):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if location:
+            self.send_header('Location', location)
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class StubDownloadHandler(HTTP11DownloadHandler):
+    """把weibo.com的请求改发到STUB_SERVER_URL的下载处理器，返回的响应仍是原请求的url
+
+    在DOWNLOAD_HANDLERS中配置给http和https，请求对象不变，各中间件看到的与请求微博相同；
+    登录页的重定向也指向weibo.com，同样被改发到本地服务。
+    """
+
+    def __init__(self, settings, crawler):
+        super().__init__(settings, crawler)
+        self.url = settings.get('STUB_SERVER_URL').rstrip('/')
+
+    def download_request(self, request, spider):
+        url = urlparse(request.url)
+        if not url.netloc.endswith('weibo.com'):
+            return super().download_request(request, spider)
+        path = url.path + ('?' + url.query if url.query else '')
+        d = super().download_request(request.replace(url=self.url + path),
+                                     spider)
+        d.addCallback(lambda response: response.replace(url=request.url,
+                                                        request=request))
+        return d
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='代替微博的本地HTTP服务')
+    arg_parser.add_argument('--port', type=int, default=8765)
+    arg_parser.add_argument('--rate', type=int, default=5, help='每小时的微博数')
+    arg_parser.add_argument('--delay', type=float, default=0, help='每个请求的延迟秒数')
+    arg_parser.add_argument('--bad-cookies', default='', help='以逗号分隔')
+    arg_parser.add_argument('--captcha-cookies', default='', help='以逗号分隔')
+    args = arg_parser.parse_args()
+    server = StubServer(args.port, args.rate, args.delay,
+                        filter(None, args.bad_cookies.split(',')),
+                        filter(None, args.captcha_cookies.split(',')))
+    print('serving on %s' % server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""以stub_server代替微博爬取时的Scrapy设置，不读取weibo/settings.py
+
+smoke_crawl.py在本进程中使用，smoke_backfill.py启动的scrapy进程以环境变量
+SCRAPY_SETTINGS_MODULE=stub_settings使用。本地服务的地址和缓存目录所在的目录从环境变量
+STUB_SERVER_URL、STUB_WORK_DIR读取。在weibo-search目录下运行：
+
+    STUB_SERVER_URL=http://127.0.0.1:8765 SCRAPY_SETTINGS_MODULE=stub_settings \\
+        PYTHONPATH=benchmarks scrapy crawl search
+"""
+import os
+
+BOT_NAME = 'weibo'
+SPIDER_MODULES = ['weibo.spiders']
+NEWSPIDER_MODULE = 'weibo.spiders'
+LOG_LEVEL = 'ERROR'
+ROBOTSTXT_OBEY = False
+COOKIES_ENABLED = False
+TELNETCONSOLE_ENABLED = False
+DOWNLOAD_DELAY = 0
+DOWNLOAD_HANDLERS = {
+    'http': 'stub_server.StubDownloadHandler',
+    'https': 'stub_server.StubDownloadHandler',
+}
+STUB_SERVER_URL = os.environ.get('STUB_SERVER_URL', 'http://127.0.0.1:8765')
+ITEM_PIPELINES = {
+    'weibo.pipelines.DuplicatesPipeline': 300,
+    'weibo.pipelines.CsvPipeline': 301,
+}
+KEYWORD_LIST = ['东方精工']
+WEIBO_TYPE = 1
+CONTAIN_TYPE = 0
+REGION = ['全部']
+START_DATE = '2025-10-01'
+END_DATE = '2025-10-01'
+# 最后一个cookie被stub_server重定向到登录页
+GOOD_COOKIES = ['SUB=good1', 'SUB=good2']
+BAD_COOKIE = 'SUB=bad'
+COOKIE_POOL = GOOD_COOKIES + [BAD_COOKIE]
+CACHE_DIR = os.path.join(os.environ.get('STUB_WORK_DIR', '.'), '缓存文件')
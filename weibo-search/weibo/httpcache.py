@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+
+# 搜索结果页的HTTP缓存，HTTPCACHE_ENABLED为True时由搜索爬虫自动使用
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/downloader-middleware.html#httpcache-middleware-settings
+
+import json
+import time
+import zlib
+from datetime import datetime, timedelta
+from urllib.parse import parse_qs, urlparse
+
+from scrapy.http import Headers
+from scrapy.responsetypes import responsetypes
+
+import weibo.utils.anticrawl as anticrawl
+import weibo.utils.util as util
+
+
+def get_timescope_end(url):
+    """返回搜索链接中timescope的结束时间，不是按时间段搜索的链接返回None"""
+    timescope = parse_qs(urlparse(url).query).get('timescope')
+    if not timescope or not timescope[0].startswith('custom:'):
+        return None
+    end = timescope[0].split(':')[-1]
+    try:
+        day, hour = end.rsplit('-', 1)
+        return datetime.strptime(day, '%Y-%m-%d') + timedelta(hours=int(hour))
+    except ValueError:
+        return None
+
+
+def get_ttl(url, past_ttl, recent_ttl):
+    """时间段已结束一小时以上的搜索结果基本不再变化，缓存past_ttl秒，其余缓存recent_ttl秒"""
+    end = get_timescope_end(url)
+    if end is not None and end <= datetime.now() - timedelta(hours=1):
+        return past_ttl
+    return recent_ttl
+
+
+class TimescopePolicy(object):
+    """只缓存按时间段搜索的正常结果页，登录页、验证码等异常页面不缓存
+
+    缓存是否过期由SqliteCacheStorage按timescope判断，取出的缓存都是新鲜的。
+    """
+
+    def __init__(self, settings):
+        pass
+
+    def should_cache_request(self, request):
+        return get_timescope_end(request.url) is not None
+
+    def should_cache_response(self, response, request):
+        return response.status == 200 and anticrawl.classify(
+            request, response, True) is None
+
+    def is_cached_response_fresh(self, cachedresponse, request):
+        return True
+
+    def is_cached_response_valid(self, cachedresponse, response, request):
+        return False
+
+
+class SqliteCacheStorage(object):
+    """压缩后保存在SQLite中的HTTP缓存，总大小超过HTTPCACHE_MAX_BYTES时淘汰最久未使用的页面
+
+    时间段已结束的搜索结果缓存HTTPCACHE_PAST_TTL秒，时间段包含最近一小时的缓存
+    HTTPCACHE_RECENT_TTL秒。缓存命中率和节省的下载字节数记录在爬虫统计信息中。
+    """
+
+    def __init__(self, settings, commit_interval=100):
+        self.path = util.get_cache_path(settings, 'http_cache.db')
+        self.past_ttl = settings.getfloat('HTTPCACHE_PAST_TTL', 2592000)
+        self.recent_ttl = settings.getfloat('HTTPCACHE_RECENT_TTL', 600)
+        self.max_bytes = settings.getint('HTTPCACHE_MAX_BYTES', 536870912)
+        self.compress_level = settings.getint('HTTPCACHE_COMPRESS_LEVEL', 6)
+        self.autocommit = util.is_cache_shared(settings)
+        self.commit_interval = commit_interval
+        self.pending = 0
+
+    def open_spider(self, spider):
+        self.stats = spider.crawler.stats
+        self.fingerprinter = spider.crawler.request_fingerprinter
+        self.conn = util.connect_sqlite(self.path, self.autocommit)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS page (
+            fingerprint TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            status INTEGER NOT NULL,
+            headers BLOB NOT NULL,
+            body BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            expires_at REAL NOT NULL,
+            accessed_at REAL NOT NULL)""")
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS page_accessed_at ON page (accessed_at)')
+        self.conn.execute('DELETE FROM page WHERE expires_at < ?',
+                          (time.time(), ))
+        self.conn.commit()
+        self.total_bytes = self._total_bytes()
+
+    def close_spider(self, spider):
+        self.conn.commit()
+        self.conn.close()
+        hits = self.stats.get_value('httpcache/hit', 0)
+        lookups = hits + self.stats.get_value('httpcache/miss', 0)
+        if lookups:
+            self.stats.set_value('httpcache/hit_ratio', hits / lookups)
+
+    def _total_bytes(self):
+        return self.conn.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM page').fetchone()[0]
+
+    def retrieve_response(self, spider, request):
+        key = self.fingerprinter.fingerprint(request).hex()
+        row = self.conn.execute(
+            """SELECT url, status, headers, body, expires_at FROM page
+            WHERE fingerprint = ?""", (key, )).fetchone()
+        if row is None:
+            return None
+        url, status, headers, body, expires_at = row
+        if expires_at < time.time():
+            return None
+        self.conn.execute(
+            'UPDATE page SET accessed_at = ? WHERE fingerprint = ?',
+            (time.time(), key))
+        self._written()
+        headers = Headers(json.loads(zlib.decompress(headers)))
+        body = zlib.decompress(body)
+        self.stats.inc_value('httpcache/bytes_saved', len(body))
+        respcls = responsetypes.from_args(headers=headers, url=url, body=body)
+        return respcls(url=url, headers=headers, status=status, body=body)
+
+    def store_response(self, spider, request, response):
+        key = self.fingerprinter.fingerprint(request).hex()
+        headers = {
+            name.decode('latin-1'):
+            [value.decode('latin-1') for value in values]
+            for name, values in response.headers.items()
+        }
+        headers = zlib.compress(json.dumps(headers).encode(),
+                                self.compress_level)
+        body = zlib.compress(response.body, self.compress_level)
+        size = len(headers) + len(body)
+        now = time.time()
+        self.conn.execute(
+            """INSERT OR REPLACE INTO page (fingerprint, url, status, headers,
+            body, size, expires_at, accessed_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (key, response.url, response.status, headers, body, size,
+             now + get_ttl(request.url, self.past_ttl, self.recent_ttl), now))
+        self.stats.inc_value('httpcache/stored_bytes', size)
+        self.total_bytes += size
+        if self.total_bytes > self.max_bytes:
+            self._evict()
+        self._written()
+
+    def _evict(self):
+        """淘汰过期和最久未使用的页面，直到总大小不超过上限的九成"""
+        self.conn.execute('DELETE FROM page WHERE expires_at < ?',
+                          (time.time(), ))
+        # 多个爬虫进程共用缓存时，以数据库中的实际大小为准
+        self.total_bytes = self._total_bytes()
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, size in self.conn.execute(
+                'SELECT fingerprint, size FROM page ORDER BY accessed_at'):
+            if self.total_bytes <= target:
+                break
+            evicted.append((key, ))
+            self.total_bytes -= size
+        self.conn.executemany('DELETE FROM page WHERE fingerprint = ?',
+                              evicted)
+        self.stats.inc_value('httpcache/evicted', len(evicted))
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.conn.commit()
+            self.pending = 0
@@ -0,0 +1,381 @@
+# -*- coding: utf-8 -*-
+
+# 爬取过程的性能指标，METRICS_ENABLED为True时由搜索爬虫自动启用
+#
+# 各回调的耗时、下载耗时、每页微博数、空页面比例和每条微博在管道中的耗时，
+# 爬取结束时写入METRICS_FILE（JSON）和同名的.prom文件（Prometheus文本格式）。
+
+import json
+import math
+import os
+import time
+
+from scrapy import signals
+from scrapy.exceptions import NotConfigured
+from scrapy.http import Request
+from scrapy.pipelines import ItemPipelineManager
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1,
+                   2.5, 5, 10, 30)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 15, 20, 30, 50)
+PREFIX = 'weibo_'
+
+
+class Histogram(object):
+    """Prometheus式的直方图，buckets为各桶的上界，最后还有一个+Inf桶"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """按桶内均匀分布估计分位数，落在+Inf桶时返回最大的上界"""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        lower = 0
+        for bound, count in zip(self.buckets, self.counts):
+            if count and seen + count >= rank:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.buckets[-1]
+
+    def cumulative(self):
+        """各桶的累计数，键为上界"""
+        total = 0
+        result = []
+        for bound, count in zip(list(self.buckets) + [math.inf], self.counts):
+            total += count
+            result.append(('+Inf' if bound == math.inf else repr(bound), total))
+        return result
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'mean': round(self.sum / self.count, 6) if self.count else 0,
+            'p50': round(self.quantile(0.5), 6),
+            'p95': round(self.quantile(0.95), 6),
+            'p99': round(self.quantile(0.99), 6),
+            'buckets': dict(self.cumulative())
+        }
+
+
+class CrawlMetrics(object):
+    """一次爬取的所有直方图和计数器，按指标名和标签区分"""
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, value, buckets=SECONDS_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def inc(self, name, count=1):
+        self.counters[name] = self.counters.get(name, 0) + count
+
+    def merged(self, name):
+        """合并名为name的所有直方图，用于计算总体的平均值"""
+        count = total = 0
+        for (key, _), histogram in self.histograms.items():
+            if key == name:
+                count += histogram.count
+                total += histogram.sum
+        return count, total
+
+    def summary(self):
+        pages = self.counters.get('pages', 0)
+        page_count, page_items = self.merged('page_items')
+        items, pipeline_seconds = self.merged('pipeline_item_seconds')
+        return {
+            'pages':
+            pages,
+            'empty_pages':
+            self.counters.get('empty_pages', 0),
+            'empty_page_ratio':
+            round(self.counters.get('empty_pages', 0) /
+                  pages, 4) if pages else 0,
+            'items_per_page':
+            round(page_items / page_count, 2) if page_count else 0,
+            'pipeline_seconds_per_item':
+            round(pipeline_seconds / items, 6) if items else 0
+        }
+
+    def to_dict(self, stats, finish_reason=None):
+        """finish_reason不是数值，单独导出，爬虫是否正常结束以它为准"""
+        histograms = {}
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            entry = dict(labels)
+            entry.update(histogram.to_dict())
+            histograms.setdefault(name, []).append(entry)
+        return {
+            'finish_reason': finish_reason or stats.get('finish_reason'),
+            'summary': self.summary(),
+            'histograms': histograms,
+            'counters': dict(self.counters),
+            'stats': numeric_stats(stats)
+        }
+
+    def to_prometheus(self, stats):
+        lines = []
+        typed = set()
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            metric = PREFIX + name
+            if metric not in typed:
+                typed.add(metric)
+                lines.append('# TYPE %s histogram' % metric)
+            for bound, total in histogram.cumulative():
+                lines.append('%s_bucket%s %d' %
+                             (metric, format_labels(labels + (
+                                 ('le', bound), )), total))
+            lines.append('%s_sum%s %r' %
+                         (metric, format_labels(labels), histogram.sum))
+            lines.append('%s_count%s %d' %
+                         (metric, format_labels(labels), histogram.count))
+        for name, count in sorted(self.counters.items()):
+            lines.append('# TYPE %s%s_total counter' % (PREFIX, name))
+            lines.append('%s%s_total %d' % (PREFIX, name, count))
+        for name, value in sorted(self.summary().items()):
+            lines.append('# TYPE %s%s gauge' % (PREFIX, name))
+            lines.append('%s%s %r' % (PREFIX, name, value))
+        lines.append('# TYPE %sstat gauge' % PREFIX)
+        for name, value in sorted(numeric_stats(stats).items()):
+            lines.append('%sstat%s %r' %
+                         (PREFIX, format_labels((('name', name), )), value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace(
+        '\\', '\\\\').replace('"', '\\"')) for key, value in labels)
+
+
+def numeric_stats(stats):
+    """爬虫统计信息中的数值项，时间等其它类型不导出"""
+    return {
+        key: value
+        for key, value in stats.items()
+        if isinstance(value, (int, float)) and not isinstance(value, bool)
+    }
+
+
+def get_metrics(crawler):
+    """同一次爬取的各组件共用一个CrawlMetrics"""
+    metrics = getattr(crawler, 'weibo_metrics', None)
+    if metrics is None:
+        metrics = crawler.weibo_metrics = CrawlMetrics()
+    return metrics
+
+
+def get_callback_name(request):
+    return getattr(request.callback, '__name__', 'parse')
+
+
+def is_weibo_output(output):
+    """回调的输出是否为一条微博，或之后会输出一条微博的请求"""
+    return not isinstance(output, Request) or 'item' in output.meta
+
+
+class MetricsSpiderMiddleware(object):
+    """记录每个回调的耗时，以及每个搜索结果页输出的微博数
+
+    只累计回调本身产生输出的时间，不包括输出交给后面的中间件和管道处理的时间。
+    由查询IP属地或获取详情的请求输出的微博也算作该页的微博。
+    """
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('METRICS_ENABLED', True):
+            raise NotConfigured
+        return cls(get_metrics(crawler))
+
+    def process_spider_output(self, response, result, spider):
+        elapsed = 0
+        weibos = 0
+        iterator = iter(result)
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    output = next(iterator)
+                except StopIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                if is_weibo_output(output):
+                    weibos += 1
+                yield output
+        finally:
+            self.record_callback(response, elapsed, weibos)
+
+    async def process_spider_output_async(self, response, result, spider):
+        elapsed = 0
+        weibos = 0
+        iterator = result.__aiter__()
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    output = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+                finally:
+                    elapsed += time.perf_counter() - start
+                if is_weibo_output(output):
+                    weibos += 1
+                yield output
+        finally:
+            self.record_callback(response, elapsed, weibos)
+
+    def record_callback(self, response, elapsed, weibos):
+        cell = response.meta.get('cell')
+        callback = get_callback_name(response.request)
+        self.metrics.observe('callback_seconds',
+                             elapsed,
+                             callback=callback,
+                             cell=cell.level if cell else '')
+        if cell is not None and not response.meta.get('cell_split'):
+            self.record_page(callback, weibos)
+
+    def record_page(self, callback, weibos):
+        """记录一个搜索结果页，拆分为更小单元的页面不算在内"""
+        self.metrics.inc('pages')
+        if not weibos:
+            self.metrics.inc('empty_pages')
+        self.metrics.observe('page_items',
+                             weibos,
+                             COUNT_BUCKETS,
+                             callback=callback)
+
+
+class TimedPipeline(object):
+    """包装一个管道，记录其process_item本身的耗时，其它属性直接取自被包装的管道"""
+
+    def __init__(self, pipe, manager):
+        self.pipe = pipe
+        self.manager = manager
+        self.name = type(pipe).__name__
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def process_item(self, item, spider):
+        start = time.perf_counter()
+        try:
+            return self.pipe.process_item(item, spider)
+        finally:
+            if self.manager.metrics is not None:
+                self.manager.metrics.observe('pipeline_seconds',
+                                             time.perf_counter() - start,
+                                             pipeline=self.name)
+
+
+class TimedItemPipelineManager(ItemPipelineManager):
+    """记录每条微博经过所有管道的总耗时，和每个管道process_item本身的耗时
+
+    总耗时包括图片、视频下载等异步处理的等待时间。每个管道由TimedPipeline包装后
+    再交给Scrapy的管道管理器。
+    """
+
+    def __init__(self, *middlewares):
+        self.metrics = None
+        super().__init__(*[
+            TimedPipeline(pipe, self) if hasattr(pipe, 'process_item') else
+            pipe for pipe in middlewares
+        ])
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        manager = super().from_crawler(crawler)
+        if crawler.settings.getbool('METRICS_ENABLED', True):
+            manager.metrics = get_metrics(crawler)
+        return manager
+
+    def process_item(self, item, spider):
+        start = time.perf_counter()
+        d = super().process_item(item, spider)
+        if self.metrics is not None:
+            d.addBoth(self.item_done, start)
+        return d
+
+    def item_done(self, result, start):
+        self.metrics.observe('pipeline_item_seconds',
+                             time.perf_counter() - start)
+        return result
+
+
+class MetricsExtension(object):
+    """记录下载耗时，爬取结束时将所有指标写入文件，路径记录在metrics/file中"""
+
+    def __init__(self, crawler, path):
+        self.crawler = crawler
+        self.path = path
+        self.metrics = get_metrics(crawler)
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        if not settings.getbool('METRICS_ENABLED', True):
+            raise NotConfigured
+        ext = cls(
+            crawler,
+            settings.get(
+                'METRICS_FILE',
+                os.path.join(settings.get('RESULT_DIR', '结果文件'),
+                             'metrics.json')))
+        crawler.signals.connect(ext.response_received,
+                                signal=signals.response_received)
+        crawler.signals.connect(ext.spider_closed,
+                                signal=signals.spider_closed)
+        return ext
+
+    def response_received(self, response, request, spider):
+        # 从HTTP缓存取出的页面没有下载耗时
+        latency = request.meta.get('download_latency')
+        if latency is not None and 'cached' not in response.flags:
+            self.metrics.observe('download_seconds',
+                                 latency,
+                                 callback=get_callback_name(request))
+
+    def spider_closed(self, spider, reason):
+        stats = self.crawler.stats
+        summary = self.metrics.summary()
+        stats.set_value('metrics/empty_page_ratio',
+                        summary['empty_page_ratio'])
+        stats.set_value('metrics/file', self.path)
+        stats_dict = stats.get_stats()
+        metrics_dir = os.path.dirname(self.path)
+        if metrics_dir and not os.path.isdir(metrics_dir):
+            os.makedirs(metrics_dir)
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(self.metrics.to_dict(stats_dict, reason),
+                      f,
+                      ensure_ascii=False,
+                      indent=4)
+        with open(os.path.splitext(self.path)[0] + '.prom',
+                  'w',
+                  encoding='utf-8') as f:
+            f.write(self.metrics.to_prometheus(stats_dict))
@@ -5,7 +5,15 @@
 # See documentation in:
 # https://docs.scrapy.org/en/latest/topics/spider-middleware.html
 
+import time
+
 from scrapy import signals
+from scrapy.exceptions import IgnoreRequest, NotConfigured
+from scrapy.utils.httpobj import urlparse_cached
+
+import weibo.utils.anticrawl as anticrawl
+import weibo.utils.util as util
+from weibo.utils.session_pool import ERROR, OK, REDIRECT, SessionPool
 
 
 class WeiboSpiderMiddleware(object):
@@ -101,3 +109,166 @@ class WeiboDownloaderMiddleware(object):
 
     def spider_opened(self, spider):
         spider.logger.info('Spider opened: %s' % spider.name)
+
+
+class SessionPoolMiddleware(object):
+    """cookie池下载中间件，配置了COOKIE_POOL时由搜索爬虫自动启用
+
+    weibo.com的每个请求轮换使用池中的cookie，替换DEFAULT_REQUEST_HEADERS中的cookie。每个
+    cookie使用独立的下载槽，包括IP属地和详情请求在内的并发数不超过SESSION_CONCURRENT_REQUESTS，
+    DOWNLOAD_DELAY也按cookie分别计算。重定向和登录页算作重定向，状态码为4xx、5xx、下载出错和其它异常页面算作出错，
+    比例过高的cookie被隔离。得到异常页面的请求换用其它cookie重新请求，所有cookie都试过后
+    才交给AntiCrawlMiddleware。
+    """
+
+    def __init__(self, crawler, pool):
+        self.crawler = crawler
+        self.pool = pool
+        self.assigned = {}
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        cookies = util.get_cookie_pool(settings)
+        if not cookies:
+            raise NotConfigured
+        pool = SessionPool(
+            cookies, settings.getint('SESSION_WINDOW', 20),
+            settings.getfloat('SESSION_MAX_ERROR_RATE', 0.3),
+            settings.getfloat('SESSION_MAX_REDIRECT_RATE', 0.2),
+            settings.getfloat('SESSION_QUARANTINE_SECS', 600))
+        s = cls(crawler, pool)
+        crawler.signals.connect(s.spider_closed, signal=signals.spider_closed)
+        return s
+
+    def process_request(self, request, spider):
+        # 图片、视频等其它网站的请求不需要cookie
+        if not (urlparse_cached(request).hostname or '').endswith('weibo.com'):
+            return None
+        session, exhausted = self.pool.acquire(
+            request.meta.get('sessions_tried', ()))
+        if exhausted:
+            self.crawler.stats.inc_value('session/exhausted')
+        self.assigned[request] = session
+        request.headers['Cookie'] = session.cookie
+        request.meta['session'] = session.index
+        request.meta['cookiejar'] = session.index
+        # 带cookie的请求都使用该cookie的下载槽，IP属地和详情请求也计入cookie的并发
+        request.meta['download_slot'] = session.slot
+        return None
+
+    def process_response(self, request, response, spider):
+        kind = anticrawl.classify(request, response, 'cell' in request.meta)
+        if kind in (anticrawl.LOGIN, anticrawl.REDIRECT):
+            outcome = REDIRECT
+        elif kind or response.status >= 400:
+            outcome = ERROR
+        else:
+            outcome = OK
+        session = self.record(request, outcome, spider)
+        if kind and session is not None:
+            tried = request.meta.get('sessions_tried', []) + [session.index]
+            if len(tried) < len(self.pool.sessions):
+                self.crawler.stats.inc_value('session/reissued')
+                request = request.replace(dont_filter=True)
+                request.meta['sessions_tried'] = tried
+                return request
+        return response
+
+    def process_exception(self, request, exception, spider):
+        self.record(request, ERROR, spider)
+
+    def record(self, request, outcome, spider):
+        session = self.assigned.pop(request, None)
+        if session is None:
+            return None
+        stats = self.crawler.stats
+        if outcome == ERROR:
+            stats.inc_value('session/errors')
+        elif outcome == REDIRECT:
+            stats.inc_value('session/redirects')
+        if self.pool.record(session, outcome):
+            stats.inc_value('session/quarantined')
+            spider.logger.warning(
+                '第%d个cookie最近%d个请求中出错%.0f%%、重定向%.0f%%，隔离至%s',
+                session.index, len(session.outcomes),
+                session.rate(ERROR) * 100,
+                session.rate(REDIRECT) * 100,
+                time.strftime('%H:%M:%S',
+                              time.localtime(session.quarantined_until)))
+        return session
+
+    def spider_closed(self, spider):
+        self.crawler.stats.set_value('session/health', self.pool.health())
+
+
+class AntiCrawlMiddleware(object):
+    """识别登录页、重定向、验证码和空壳页面，连续出现时暂停或停止爬取，由搜索爬虫自动启用
+
+    异常的搜索结果页不交给爬虫解析，请求失败的搜索单元下次运行时重新爬取；其它请求的
+    异常页面照常交给爬虫，如IP属地置空。只有搜索结果页计入连续异常的次数，连续出现
+    ANTICRAWL_THRESHOLD个异常页面时，ANTICRAWL_ACTION为'close'则立即停止爬取，
+    为'pause'则暂停ANTICRAWL_PAUSE_SECS秒，期间的异常页面在恢复后重新请求，同一页面
+    最多重新请求ANTICRAWL_MAX_RETRIES次；暂停超过ANTICRAWL_MAX_PAUSES次后停止爬取。
+    原因记录在anticrawl/reason中。
+    """
+
+    def __init__(self, crawler):
+        settings = crawler.settings
+        self.crawler = crawler
+        self.action = settings.get('ANTICRAWL_ACTION', 'close')
+        self.pause_secs = settings.getfloat('ANTICRAWL_PAUSE_SECS', 300)
+        self.max_pauses = settings.getint('ANTICRAWL_MAX_PAUSES', 3)
+        self.max_retries = settings.getint('ANTICRAWL_MAX_RETRIES', 3)
+        self.breaker = anticrawl.CircuitBreaker(
+            settings.getint('ANTICRAWL_THRESHOLD', 3))
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        if not crawler.settings.getbool('ANTICRAWL_ENABLED', True):
+            raise NotConfigured
+        return cls(crawler)
+
+    def can_pause(self):
+        return self.action == 'pause' and self.breaker.trips <= self.max_pauses
+
+    def process_response(self, request, response, spider):
+        is_search = 'cell' in request.meta
+        kind = anticrawl.classify(request, response, is_search)
+        # IP属地、详情和图片等请求正常不代表搜索没有被拦截，不计入连续异常的次数
+        if is_search and self.breaker.record(kind):
+            self.trip(kind, response, spider)
+        if kind is None:
+            return response
+        self.crawler.stats.inc_value('anticrawl/%s' % kind)
+        if not is_search:
+            return response
+        retries = request.meta.get('anticrawl_retries', 0)
+        if self.can_pause():
+            if retries < self.max_retries:
+                retry = request.replace(dont_filter=True)
+                retry.meta['anticrawl_retries'] = retries + 1
+                return retry
+            self.crawler.stats.inc_value('anticrawl/retries_exhausted')
+        raise IgnoreRequest('%s页面: %s' % (kind, response.url))
+
+    def trip(self, kind, response, spider):
+        stats = self.crawler.stats
+        stats.inc_value('anticrawl/trips')
+        stats.set_value('anticrawl/reason', kind)
+        stats.set_value('anticrawl/url', response.url)
+        if self.can_pause():
+            spider.logger.warning('连续%d个%s页面，暂停爬取%d秒，可能是cookie无效或已过期',
+                                  self.breaker.threshold, kind,
+                                  self.pause_secs)
+            from twisted.internet import reactor
+            self.crawler.engine.pause()
+            reactor.callLater(self.pause_secs, self.resume)
+        else:
+            spider.logger.error('连续%d个%s页面，停止爬取，可能是cookie无效或已过期',
+                                self.breaker.threshold, kind)
+            self.crawler.engine.close_spider(spider, 'anticrawl_%s' % kind)
+
+    def resume(self):
+        self.breaker.half_open()
+        self.crawler.engine.unpause()
@@ -5,142 +5,485 @@
 # Don't forget to add your pipeline to the ITEM_PIPELINES setting
 # See: https://docs.scrapy.org/en/latest/topics/item-pipeline.html
 
-import copy
 import csv
+import hashlib
 import os
+import shutil
+import time
+from datetime import datetime
+from io import BytesIO
 
 import scrapy
 from scrapy.exceptions import DropItem
-from scrapy.pipelines.files import FilesPipeline
-from scrapy.pipelines.images import ImagesPipeline
-from scrapy.utils.project import get_project_settings
+from scrapy.pipelines.files import FileException, FilesPipeline
+from scrapy.utils.misc import load_object
+from twisted.internet import defer, task
 
-settings = get_project_settings()
+import weibo.utils.util as util
+from weibo.utils.dedup import DedupStore
+from weibo.utils.media_index import MediaIndex
+from weibo.utils.weibo_store import WeiboStore
+
+CSV_HEADER = [
+    'id', 'bid', 'user_id', '用户昵称', '微博正文', '头条文章url', '发布位置', '艾特用户', '话题',
+    '转发数', '评论数', '点赞数', '发布时间', '发布工具', '微博图片url', '微博视频url',
+    'retweet_id', 'ip', 'user_authentication'
+]
+
+
+def get_csv_row(weibo):
+    return [
+        weibo.get('id', ''),
+        weibo.get('bid', ''),
+        weibo.get('user_id', ''),
+        weibo.get('screen_name', ''),
+        weibo.get('text', ''),
+        weibo.get('article_url', ''),
+        weibo.get('location', ''),
+        weibo.get('at_users', ''),
+        weibo.get('topics', ''),
+        weibo.get('reposts_count', ''),
+        weibo.get('comments_count', ''),
+        weibo.get('attitudes_count', ''),
+        weibo.get('created_at', ''),
+        weibo.get('source', ''),
+        ','.join(weibo.get('pics', [])),
+        weibo.get('video_url', ''),
+        weibo.get('retweet_id', ''),
+        weibo.get('ip', ''),
+        weibo.get('user_authentication', '')
+    ]
 
 
 class CsvPipeline(object):
-    def process_item(self, item, spider):
-        base_dir = '结果文件' + os.sep + item['keyword']
+    """每个关键词的csv文件在整个爬取过程中只打开一次，缓冲写入
+
+    写入CSV_FLUSH_ROWS行或距上次写入磁盘超过CSV_FLUSH_SECS秒时写入磁盘，爬取结束时
+    关闭所有文件。多个爬虫进程共用待爬队列时，每个进程先写入各自的文件，结束时合并。
+    """
+
+    def open_spider(self, spider):
+        settings = spider.settings
+        self.worker = settings.get('FRONTIER_WORKER')
+        self.result_dir = settings.get('RESULT_DIR', '结果文件')
+        self.flush_rows = settings.getint('CSV_FLUSH_ROWS', 100)
+        self.flush_secs = settings.getfloat('CSV_FLUSH_SECS', 5)
+        self.parts = {}
+        self.files = {}
+        self.pending = 0
+        self.flushed_at = time.time()
+        # 一段时间没有新微博时，已缓冲的行也按时写入磁盘
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(self.flush_secs, now=False)
+
+    def get_writer(self, keyword):
+        """返回关键词的csv写入器，第一次写入时打开文件，新文件先写入表头"""
+        writer = self.files.get(keyword)
+        if writer is not None:
+            return writer[1]
+        base_dir = self.result_dir + os.sep + keyword
         if not os.path.isdir(base_dir):
             os.makedirs(base_dir)
-        file_path = base_dir + os.sep + item['keyword'] + '.csv'
-        if not os.path.isfile(file_path):
-            is_first_write = 1
-        else:
-            is_first_write = 0
+        file_path = base_dir + os.sep + keyword + '.csv'
+        if self.worker:
+            part_path = '%s.%s.part' % (file_path, self.worker)
+            self.parts[part_path] = file_path
+            file_path = part_path
+        is_first_write = not os.path.isfile(file_path)
+        f = open(file_path, 'a', encoding='utf-8-sig', newline='')
+        writer = csv.writer(f)
+        if is_first_write:
+            writer.writerow(CSV_HEADER)
+        self.files[keyword] = (f, writer)
+        return writer
 
+    def process_item(self, item, spider):
         if item:
-            with open(file_path, 'a', encoding='utf-8-sig', newline='') as f:
-                writer = csv.writer(f)
-                if is_first_write:
-                    header = [
-                        'id', 'bid', 'user_id', '用户昵称', '微博正文', '头条文章url',
-                        '发布位置', '艾特用户', '话题', '转发数', '评论数', '点赞数', '发布时间',
-                        '发布工具', '微博图片url', '微博视频url', 'retweet_id', 'ip', 'user_authentication'
-                    ]
-                    writer.writerow(header)
-
-                writer.writerow([
-                    item['weibo'].get('id', ''),
-                    item['weibo'].get('bid', ''),
-                    item['weibo'].get('user_id', ''),
-                    item['weibo'].get('screen_name', ''),
-                    item['weibo'].get('text', ''),
-                    item['weibo'].get('article_url', ''),
-                    item['weibo'].get('location', ''),
-                    item['weibo'].get('at_users', ''),
-                    item['weibo'].get('topics', ''),
-                    item['weibo'].get('reposts_count', ''),
-                    item['weibo'].get('comments_count', ''),
-                    item['weibo'].get('attitudes_count', ''),
-                    item['weibo'].get('created_at', ''),
-                    item['weibo'].get('source', ''),
-                    ','.join(item['weibo'].get('pics', [])),
-                    item['weibo'].get('video_url', ''),
-                    item['weibo'].get('retweet_id', ''),
-                    item['weibo'].get('ip', ''),
-                    item['weibo'].get('user_authentication', '')
-                ])
+            self.get_writer(item['keyword']).writerow(
+                get_csv_row(item['weibo']))
+            self.pending += 1
+            if (self.pending >= self.flush_rows
+                    or time.time() - self.flushed_at >= self.flush_secs):
+                self.flush()
         return item
 
-class MyImagesPipeline(ImagesPipeline):
-    def get_media_requests(self, item, info):
-        if len(item['weibo']['pics']) == 1:
-            yield scrapy.Request(item['weibo']['pics'][0],
-                                 meta={
-                                     'item': item,
-                                     'sign': ''
-                                 })
+    def flush(self):
+        if not self.pending:
+            return
+        for f, _ in self.files.values():
+            f.flush()
+        self.pending = 0
+        self.flushed_at = time.time()
+
+    def close_spider(self, spider):
+        if self.flush_task.running:
+            self.flush_task.stop()
+        for f, _ in self.files.values():
+            f.close()
+        self.files = {}
+        for part_path, file_path in self.parts.items():
+            util.merge_csv(part_path, file_path)
+
+
+class HashedFilesPipeline(FilesPipeline):
+    """按内容的sha1命名保存图片和视频，相同内容只保存一份
+
+    文件保存在RESULT_DIR下关键词目录的media_dir中。链接与文件的对应关系保存在CACHE_DIR
+    的media_images.db和media_videos.db中，下载过的链接不再下载，已保存在其它关键词目录的文件建立硬链接。
+    媒体请求不携带微博，使用独立的下载槽，并发数由MEDIA_CONCURRENT_REQUESTS限制。
+    """
+    media_dir = ''
+    suffix = ''
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        settings = spider.settings
+        self.result_dir = settings.get('RESULT_DIR', '结果文件')
+        self.media_slot = spider.media_slot
+        # 图片和视频管道各用一个文件，避免两个连接争用写锁
+        self.index = MediaIndex(
+            util.get_cache_path(settings, 'media_%s.db' % self.media_dir),
+            autocommit=util.is_cache_shared(settings))
+
+    def close_spider(self, spider):
+        self.index.close()
+
+    def media_request(self, url):
+        return scrapy.Request(url, meta={'download_slot': self.media_slot})
+
+    def get_suffix(self, url):
+        return self.suffix
+
+    def get_path(self, item, sha1, url):
+        return os.path.join(self.result_dir, item['keyword'], self.media_dir,
+                            sha1 + self.get_suffix(url))
+
+    def local_path(self, path):
+        return os.path.abspath(os.path.join(self.store.basedir, path))
+
+    def media_to_download(self, request, info, *, item=None):
+        row = self.index.get(request.url)
+        if row is None:
+            return None
+        sha1, indexed_path = row
+        path = self.get_path(item, sha1, request.url)
+        if not self.link_file(indexed_path, path):
+            # 文件已被删除，重新下载
+            return None
+        self.inc_stats(info.spider, 'uptodate')
+        return {
+            'url': request.url,
+            'path': path,
+            'checksum': sha1,
+            'status': 'uptodate'
+        }
+
+    def link_file(self, source_path, path):
+        """path不存在时，为已保存的source_path建立硬链接，返回path是否存在"""
+        local_path = self.local_path(path)
+        if os.path.isfile(local_path):
+            return True
+        if not os.path.isfile(source_path):
+            return False
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        try:
+            os.link(source_path, local_path)
+        except OSError:
+            shutil.copyfile(source_path, local_path)
+        return True
+
+    def item_completed(self, results, item, info):
+        # 本次爬取中已下载过的链接直接返回之前的结果，文件可能在其它关键词目录中
+        for ok, result in results:
+            if ok:
+                self.link_file(
+                    self.local_path(result['path']),
+                    self.get_path(item, result['checksum'], result['url']))
+        return item
+
+    def file_path(self, request, response=None, info=None, *, item=None):
+        if response is None or item is None:
+            return super().file_path(request, response, info, item=item)
+        return self.get_path(item,
+                             hashlib.sha1(response.body).hexdigest(),
+                             request.url)
+
+    def file_downloaded(self, response, request, info, *, item=None):
+        path = self.file_path(request, response=response, info=info, item=item)
+        sha1 = os.path.splitext(os.path.basename(path))[0]
+        local_path = self.local_path(path)
+        if os.path.isfile(local_path):
+            info.spider.crawler.stats.inc_value('media/duplicate_content')
         else:
-            sign = 0
-            for image_url in item['weibo']['pics']:
-                yield scrapy.Request(image_url,
-                                     meta={
-                                         'item': item,
-                                         'sign': '-' + str(sign)
-                                     })
-                sign += 1
-
-    def file_path(self, request, response=None, info=None):
-        image_url = request.url
-        item = request.meta['item']
-        sign = request.meta['sign']
-        base_dir = '结果文件' + os.sep + item['keyword'] + os.sep + 'images'
-        if not os.path.isdir(base_dir):
-            os.makedirs(base_dir)
-        image_suffix = image_url[image_url.rfind('.'):]
-        file_path = base_dir + os.sep + item['weibo'][
-            'id'] + sign + image_suffix
-        return file_path
+            self.store.persist_file(path, BytesIO(response.body), info)
+        self.index.add(request.url, sha1, local_path, len(response.body))
+        return sha1
 
 
-class MyVideoPipeline(FilesPipeline):
+class MyImagesPipeline(HashedFilesPipeline):
+    """原样保存微博图片，不经过Pillow转换
+
+    与原来的ImagesPipeline一样保存在IMAGES_STORE下，未设置时使用FILES_STORE。
+    """
+    media_dir = 'images'
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        settings = crawler.settings
+        cls._update_stores(settings)
+        return cls(settings.get('IMAGES_STORE')
+                   or settings.get('FILES_STORE'),
+                   crawler=crawler)
+
+    def get_media_requests(self, item, info):
+        for image_url in item['weibo']['pics']:
+            yield self.media_request(image_url)
+
+    def get_suffix(self, url):
+        name = url.split('?')[0].rsplit('/', 1)[-1]
+        return name[name.rfind('.'):] if '.' in name else '.jpg'
+
+
+class PartialFile(object):
+    """分段下载中的文件，边写入边计算sha1"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'wb')
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.sha1.update(data)
+        self.size += len(data)
+
+    def discard(self):
+        self.file.close()
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class MyVideoPipeline(HashedFilesPipeline):
+    """用Range请求按MEDIA_CHUNK_BYTES分段下载视频，每段下载后立即写入磁盘
+
+    内存中至多保留一段，不支持Range请求的服务器返回整个视频时按普通文件保存。
+    Content-Range中的总大小未知（为*）时，继续请求下一段，直到返回的一段不足
+    MEDIA_CHUNK_BYTES或返回416。
+    """
+    media_dir = 'videos'
+    suffix = '.mp4'
+
+    def open_spider(self, spider):
+        super().open_spider(spider)
+        self.chunk_bytes = spider.settings.getint('MEDIA_CHUNK_BYTES',
+                                                  4194304)
+
     def get_media_requests(self, item, info):
         if item['weibo']['video_url']:
-            yield scrapy.Request(item['weibo']['video_url'],
-                                 meta={'item': item})
+            yield self.chunk_request(item['weibo']['video_url'], 0)
 
-    def file_path(self, request, response=None, info=None):
-        item = request.meta['item']
-        base_dir = '结果文件' + os.sep + item['keyword'] + os.sep + 'videos'
-        if not os.path.isdir(base_dir):
-            os.makedirs(base_dir)
-        file_path = base_dir + os.sep + item['weibo']['id'] + '.mp4'
-        return file_path
+    def chunk_request(self, url, start):
+        request = self.media_request(url)
+        request.headers['Range'] = 'bytes=%d-%d' % (
+            start, start + self.chunk_bytes - 1)
+        return request
+
+    def media_downloaded(self, response, request, info, *, item=None):
+        if response.status != 206 or not response.body:
+            return super().media_downloaded(response,
+                                            request,
+                                            info,
+                                            item=item)
+        base_dir = self.local_path(
+            os.path.join(self.result_dir, item['keyword'], self.media_dir))
+        os.makedirs(base_dir, exist_ok=True)
+        part = PartialFile(
+            os.path.join(base_dir,
+                         hashlib.sha1(request.url.encode()).hexdigest() +
+                         '.part'))
+        try:
+            return self.save_chunk(response, part, request, info, item)
+        except Exception:
+            part.discard()
+            raise
+
+    def save_chunk(self, response, part, request, info, item):
+        part.write(response.body)
+        total = get_total_size(response)
+        if total is None:
+            has_more = len(response.body) >= self.chunk_bytes
+        else:
+            has_more = part.size < total
+        if has_more:
+            d = self.crawler.engine.download(
+                self.chunk_request(request.url, part.size))
+            d.addCallback(self.chunk_downloaded, part, request, info, item)
+            d.addErrback(self.chunk_failed, part)
+            return d
+        return self.save_file(part, request, info, item)
+
+    def chunk_downloaded(self, response, part, request, info, item):
+        if response.status == 416:
+            # 总大小未知且已下载的大小恰好是MEDIA_CHUNK_BYTES的整数倍
+            return self.save_file(part, request, info, item)
+        if response.status != 206 or not response.body:
+            raise FileException('download-error')
+        return self.save_chunk(response, part, request, info, item)
+
+    def chunk_failed(self, failure, part):
+        part.discard()
+        return failure
+
+    def save_file(self, part, request, info, item):
+        part.file.close()
+        sha1 = part.sha1.hexdigest()
+        path = self.get_path(item, sha1, request.url)
+        local_path = self.local_path(path)
+        if os.path.isfile(local_path):
+            info.spider.crawler.stats.inc_value('media/duplicate_content')
+            os.remove(part.path)
+        else:
+            os.replace(part.path, local_path)
+        self.index.add(request.url, sha1, local_path, part.size)
+        self.inc_stats(info.spider, 'downloaded')
+        return {
+            'url': request.url,
+            'path': path,
+            'checksum': sha1,
+            'status': 'downloaded'
+        }
+
+
+def get_total_size(response):
+    """从Content-Range中获取文件的总大小，如bytes 0-1023/4096为4096"""
+    content_range = response.headers.get('Content-Range', b'').decode()
+    total = content_range.rsplit('/', 1)[-1]
+    return int(total) if total.isdigit() else None
 
 
 class MongoPipeline(object):
+    """批量写入MongoDB，以id为唯一索引upsert微博
+
+    缓冲MONGO_BATCH_SIZE条微博或距上次写入超过MONGO_FLUSH_SECS秒时，以一次无序的
+    bulk_write写入，爬取结束时写入剩余的微博。MONGO_CLIENT为客户端类，
+    测试时可换成mongomock.MongoClient。
+    """
+
     def open_spider(self, spider):
+        settings = spider.settings
+        self.stats = spider.crawler.stats
+        self.batch_size = settings.getint('MONGO_BATCH_SIZE', 500)
+        self.flush_secs = settings.getfloat('MONGO_FLUSH_SECS', 5)
+        self.spider = spider
+        self.collection = None
+        self.buffer = {}
         try:
-            from pymongo import MongoClient
-            self.client = MongoClient(settings.get('MONGO_URI'))
+            import pymongo
+            client_cls = load_object(
+                settings.get('MONGO_CLIENT', 'pymongo.MongoClient'))
+            self.client = client_cls(settings.get('MONGO_URI'))
             self.db = self.client['weibo']
             self.collection = self.db['weibo']
+            self.collection.create_index('id', unique=True)
         except ModuleNotFoundError:
             spider.pymongo_error = True
+            return
+        except pymongo.errors.ServerSelectionTimeoutError:
+            spider.mongo_error = True
+            self.collection = None
+            return
+        except pymongo.errors.OperationFailure as e:
+            # 之前写入的数据中已有重复的id，不影响按id upsert
+            spider.logger.warning('无法在id上建立唯一索引: %s', e)
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(self.flush_secs, now=False)
 
     def process_item(self, item, spider):
-        try:
-            import pymongo
+        if self.collection is not None:
+            # 同一批中的同一微博只保留最新的一条
+            self.buffer[item['weibo']['id']] = dict(item['weibo'])
+            if len(self.buffer) >= self.batch_size:
+                self.flush()
+        return item
 
-            new_item = copy.deepcopy(item)
-            if not self.collection.find_one({'id': new_item['weibo']['id']}):
-                self.collection.insert_one(dict(new_item['weibo']))
-            else:
-                self.collection.update_one({'id': new_item['weibo']['id']},
-                                           {'$set': dict(new_item['weibo'])})
+    def flush(self):
+        if not self.buffer:
+            return
+        import pymongo
+        requests = [
+            pymongo.UpdateOne({'id': weibo_id}, {'$set': weibo}, upsert=True)
+            for weibo_id, weibo in self.buffer.items()
+        ]
+        self.buffer = {}
+        try:
+            result = self.collection.bulk_write(requests, ordered=False)
+            self.stats.inc_value('mongo/upserted', result.upserted_count)
+            self.stats.inc_value('mongo/modified', result.modified_count)
+        except pymongo.errors.BulkWriteError as e:
+            # 无序写入时其余微博照常写入，只记录失败的条数
+            self.stats.inc_value('mongo/write_errors',
+                                 len(e.details.get('writeErrors', [])))
         except pymongo.errors.ServerSelectionTimeoutError:
-            spider.mongo_error = True
+            self.spider.mongo_error = True
+        self.stats.inc_value('mongo/flushes')
 
     def close_spider(self, spider):
-        try:
-            self.client.close()
-        except AttributeError:
-            pass
+        if self.collection is None:
+            return
+        if self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        self.client.close()
+
+
+# MySQL表weibo的列，插入语句按此顺序只生成一次
+MYSQL_COLUMNS = [
+    'id', 'bid', 'user_id', 'screen_name', 'text', 'article_url', 'topics',
+    'at_users', 'pics', 'video_url', 'location', 'created_at', 'source',
+    'attitudes_count', 'comments_count', 'reposts_count', 'retweet_id', 'ip',
+    'user_authentication'
+]
+MYSQL_COUNT_COLUMNS = ('attitudes_count', 'comments_count', 'reposts_count')
+
+
+def get_mysql_sql(table='weibo'):
+    """插入一行微博的语句，已有的微博保持不变
+
+    ON DUPLICATE KEY UPDATE须在同一行，pymysql才会把executemany合并为一条多行INSERT
+    """
+    return """INSERT INTO {table}({keys})
+        VALUES ({values}) ON DUPLICATE KEY UPDATE {update}""".format(
+        table=table,
+        keys=', '.join(MYSQL_COLUMNS),
+        values=', '.join(['%s'] * len(MYSQL_COLUMNS)),
+        update=', '.join('{key} = {key}'.format(key=key)
+                         for key in MYSQL_COLUMNS))
+
+
+def get_mysql_row(weibo):
+    """按MYSQL_COLUMNS的顺序返回一行，转评赞数转为整数"""
+    row = []
+    for key in MYSQL_COLUMNS:
+        value = weibo.get(key)
+        if key == 'pics':
+            value = ','.join(value or [])
+        elif key in MYSQL_COUNT_COLUMNS:
+            value = util.get_count(value or 0)
+        row.append(value)
+    return tuple(row)
 
 
 class MysqlPipeline(object):
-    def create_database(self, mysql_config):
+    """通过连接池在线程中批量写入MySQL
+
+    缓冲MYSQL_BATCH_SIZE条微博或距上次写入超过MYSQL_FLUSH_SECS秒时，在
+    MYSQL_POOL_SIZE个连接的twisted连接池中以一次executemany写入并提交，不阻塞
+    reactor。一批中有微博写入出错时改为逐条写入，只丢弃出错的微博。正在写入的
+    批次达到MYSQL_MAX_PENDING时，process_item等这一批写完再返回，爬虫随之放慢。
+    """
+
+    def create_database(self, mysql_config, settings):
         """创建MySQL数据库"""
         import pymysql
         sql = """CREATE DATABASE IF NOT EXISTS %s DEFAULT
@@ -151,7 +494,7 @@ class MysqlPipeline(object):
         cursor.execute(sql)
         db.close()
 
-    def create_table(self):
+    def create_table(self, cursor):
         """创建MySQL表"""
         sql = """
                 CREATE TABLE IF NOT EXISTS weibo (
@@ -176,60 +519,293 @@ class MysqlPipeline(object):
                 ip varchar(100),
                 user_authentication varchar(100)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4"""
-        self.cursor.execute(sql)
+        cursor.execute(sql)
 
     def open_spider(self, spider):
+        settings = spider.settings
+        self.stats = spider.crawler.stats
+        self.batch_size = settings.getint('MYSQL_BATCH_SIZE', 200)
+        self.flush_secs = settings.getfloat('MYSQL_FLUSH_SECS', 5)
+        self.max_pending = settings.getint('MYSQL_MAX_PENDING', 2)
+        self.spider = spider
+        self.dbpool = None
+        self.buffer = []
+        self.pending = set()
+        self.sql = get_mysql_sql()
         try:
             import pymysql
+            from twisted.enterprise import adbapi
             mysql_config = {
                 'host': settings.get('MYSQL_HOST', 'localhost'),
-                'port': settings.get('MYSQL_PORT', 3306),
+                'port': settings.getint('MYSQL_PORT', 3306),
                 'user': settings.get('MYSQL_USER', 'root'),
                 'password': settings.get('MYSQL_PASSWORD', '123456'),
                 'charset': 'utf8mb4'
             }
-            self.create_database(mysql_config)
+            self.create_database(mysql_config, settings)
             mysql_config['db'] = settings.get('MYSQL_DATABASE', 'weibo')
-            self.db = pymysql.connect(**mysql_config)
-            self.cursor = self.db.cursor()
-            self.create_table()
+            db = pymysql.connect(**mysql_config)
+            self.create_table(db.cursor())
+            db.close()
         except ImportError:
             spider.pymysql_error = True
+            return
         except pymysql.OperationalError:
             spider.mysql_error = True
+            return
+        pool_size = settings.getint('MYSQL_POOL_SIZE', 2)
+        self.dbpool = adbapi.ConnectionPool('pymysql',
+                                            cp_min=1,
+                                            cp_max=pool_size,
+                                            cp_reconnect=True,
+                                            **mysql_config)
+        self.flush_task = task.LoopingCall(self.flush)
+        self.flush_task.start(self.flush_secs, now=False)
 
     def process_item(self, item, spider):
-        data = dict(item['weibo'])
-        data['pics'] = ','.join(data['pics'])
-        keys = ', '.join(data.keys())
-        values = ', '.join(['%s'] * len(data))
-        sql = """INSERT INTO {table}({keys}) VALUES ({values}) ON
-                     DUPLICATE KEY UPDATE""".format(table='weibo',
-                                                    keys=keys,
-                                                    values=values)
-        update = ','.join([" {key} = {key}".format(key=key) for key in data])
-        sql += update
-        try:
-            self.cursor.execute(sql, tuple(data.values()))
-            self.db.commit()
-        except Exception:
-            self.db.rollback()
+        if self.dbpool is None:
+            return item
+        self.buffer.append(get_mysql_row(item['weibo']))
+        if len(self.buffer) >= self.batch_size:
+            d = self.flush()
+            if len(self.pending) >= self.max_pending:
+                # 写入跟不上爬取，等这一批写完再处理后面的微博
+                self.stats.inc_value('mysql/backpressure')
+                return d.addBoth(lambda _: item)
         return item
 
-    def close_spider(self, spider):
+    def insert_rows(self, cursor, rows):
+        """在连接池的线程中执行，runInteraction返回后提交，返回写入出错的[(行, 错误)]
+
+        多行INSERT是一条语句，出错时整条语句回滚，再逐条写入；MySQL中出错的语句
+        不影响同一事务中的其它语句。逐条写入也全部出错时（如连接断开）抛出异常，
+        整批回滚，连接池重新连接。
+        """
+        import pymysql
         try:
-            self.db.close()
-        except Exception:
+            cursor.executemany(self.sql, rows)
+            return []
+        except pymysql.MySQLError:
             pass
+        failed = []
+        for row in rows:
+            try:
+                cursor.execute(self.sql, row)
+            except pymysql.MySQLError as e:
+                if len(failed) == len(rows) - 1:
+                    raise
+                failed.append((row, e))
+        return failed
+
+    def flush(self):
+        """写入缓冲的微博，返回这一批写完时触发的Deferred"""
+        if not self.buffer:
+            return None
+        rows, self.buffer = self.buffer, []
+        d = self.dbpool.runInteraction(self.insert_rows, rows)
+        self.pending.add(d)
+        d.addCallbacks(self.rows_written,
+                       self.rows_failed,
+                       callbackArgs=(rows, ),
+                       errbackArgs=(rows, ))
+        d.addBoth(self.batch_done, d)
+        return d
+
+    def rows_written(self, failed, rows):
+        self.stats.inc_value('mysql/rows', len(rows) - len(failed))
+        self.stats.inc_value('mysql/flushes')
+        if not failed:
+            return
+        self.stats.inc_value('mysql/row_by_row_flushes')
+        self.stats.inc_value('mysql/failed_rows', len(failed))
+        for row, error in failed:
+            self.spider.logger.error('微博%s写入MySQL失败: %s', row[0], error)
+
+    def rows_failed(self, failure, rows):
+        self.stats.inc_value('mysql/failed_rows', len(rows))
+        self.spider.logger.error('%d条微博写入MySQL失败: %s', len(rows),
+                                 failure.getErrorMessage())
+
+    def batch_done(self, _, d):
+        self.pending.discard(d)
+
+    def close_spider(self, spider):
+        if self.dbpool is None:
+            return None
+        if self.flush_task.running:
+            self.flush_task.stop()
+        self.flush()
+        d = defer.DeferredList(list(self.pending))
+        d.addBoth(lambda _: self.dbpool.close())
+        return d
+
+
+# Parquet文件的列和类型，与csv文件的列顺序相同
+PARQUET_FIELDS = [('id', 'string'), ('bid', 'string'), ('user_id', 'string'),
+                  ('screen_name', 'string'), ('text', 'string'),
+                  ('article_url', 'string'), ('location', 'string'),
+                  ('at_users', 'string'), ('topics', 'string'),
+                  ('reposts_count', 'count'), ('comments_count', 'count'),
+                  ('attitudes_count', 'count'), ('created_at', 'time'),
+                  ('source', 'string'), ('pics', 'list'),
+                  ('video_url', 'string'), ('retweet_id', 'string'),
+                  ('ip', 'string'), ('user_authentication', 'string')]
+
+
+class ParquetPipeline(object):
+    """将微博写入按关键词和发布日期分区的Parquet数据集
+
+    数据集位于PARQUET_DIR，分区目录为keyword=关键词/date=发布日期，可用pyarrow.dataset
+    按hive分区只读取需要的列和日期。转评赞数为整数，发布时间为时间类型，图片为列表。
+    每次爬取在每个分区写入一个文件，每PARQUET_BATCH_ROWS行写入一个row group；写入中的
+    文件以_开头，读取数据集时会被忽略，爬取结束时关闭并改为正式的文件名。
+    """
+
+    def open_spider(self, spider):
+        self.schema = None
+        try:
+            import pyarrow as pa
+        except ImportError:
+            spider.pyarrow_error = True
+            return
+        settings = spider.settings
+        types = {
+            'string': pa.string(),
+            'count': pa.int64(),
+            'time': pa.timestamp('s'),
+            'list': pa.list_(pa.string())
+        }
+        self.schema = pa.schema([(field, types[kind])
+                                 for field, kind in PARQUET_FIELDS])
+        self.dataset_dir = settings.get(
+            'PARQUET_DIR',
+            os.path.join(settings.get('RESULT_DIR', '结果文件'), 'parquet'))
+        self.batch_rows = settings.getint('PARQUET_BATCH_ROWS', 10000)
+        self.compression = settings.get('PARQUET_COMPRESSION', 'zstd')
+        # 多次爬取和多个爬虫进程写入同一个分区时，各自写入不同的文件
+        self.file_name = 'part-%s-%s.parquet' % (
+            datetime.now().strftime('%Y%m%d%H%M%S'),
+            settings.get('FRONTIER_WORKER') or os.getpid())
+        self.batches = {}
+        self.writers = {}
+
+    def get_row(self, weibo):
+        row = {}
+        for field, kind in PARQUET_FIELDS:
+            value = weibo.get(field, '')
+            if kind == 'count':
+                value = util.get_count(value)
+            elif kind == 'time':
+                try:
+                    value = datetime.strptime(value, '%Y-%m-%d %H:%M')
+                except ValueError:
+                    value = None
+            elif kind == 'list':
+                value = list(value or [])
+            row[field] = value
+        return row
+
+    def process_item(self, item, spider):
+        if self.schema is None:
+            return item
+        weibo = item['weibo']
+        key = (item['keyword'], weibo.get('created_at', '')[:10])
+        rows = self.batches.setdefault(key, [])
+        rows.append(self.get_row(weibo))
+        if len(rows) >= self.batch_rows:
+            self.write_batch(key)
+        return item
+
+    def write_batch(self, key):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        rows = self.batches.pop(key)
+        if key not in self.writers:
+            keyword, date = key
+            part_dir = os.path.join(self.dataset_dir, 'keyword=' + keyword,
+                                    'date=' + date)
+            if not os.path.isdir(part_dir):
+                os.makedirs(part_dir)
+            self.writers[key] = (pq.ParquetWriter(
+                os.path.join(part_dir, '_' + self.file_name),
+                self.schema,
+                compression=self.compression), part_dir)
+        writer = self.writers[key][0]
+        writer.write_batch(pa.RecordBatch.from_pylist(rows,
+                                                      schema=self.schema))
+
+    def close_spider(self, spider):
+        if self.schema is None:
+            return
+        for key in list(self.batches):
+            self.write_batch(key)
+        for writer, part_dir in self.writers.values():
+            writer.close()
+            os.replace(os.path.join(part_dir, '_' + self.file_name),
+                       os.path.join(part_dir, self.file_name))
+        self.writers = {}
+
+
+class SqlitePipeline(object):
+    """将微博写入SQLite数据库，便于按关键词、时间和正文中的词查询历史微博
+
+    数据库位于SQLITE_PATH，以WAL模式打开，查询方法见WeiboStore.search。缓冲
+    SQLITE_BATCH_SIZE条微博或距上次写入超过SQLITE_FLUSH_SECS秒时在一个事务中写入。
+    """
+
+    def open_spider(self, spider):
+        settings = spider.settings
+        path = settings.get(
+            'SQLITE_PATH',
+            os.path.join(settings.get('RESULT_DIR', '结果文件'), 'weibo.db'))
+        base_dir = os.path.dirname(path)
+        if base_dir and not os.path.isdir(base_dir):
+            os.makedirs(base_dir)
+        self.store = WeiboStore(path, settings.getint('SQLITE_BATCH_SIZE',
+                                                      1000))
+        self.flush_task = task.LoopingCall(self.store.flush)
+        self.flush_task.start(settings.getfloat('SQLITE_FLUSH_SECS', 5),
+                              now=False)
+
+    def process_item(self, item, spider):
+        self.store.add(item['keyword'], item['weibo'])
+        return item
+
+    def close_spider(self, spider):
+        if self.flush_task.running:
+            self.flush_task.stop()
+        self.store.close()
 
 
 class DuplicatesPipeline(object):
-    def __init__(self):
-        self.ids_seen = set()
+    """过滤重复微博，已输出过的微博id保存在去重库中，跨多次爬取共享"""
+
+    def __init__(self, crawler):
+        self.crawler = crawler
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        return cls(crawler)
+
+    def open_spider(self, spider):
+        settings = self.crawler.settings
+        self.ids_seen = DedupStore(
+            util.get_cache_path(settings, 'dedup.db'),
+            settings.getfloat('DEDUP_ERROR_RATE', 0.001),
+            settings.getint('DEDUP_RETENTION_DAYS', 30),
+            autocommit=util.is_cache_shared(settings))
 
     def process_item(self, item, spider):
-        if item['weibo']['id'] in self.ids_seen:
+        # 其它爬虫进程可能已输出同一微博，以add的结果为准
+        if item['weibo']['id'] in self.ids_seen or not self.ids_seen.add(
+                item['weibo']['id']):
             raise DropItem("过滤重复微博: %s" % item)
         else:
-            self.ids_seen.add(item['weibo']['id'])
             return item
+
+    def close_spider(self, spider):
+        stats = self.crawler.stats
+        stats.set_value('dedup/false_positives',
+                        self.ids_seen.false_positives)
+        stats.set_value('dedup/bloom_bytes', self.ids_seen.bloom.size)
+        self.ids_seen.close()
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+# 按请求优先级和爬取时限调度请求，SCHEDULER未另行配置时由搜索爬虫自动使用
+#
+# See documentation in:
+# https://docs.scrapy.org/en/latest/topics/scheduler.html
+
+import time
+
+from scrapy.core.scheduler import Scheduler
+
+from weibo.metrics import get_callback_name
+
+
+def get_kind(request):
+    """请求的类别：搜索单元的粒度加第一页或翻页，其它请求为回调名"""
+    cell = request.meta.get('cell')
+    if cell is None:
+        return get_callback_name(request)
+    page = 'first_page' if request.meta.get('page', 1) == 1 else 'next_page'
+    return '%s/%s' % (cell.level, page)
+
+
+class DeadlineScheduler(Scheduler):
+    """在爬取时限内先爬优先级高的请求，时限将到时不再接受优先级低的请求
+
+    时限为CLOSESPIDER_TIMEOUT，剩余时间不足SCHEDULER_CUTOFF_RATIO时，优先级低于
+    SCHEDULER_CUTOFF_PRIORITY的请求不再调度，所在的搜索单元下次运行时从该页继续。
+    不再调度和爬取结束时还未爬取的请求按类别记录在爬虫统计信息的deadline/dropped
+    和deadline/unfetched中。
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler):
+        scheduler = super().from_crawler(crawler)
+        settings = crawler.settings
+        scheduler.budget = settings.getfloat('CLOSESPIDER_TIMEOUT')
+        scheduler.cutoff_ratio = settings.getfloat('SCHEDULER_CUTOFF_RATIO',
+                                                   0.2)
+        scheduler.cutoff_priority = settings.getint(
+            'SCHEDULER_CUTOFF_PRIORITY', -10)
+        return scheduler
+
+    def open(self, spider):
+        self.started_at = time.monotonic()
+        return super().open(spider)
+
+    def is_cutoff(self):
+        """是否已进入时限前不再调度低优先级请求的阶段"""
+        if not self.budget:
+            return False
+        remaining = self.budget - (time.monotonic() - self.started_at)
+        return remaining < self.budget * self.cutoff_ratio
+
+    def enqueue_request(self, request):
+        if request.priority < self.cutoff_priority and self.is_cutoff():
+            self.record('deadline/dropped', request)
+            return False
+        return super().enqueue_request(request)
+
+    def close(self, reason):
+        # 保存在磁盘队列中的请求下次运行时继续，只统计内存队列
+        while True:
+            request = self.mqs.pop()
+            if request is None:
+                break
+            self.record('deadline/unfetched', request)
+        return super().close(reason)
+
+    def record(self, prefix, request):
+        self.stats.inc_value(prefix)
+        self.stats.inc_value('%s/%s' % (prefix, get_kind(request)))
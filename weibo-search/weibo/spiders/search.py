@@ -1,84 +1,373 @@
 # -*- coding: utf-8 -*-
+import hashlib
+import json
 import os
 import re
 import sys
 from datetime import datetime, timedelta
 from urllib.parse import unquote
 
-import requests
 import scrapy
 
+import weibo.utils.ajax_parser as ajax_parser
+import weibo.utils.lxml_parser as lxml_parser
 import weibo.utils.util as util
-from scrapy.exceptions import CloseSpider
-from scrapy.utils.project import get_project_settings
+from scrapy import signals
+from scrapy.exceptions import CloseSpider, DontCloseSpider
+from scrapy.utils.defer import deferred_from_coro
+from scrapy.utils.misc import load_object
 from weibo.items import WeiboItem
+from weibo.utils.cell import SearchCell
+from weibo.utils.detail_cache import DetailCache
+from weibo.utils.empty_cells import EmptyCellCache
+from weibo.utils.planner import DensityPlanner
+from weibo.utils.priority import (ITEM_PRIORITY, PriorityPolicy,
+                                  get_engagement, get_page)
+from weibo.utils.session_pool import slot_name
+from weibo.utils.watermark import HighWaterMark
 
 
 class SearchSpider(scrapy.Spider):
     name = 'search'
     allowed_domains = ['weibo.com']
-    settings = get_project_settings()
-    keyword_list = settings.get('KEYWORD_LIST')
-    if not isinstance(keyword_list, list):
-        if not os.path.isabs(keyword_list):
-            keyword_list = os.getcwd() + os.sep + keyword_list
-        if not os.path.isfile(keyword_list):
-            sys.exit('不存在%s文件' % keyword_list)
-        keyword_list = util.get_keyword_list(keyword_list)
-
-    for i, keyword in enumerate(keyword_list):
-        if len(keyword) > 2 and keyword[0] == '#' and keyword[-1] == '#':
-            keyword_list[i] = '%23' + keyword[1:-1] + '%23'
-    weibo_type = util.convert_weibo_type(settings.get('WEIBO_TYPE'))
-    contain_type = util.convert_contain_type(settings.get('CONTAIN_TYPE'))
-    regions = util.get_regions(settings.get('REGION'))
     base_url = 'https://s.weibo.com'
-    start_date = settings.get('START_DATE',
-                              datetime.now().strftime('%Y-%m-%d'))
-    end_date = settings.get('END_DATE', datetime.now().strftime('%Y-%m-%d'))
-    if util.str_to_time(start_date) > util.str_to_time(end_date):
-        sys.exit('settings.py配置错误，START_DATE值应早于或等于END_DATE值，请重新配置settings.py')
-    further_threshold = settings.get('FURTHER_THRESHOLD', 46)
     mongo_error = False
     pymongo_error = False
     mysql_error = False
     pymysql_error = False
+    pyarrow_error = False
+    # 查询IP属地的请求使用独立的下载槽，与搜索请求分开限制并发
+    ip_slot = 'weibo_ip'
+    # 图片和视频请求同样使用独立的下载槽，不占用搜索请求的并发
+    media_slot = 'weibo_media'
+
+    @classmethod
+    def update_settings(cls, settings):
+        super().update_settings(settings)
+        download_slots = settings.getdict('DOWNLOAD_SLOTS')
+        download_slots.setdefault(
+            cls.ip_slot, {
+                'concurrency': settings.getint('IP_CONCURRENT_REQUESTS', 8),
+                'delay': settings.getfloat('IP_DOWNLOAD_DELAY', 0)
+            })
+        download_slots.setdefault(
+            cls.media_slot, {
+                'concurrency': settings.getint('MEDIA_CONCURRENT_REQUESTS', 4),
+                'delay': settings.getfloat('MEDIA_DOWNLOAD_DELAY', 0)
+            })
+        # 识别登录页等异常页面的中间件在RedirectMiddleware跟随重定向之前检查响应；
+        # 配置了cookie池时启用cookie池中间件，每个cookie使用独立的下载槽
+        middlewares = settings.getdict('DOWNLOADER_MIDDLEWARES')
+        middlewares.setdefault('weibo.middlewares.AntiCrawlMiddleware', 625)
+        cookies = util.get_cookie_pool(settings)
+        if cookies:
+            middlewares.setdefault('weibo.middlewares.SessionPoolMiddleware',
+                                   650)
+            for i in range(len(cookies)):
+                download_slots.setdefault(
+                    slot_name(i), {
+                        'concurrency':
+                        settings.getint('SESSION_CONCURRENT_REQUESTS', 2)
+                    })
+        settings.set('DOWNLOADER_MIDDLEWARES', middlewares, priority='spider')
+        # 性能指标：回调耗时由最靠近爬虫的中间件记录，管道耗时由管道管理器记录
+        spider_middlewares = settings.getdict('SPIDER_MIDDLEWARES')
+        spider_middlewares.setdefault('weibo.metrics.MetricsSpiderMiddleware',
+                                      950)
+        settings.set('SPIDER_MIDDLEWARES',
+                     spider_middlewares,
+                     priority='spider')
+        extensions = settings.getdict('EXTENSIONS')
+        extensions.setdefault('weibo.metrics.MetricsExtension', 500)
+        settings.set('EXTENSIONS', extensions, priority='spider')
+        if settings.getpriority('ITEM_PROCESSOR') == 0:
+            settings.set('ITEM_PROCESSOR',
+                         'weibo.metrics.TimedItemPipelineManager',
+                         priority='spider')
+        # 启用HTTP缓存且未另行配置时，按timescope缓存搜索结果页
+        if settings.getpriority('HTTPCACHE_POLICY') == 0:
+            settings.set('HTTPCACHE_POLICY',
+                         'weibo.httpcache.TimescopePolicy',
+                         priority='spider')
+        if settings.getpriority('HTTPCACHE_STORAGE') == 0:
+            settings.set('HTTPCACHE_STORAGE',
+                         'weibo.httpcache.SqliteCacheStorage',
+                         priority='spider')
+        # 按优先级调度请求，爬取时限将到时不再调度深层翻页等低优先级请求
+        if settings.getpriority('SCHEDULER') == 0:
+            settings.set('SCHEDULER',
+                         'weibo.scheduler.DeadlineScheduler',
+                         priority='spider')
+        settings.set('DOWNLOAD_SLOTS', download_slots, priority='spider')
+
+    @classmethod
+    def from_crawler(cls, crawler, *args, **kwargs):
+        spider = super().from_crawler(crawler, *args, **kwargs)
+        spider.load_search_settings(crawler.settings)
+        # 多个爬虫共用缓存时，每次写入立即提交
+        shared = util.is_cache_shared(crawler.settings)
+        spider.detail_cache = DetailCache(
+            util.get_cache_path(crawler.settings, 'detail.db'),
+            crawler.settings.getint('DETAIL_CACHE_SIZE', 100000),
+            autocommit=shared)
+        spider.planner = DensityPlanner(
+            util.get_cache_path(crawler.settings, 'density.db'),
+            crawler.settings.getint('PLANNER_HISTORY_DAYS', 14),
+            autocommit=shared)
+        spider.empty_cells = EmptyCellCache(
+            util.get_cache_path(crawler.settings, 'empty_cells.db'),
+            crawler.settings.getint('EMPTY_CELL_RECHECK_SECS', 604800),
+            autocommit=shared)
+        spider.watermark = HighWaterMark(
+            util.get_cache_path(crawler.settings, 'watermark.db'),
+            crawler.settings.getint('INCREMENTAL_OVERLAP_HOURS', 1),
+            autocommit=shared)
+        spider.incremental = crawler.settings.getbool('INCREMENTAL')
+        # 越接近爬取范围末尾的时间段越先爬，END_DATE是今天时以当前时间为准
+        latest = datetime.strptime(spider.end_date,
+                                   '%Y-%m-%d') + timedelta(days=1)
+        spider.priority = PriorityPolicy.from_settings(
+            crawler.settings, min(latest, datetime.now()))
+        spider.search_mode = crawler.settings.get('SEARCH_MODE', 'html')
+        frontier_cls = load_object(
+            crawler.settings.get('FRONTIER_BACKEND',
+                                 'weibo.utils.frontier.SqliteFrontier'))
+        spider.frontier = frontier_cls.from_crawler(crawler,
+                                                    spider.get_crawl_id())
+        spider.frontier_batch = crawler.settings.getint('FRONTIER_BATCH', 16)
+        crawler.signals.connect(spider.spider_idle,
+                                signal=signals.spider_idle)
+        crawler.signals.connect(spider.spider_error,
+                                signal=signals.spider_error)
+        crawler.signals.connect(spider.request_dropped,
+                                signal=signals.request_dropped)
+        return spider
+
+    def load_search_settings(self, settings):
+        """读取搜索条件，同一进程中的多次爬取可使用不同的配置"""
+        keyword_list = settings.get('KEYWORD_LIST')
+        if not isinstance(keyword_list, list):
+            if not os.path.isabs(keyword_list):
+                keyword_list = os.getcwd() + os.sep + keyword_list
+            if not os.path.isfile(keyword_list):
+                sys.exit('不存在%s文件' % keyword_list)
+            keyword_list = util.get_keyword_list(keyword_list)
+        self.keyword_list = [
+            util.escape_keyword(keyword) for keyword in keyword_list
+        ]
+        self.weibo_type = util.convert_weibo_type(settings.get('WEIBO_TYPE'))
+        self.contain_type = util.convert_contain_type(
+            settings.get('CONTAIN_TYPE'))
+        self.regions = util.get_regions(settings.get('REGION'))
+        self.start_date = settings.get('START_DATE',
+                                       datetime.now().strftime('%Y-%m-%d'))
+        self.end_date = settings.get('END_DATE',
+                                     datetime.now().strftime('%Y-%m-%d'))
+        if util.str_to_time(self.start_date) > util.str_to_time(
+                self.end_date):
+            sys.exit(
+                'settings.py配置错误，START_DATE值应早于或等于END_DATE值，请重新配置settings.py')
+        self.further_threshold = settings.getint('FURTHER_THRESHOLD', 46)
+
+    def get_crawl_id(self):
+        """爬取配置的标识，配置相同的爬取共用一个待爬队列，中断后可继续"""
+        config = [
+            self.keyword_list, self.start_date, self.end_date,
+            self.settings.get('REGION'), self.weibo_type, self.contain_type,
+            self.incremental, self.search_mode
+        ]
+        return hashlib.md5(
+            json.dumps(config, ensure_ascii=False).encode()).hexdigest()[:12]
+
+    def closed(self, reason):
+        self.detail_cache.close()
+        self.planner.close()
+        self.empty_cells.close()
+        self.watermark.close(self.frontier.unfinished_since())
+        stats = self.crawler.stats
+        # 爬取时限内没有爬到的单元，下次运行相同配置的爬取时继续
+        stats.set_value('frontier/pending', self.frontier.pending_count())
+        stats.set_value('frontier/finished', self.frontier.close())
+        planned = stats.get_value('planner/hit', 0) + stats.get_value(
+            'planner/miss', 0)
+        if planned:
+            stats.set_value('planner/hit_rate',
+                            stats.get_value('planner/hit', 0) / planned)
 
     def start_requests(self):
+        if not self.frontier.is_empty():
+            # 上次爬取中断，保存的待爬单元和未输出的微博与本次的起始单元一起爬取
+            self.crawler.stats.set_value('frontier/resumed',
+                                         self.frontier.pending_count())
+            adopted = self.frontier.adopt_held_items()
+            if adopted:
+                self.crawler.stats.inc_value('frontier/items_adopted', adopted)
+            dropped = self.frontier.drop_held_items()
+            if dropped:
+                self.crawler.stats.inc_value('frontier/items_dropped', dropped)
+            for item in self.frontier.held_items():
+                self.crawler.stats.inc_value('frontier/items_resumed')
+                if self.search_mode == 'ajax':
+                    yield self.get_detail_request(item)
+                else:
+                    yield self.get_ip_request(item)
+        self.push_root_cells()
+        yield from self.next_requests()
+
+    def push_root_cells(self):
         start_date = datetime.strptime(self.start_date, '%Y-%m-%d')
         end_date = datetime.strptime(self.end_date,
                                      '%Y-%m-%d') + timedelta(days=1)
-        start_str = start_date.strftime('%Y-%m-%d') + '-0'
-        end_str = end_date.strftime('%Y-%m-%d') + '-0'
+        if self.incremental:
+            # 不搜索还没到的时间段
+            now = datetime.now().replace(minute=0, second=0, microsecond=0)
+            end_date = min(end_date, now + timedelta(hours=1))
         for keyword in self.keyword_list:
+            keyword_start = self.get_start_time(keyword, start_date)
+            # 待爬队列中已有的时间段由队列继续爬取，只加入之后的时间段
+            covered = self.frontier.covered_until(keyword)
+            if covered is not None and covered > keyword_start:
+                keyword_start = covered
+                self.crawler.stats.inc_value('frontier/roots_merged')
+            if keyword_start >= end_date:
+                if self.incremental:
+                    self.crawler.stats.inc_value('incremental/up_to_date')
+                continue
             if not self.settings.get('REGION') or '全部' in self.settings.get(
                     'REGION'):
-                base_url = 'https://s.weibo.com/weibo?q=%s' % keyword
-                url = base_url + self.weibo_type
-                url += self.contain_type
-                url += '&timescope=custom:{}:{}'.format(start_str, end_str)
-                yield scrapy.Request(url=url,
-                                     callback=self.parse,
-                                     meta={
-                                         'base_url': base_url,
-                                         'keyword': keyword
-                                     })
+                cell = SearchCell(keyword, keyword_start, end_date, None,
+                                  None)
+                self.plan_cells(cell)
             else:
-                for region in self.regions.values():
-                    base_url = (
-                        'https://s.weibo.com/weibo?q={}&region=custom:{}:1000'
-                    ).format(keyword, region['code'])
-                    url = base_url + self.weibo_type
-                    url += self.contain_type
-                    url += '&timescope=custom:{}:{}'.format(start_str, end_str)
+                for province in self.regions:
                     # 获取一个省的搜索结果
-                    yield scrapy.Request(url=url,
-                                         callback=self.parse,
-                                         meta={
-                                             'base_url': base_url,
-                                             'keyword': keyword,
-                                             'province': region
-                                         })
+                    cell = SearchCell(keyword, keyword_start, end_date,
+                                      province, None)
+                    self.plan_cells(cell)
+
+    def get_start_time(self, keyword, start_date):
+        """增量爬取时从关键词的高水位开始搜索，否则从START_DATE开始"""
+        if not self.incremental:
+            return start_date
+        start = self.watermark.crawl_start(keyword)
+        if start is None or start <= start_date:
+            return start_date
+        self.crawler.stats.inc_value(
+            'incremental/hours_skipped',
+            int((start - start_date).total_seconds() // 3600))
+        return start
+
+    def plan_cells(self, cell):
+        """按历史结果数预测的粒度将单元加入待爬队列，省去逐层试探的请求"""
+        cells = self.planner.plan(cell, self.further_threshold)
+        if len(cells) == 1:
+            if not self.skip_cell(cell):
+                self.frontier.push(cell,
+                                   priority=self.priority.cell_priority(cell))
+            return
+        # 拆分出n个单元，省去了n-1个被拆分单元的请求
+        self.crawler.stats.inc_value('planner/probes_saved', len(cells) - 1)
+        for planned_cell, depth in cells:
+            if not self.skip_cell(planned_cell):
+                self.frontier.push(
+                    planned_cell,
+                    depth,
+                    planned=True,
+                    priority=self.priority.cell_priority(planned_cell))
+
+    def next_requests(self):
+        """从待爬队列中取出单元，使同时在爬的单元数不超过FRONTIER_BATCH"""
+        for cell, depth, planned, page_url in self.frontier.lease(
+                self.frontier_batch - self.frontier.active):
+            yield self.cell_request(cell, depth, planned, page_url)
+
+    def spider_idle(self):
+        """本进程在爬的单元都已结束时，从待爬队列中取出新的单元
+
+        其它进程还在爬取时不关闭，以便接手它们拆分出的单元和租约到期的单元。
+        """
+        requests = list(self.next_requests())
+        for request in requests:
+            self.crawler.engine.crawl(request)
+        if requests or not self.frontier.is_finished():
+            raise DontCloseSpider
+
+    def spider_error(self, failure, response, spider):
+        """解析出错的单元标记为失败，不再占用在爬的名额"""
+        cell = response.meta.get('cell')
+        if cell is not None and self.frontier.fail(cell):
+            self.crawler.stats.inc_value('frontier/failed')
+
+    def request_dropped(self, request, spider):
+        cell = request.meta.get('cell')
+        if cell is not None and self.frontier.fail(cell):
+            self.crawler.stats.inc_value('frontier/failed')
+
+    def skip_cell(self, cell):
+        """判断搜索单元是否为已知的空结果单元，是则跳过"""
+        if self.empty_cells.is_empty(cell):
+            self.crawler.stats.inc_value('empty_cells/skipped')
+            return True
+        return False
+
+    def cell_request(self, cell, depth=0, planned=False, page_url=None):
+        """生成搜索单元第一页的请求，page_url不为空时从中断的那一页继续"""
+        page = get_page(page_url) if page_url else 1
+        meta = {
+            'keyword': cell.keyword,
+            'cell': cell,
+            'cell_depth': depth,
+            'planned': planned,
+            'page': page
+        }
+        priority = self.priority.cell_priority(cell, page)
+        if page_url:
+            self.crawler.stats.inc_value('frontier/pages_resumed')
+            return scrapy.Request(url=page_url,
+                                  callback=self.parse_page,
+                                  errback=self.parse_cell_error,
+                                  priority=priority,
+                                  dont_filter=True,
+                                  meta=meta)
+        self.crawler.stats.inc_value('subdivision/cells')
+        return scrapy.Request(url=cell.url(self.weibo_type,
+                                           self.contain_type),
+                              callback=self.parse,
+                              errback=self.parse_cell_error,
+                              priority=priority,
+                              dont_filter=True,
+                              meta=meta)
+
+    def parse_cell_error(self, failure):
+        """单元的请求失败，留待下次运行时重新爬取"""
+        if self.frontier.fail(failure.request.meta['cell']):
+            self.crawler.stats.inc_value('frontier/failed')
+        self.crawl_output(self.next_requests())
+
+    def crawl_output(self, output):
+        """Scrapy 2.13.0会忽略errback的输出，直接调度其中的请求，并把微博交给管道"""
+        for result in output:
+            if isinstance(result, scrapy.Request):
+                self.crawler.engine.crawl(result)
+            else:
+                deferred_from_coro(
+                    self.crawler.engine.scraper.start_itemproc(
+                        result, response=None))
+
+    def split_cell(self, cell, depth):
+        """拆分搜索单元，并在爬虫统计信息中记录拆分树"""
+        children = cell.split(self.regions)
+        stats = self.crawler.stats
+        stats.inc_value('subdivision/splits')
+        stats.max_value('subdivision/max_depth', depth + 1)
+        tree = stats.get_value('subdivision/tree')
+        if tree is None:
+            tree = {}
+            stats.set_value('subdivision/tree', tree)
+        tree[cell.key()] = [
+            '|'.join([child.timescope, child.region]) for child in children
+        ]
+        return children
 
     def check_environment(self):
         """判断配置要求的软件是否已安装"""
@@ -94,208 +383,265 @@ class SearchSpider(scrapy.Spider):
         if self.mysql_error:
             print('系统中可能没有安装或正确配置MySQL数据库，请先根据系统环境安装或配置MySQL，再运行程序')
             raise CloseSpider()
+        if self.pyarrow_error:
+            print('系统中可能没有安装pyarrow库，请先运行 pip install pyarrow ，再运行程序')
+            raise CloseSpider()
 
     def parse(self, response):
-        base_url = response.meta.get('base_url')
-        keyword = response.meta.get('keyword')
-        province = response.meta.get('province')
+        """解析搜索单元的第一页，结果数达到阈值时拆分为更小的单元"""
+        cell = response.meta.get('cell')
+        depth = response.meta.get('cell_depth', 0)
         is_empty = response.xpath(
             '//div[@class="card card-no-result s-pt20b40"]')
         page_count = len(response.xpath('//ul[@class="s-scroll"]/li'))
+        saturated = page_count >= self.further_threshold
         if is_empty:
-            print('当前页面搜索结果为空')
-        elif page_count < self.further_threshold:
-            # 解析当前页面
-            for weibo in self.parse_weibo(response):
-                self.check_environment()
-                yield weibo
-            next_url = response.xpath(
-                '//a[@class="next"]/@href').extract_first()
-            if next_url:
-                next_url = self.base_url + next_url
-                yield scrapy.Request(url=next_url,
-                                     callback=self.parse_page,
-                                     meta={'keyword': keyword})
+            self.empty_cells.add(cell)
         else:
-            start_date = datetime.strptime(self.start_date, '%Y-%m-%d')
-            end_date = datetime.strptime(self.end_date, '%Y-%m-%d')
-            while start_date <= end_date:
-                start_str = start_date.strftime('%Y-%m-%d') + '-0'
-                start_date = start_date + timedelta(days=1)
-                end_str = start_date.strftime('%Y-%m-%d') + '-0'
-                url = base_url + self.weibo_type
-                url += self.contain_type
-                url += '&timescope=custom:{}:{}&page=1'.format(
-                    start_str, end_str)
-                # 获取一天的搜索结果
-                yield scrapy.Request(url=url,
-                                     callback=self.parse_by_day,
-                                     meta={
-                                         'base_url': base_url,
-                                         'keyword': keyword,
-                                         'province': province,
-                                         'date': start_str[:-2]
-                                     })
-
-    def parse_by_day(self, response):
-        """以天为单位筛选"""
-        base_url = response.meta.get('base_url')
-        keyword = response.meta.get('keyword')
-        province = response.meta.get('province')
-        is_empty = response.xpath(
-            '//div[@class="card card-no-result s-pt20b40"]')
-        date = response.meta.get('date')
-        page_count = len(response.xpath('//ul[@class="s-scroll"]/li'))
-        if is_empty:
-            print('当前页面搜索结果为空')
-        elif page_count < self.further_threshold:
-            # 解析当前页面
-            for weibo in self.parse_weibo(response):
-                self.check_environment()
-                yield weibo
-            next_url = response.xpath(
-                '//a[@class="next"]/@href').extract_first()
-            if next_url:
-                next_url = self.base_url + next_url
-                yield scrapy.Request(url=next_url,
-                                     callback=self.parse_page,
-                                     meta={'keyword': keyword})
+            self.empty_cells.discard(cell)
+        if not cell.city:
+            # 只有一页结果时没有分页列表，按一页记录
+            self.planner.record(cell, 0 if is_empty else max(page_count, 1))
+        if response.meta.get('planned'):
+            self.crawler.stats.inc_value(
+                'planner/miss' if saturated else 'planner/hit')
+        if saturated and cell.can_split():
+            response.meta['cell_split'] = True
+            for child in self.split_cell(cell, depth):
+                if not self.skip_cell(child):
+                    self.frontier.push(
+                        child,
+                        depth + 1,
+                        priority=self.priority.cell_priority(child))
+            self.complete_cell(cell)
+            yield from self.next_requests()
         else:
-            start_date_str = date + '-0'
-            start_date = datetime.strptime(start_date_str, '%Y-%m-%d-%H')
-            for i in range(1, 25):
-                start_str = start_date.strftime('%Y-%m-%d-X%H').replace(
-                    'X0', 'X').replace('X', '')
-                start_date = start_date + timedelta(hours=1)
-                end_str = start_date.strftime('%Y-%m-%d-X%H').replace(
-                    'X0', 'X').replace('X', '')
-                url = base_url + self.weibo_type
-                url += self.contain_type
-                url += '&timescope=custom:{}:{}&page=1'.format(
-                    start_str, end_str)
-                # 获取一小时的搜索结果
-                yield scrapy.Request(url=url,
-                                     callback=self.parse_by_hour_province
-                                     if province else self.parse_by_hour,
-                                     meta={
-                                         'base_url': base_url,
-                                         'keyword': keyword,
-                                         'province': province,
-                                         'start_time': start_str,
-                                         'end_time': end_str
-                                     })
-
-    def parse_by_hour(self, response):
-        """以小时为单位筛选"""
-        keyword = response.meta.get('keyword')
+            yield from self.parse_page(response)
+
+    def parse_page(self, response):
+        """解析一页搜索结果的信息，没有下一页时该搜索单元爬取完成"""
+        cell = response.meta.get('cell')
+        next_url = None
+        weibos = []
         is_empty = response.xpath(
             '//div[@class="card card-no-result s-pt20b40"]')
-        start_time = response.meta.get('start_time')
-        end_time = response.meta.get('end_time')
-        page_count = len(response.xpath('//ul[@class="s-scroll"]/li'))
         if is_empty:
             print('当前页面搜索结果为空')
-        elif page_count < self.further_threshold:
-            # 解析当前页面
-            for weibo in self.parse_weibo(response):
-                self.check_environment()
-                yield weibo
-            next_url = response.xpath(
-                '//a[@class="next"]/@href').extract_first()
-            if next_url:
-                next_url = self.base_url + next_url
-                yield scrapy.Request(url=next_url,
-                                     callback=self.parse_page,
-                                     meta={'keyword': keyword})
         else:
-            for region in self.regions.values():
-                url = ('https://s.weibo.com/weibo?q={}&region=custom:{}:1000'
-                       ).format(keyword, region['code'])
-                url += self.weibo_type
-                url += self.contain_type
-                url += '&timescope=custom:{}:{}&page=1'.format(
-                    start_time, end_time)
-                # 获取一小时一个省的搜索结果
-                yield scrapy.Request(url=url,
-                                     callback=self.parse_by_hour_province,
-                                     meta={
-                                         'keyword': keyword,
-                                         'start_time': start_time,
-                                         'end_time': end_time,
-                                         'province': region
-                                     })
-
-    def parse_by_hour_province(self, response):
-        """以小时和直辖市/省为单位筛选"""
-        keyword = response.meta.get('keyword')
-        is_empty = response.xpath(
-            '//div[@class="card card-no-result s-pt20b40"]')
-        start_time = response.meta.get('start_time')
-        end_time = response.meta.get('end_time')
-        province = response.meta.get('province')
-        page_count = len(response.xpath('//ul[@class="s-scroll"]/li'))
-        if is_empty:
-            print('当前页面搜索结果为空')
-        elif page_count < self.further_threshold:
-            # 解析当前页面
             for weibo in self.parse_weibo(response):
                 self.check_environment()
+                item = weibo.meta['item'] if isinstance(
+                    weibo, scrapy.Request) else weibo
+                weibos.append(item['weibo'])
                 yield weibo
             next_url = response.xpath(
                 '//a[@class="next"]/@href').extract_first()
-            if next_url:
-                next_url = self.base_url + next_url
-                yield scrapy.Request(url=next_url,
-                                     callback=self.parse_page,
-                                     meta={'keyword': keyword})
+            if next_url and self.is_known_page(response):
+                # 这一页都是之前爬到过的微博，不再请求后面的页面
+                self.crawler.stats.inc_value('incremental/pages_stopped')
+                next_url = None
+        if next_url:
+            next_url = self.base_url + next_url
+            if not self.frontier.advance(cell, next_url):
+                # 租约已到期并被其它进程接手，由其继续翻页
+                self.crawler.stats.inc_value('frontier/lease_lost')
+                yield from self.next_requests()
+                return
+            meta = {
+                key: response.meta.get(key)
+                for key in ['keyword', 'cell', 'cell_depth', 'planned']
+            }
+            meta['page'] = get_page(next_url)
+            # 这一页的微博转评赞多时，下一页也更可能是有价值的微博
+            yield scrapy.Request(url=next_url,
+                                 callback=self.parse_page,
+                                 errback=self.parse_cell_error,
+                                 priority=self.priority.cell_priority(
+                                     cell, meta['page'],
+                                     get_engagement(weibos)),
+                                 meta=meta)
         else:
-            for city in province['city'].values():
-                url = ('https://s.weibo.com/weibo?q={}&region=custom:{}:{}'
-                       ).format(keyword, province['code'], city)
-                url += self.weibo_type
-                url += self.contain_type
-                url += '&timescope=custom:{}:{}&page=1'.format(
-                    start_time, end_time)
-                # 获取一小时一个城市的搜索结果
-                yield scrapy.Request(url=url,
-                                     callback=self.parse_page,
-                                     meta={
-                                         'keyword': keyword,
-                                         'start_time': start_time,
-                                         'end_time': end_time,
-                                         'province': province,
-                                         'city': city
-                                     })
+            self.complete_cell(cell)
+            yield from self.next_requests()
 
-    def parse_page(self, response):
-        """解析一页搜索结果的信息"""
+    def complete_cell(self, cell):
+        if not self.frontier.complete(cell):
+            self.crawler.stats.inc_value('frontier/lease_lost')
+
+    def is_known_page(self, response):
+        """增量爬取时，判断页面中的微博是否都在之前的爬取中爬到过"""
+        if not self.incremental:
+            return False
         keyword = response.meta.get('keyword')
-        is_empty = response.xpath(
-            '//div[@class="card card-no-result s-pt20b40"]')
-        if is_empty:
-            print('当前页面搜索结果为空')
+        mids = response.xpath("//div[@class='card-wrap']/@mid").extract()
+        return bool(mids) and all(
+            self.watermark.is_known(keyword, mid) for mid in mids)
+
+    def fill_ip(self, item):
+        """优先从详情缓存补全IP属地，缓存未命中时返回查询IP属地的请求"""
+        detail = self.detail_cache.get(item['weibo']['bid'])
+        if detail is None:
+            self.crawler.stats.inc_value('detail_cache/miss')
+            self.frontier.hold(item)
+            return self.get_ip_request(item)
+        self.crawler.stats.inc_value('detail_cache/hit')
+        item['weibo']['ip'] = self.get_ip(detail)
+        return item
+
+    def get_ip_request(self, item):
+        """生成查询微博IP属地的请求，由Scrapy调度，不阻塞其它请求"""
+        bid = item['weibo']['bid']
+        url = f"https://weibo.com/ajax/statuses/show?id={bid}&locale=zh-CN"
+        return scrapy.Request(url=url,
+                              callback=self.parse_ip,
+                              errback=self.parse_ip_error,
+                              priority=ITEM_PRIORITY,
+                              dont_filter=True,
+                              meta={
+                                  'item': item,
+                                  'download_slot': self.ip_slot
+                              })
+
+    def parse_ip(self, response):
+        """补全微博的IP属地后输出微博，并写入详情缓存"""
+        item = response.meta['item']
+        detail = self.get_detail(response)
+        if detail is None:
+            item['weibo']['ip'] = ''
         else:
-            for weibo in self.parse_weibo(response):
-                self.check_environment()
-                yield weibo
-            next_url = response.xpath(
-                '//a[@class="next"]/@href').extract_first()
-            if next_url:
-                next_url = self.base_url + next_url
-                yield scrapy.Request(url=next_url,
-                                     callback=self.parse_page,
-                                     meta={'keyword': keyword})
+            self.detail_cache.set(item['weibo']['bid'], item['weibo']['id'],
+                                  detail)
+            item['weibo']['ip'] = self.get_ip(detail)
+        self.frontier.release(item)
+        yield item
 
-    def get_ip(self, bid):
+    def parse_ip_error(self, failure):
+        """IP属地请求失败时，IP属地置空后照常输出微博"""
+        item = failure.request.meta['item']
+        item['weibo']['ip'] = ''
+        self.frontier.release(item)
+        self.crawl_output([item])
+
+    def parse_mids(self, response):
+        """ajax模式下只从搜索结果页提取微博id，微博内容从详情接口获取"""
+        keyword = response.meta.get('keyword')
+        for card in response.xpath("//div[@class='card-wrap'][@mid]"):
+            mid = card.xpath('@mid').extract_first()
+            href = card.xpath('.//div[@class="from"]/a[1]/@href').extract_first()
+            if not href:
+                continue
+            if self.incremental and self.watermark.is_known(keyword, mid):
+                self.crawler.stats.inc_value('incremental/known')
+                continue
+            weibo = WeiboItem(id=mid, bid=href.split('/')[-1].split('?')[0])
+            item = {'weibo': weibo, 'keyword': keyword}
+            # 获取详情后再输出该微博
+            self.frontier.hold(item)
+            yield self.get_detail_request(item)
+
+    def get_detail_request(self, item):
+        """生成获取微博详情的请求，与查询IP属地使用同一接口和下载槽"""
+        bid = item['weibo']['bid']
         url = f"https://weibo.com/ajax/statuses/show?id={bid}&locale=zh-CN"
-        response = requests.get(url, headers=self.settings.get('DEFAULT_REQUEST_HEADERS'))
-        if response.status_code != 200:
-            return ""
+        return scrapy.Request(url=url,
+                              callback=self.parse_detail,
+                              errback=self.parse_detail_error,
+                              priority=ITEM_PRIORITY,
+                              dont_filter=True,
+                              meta={
+                                  'item': item,
+                                  'download_slot': self.ip_slot
+                              })
+
+    def parse_detail(self, response):
+        """由微博详情生成微博，长微博再获取全文"""
+        item = response.meta['item']
         try:
-            data = response.json()
-        except requests.exceptions.JSONDecodeError:
-            return ""
-        ip_str = data.get("region_name", "")
+            status = json.loads(response.body)
+        except ValueError:
+            status = None
+        if not isinstance(status, dict) or status.get('ok') != 1:
+            # 微博已删除或不可见，重新获取也不会成功，不再输出
+            self.crawler.stats.inc_value('ajax/detail_unavailable')
+            self.frontier.release(item)
+            return
+        weibo, retweet = ajax_parser.parse_status(status)
+        self.detail_cache.set(weibo['bid'], weibo['id'],
+                              {'region_name': status.get('region_name', '')})
+        self.watermark.add(item['keyword'], weibo['id'], weibo['created_at'])
+        long_weibos = [weibo] if status.get('isLongText') else []
+        if retweet is not None and status['retweeted_status'].get(
+                'isLongText'):
+            long_weibos.append(retweet)
+        yield from self.next_long_text(item, weibo, retweet, long_weibos)
+
+    def next_long_text(self, item, weibo, retweet, long_weibos):
+        """依次获取长微博的全文，都获取后输出微博"""
+        if long_weibos:
+            self.crawler.stats.inc_value('ajax/long_text')
+            url = 'https://weibo.com/ajax/statuses/longtext?id=%s' % long_weibos[
+                0]['bid']
+            yield scrapy.Request(url=url,
+                                 callback=self.parse_long_text,
+                                 errback=self.parse_long_text_error,
+                                 priority=ITEM_PRIORITY,
+                                 dont_filter=True,
+                                 meta={
+                                     'item': item,
+                                     'weibo': weibo,
+                                     'retweet': retweet,
+                                     'long_weibos': long_weibos,
+                                     'download_slot': self.ip_slot
+                                 })
+            return
+        if retweet is not None:
+            yield {'weibo': retweet, 'keyword': item['keyword']}
+        item['weibo'] = weibo
+        self.frontier.release(item)
+        yield item
+
+    def parse_long_text(self, response):
+        meta = response.meta
+        long_weibos = meta['long_weibos']
+        try:
+            data = json.loads(response.body)['data']
+            ajax_parser.set_text(long_weibos[0], data['longTextContent'],
+                                 data.get('url_struct'))
+        except (ValueError, KeyError, TypeError):
+            # 获取全文失败时保留截断的正文
+            self.crawler.stats.inc_value('ajax/long_text_failed')
+        yield from self.next_long_text(meta['item'], meta['weibo'],
+                                       meta['retweet'], long_weibos[1:])
+
+    def parse_long_text_error(self, failure):
+        """获取全文的请求失败时保留截断的正文，照常输出微博"""
+        self.crawler.stats.inc_value('ajax/long_text_failed')
+        meta = failure.request.meta
+        self.crawl_output(
+            self.next_long_text(meta['item'], meta['weibo'], meta['retweet'],
+                                meta['long_weibos'][1:]))
+
+    def parse_detail_error(self, failure):
+        """详情请求失败的微博不输出，保留在待爬队列中，下次运行时重新获取
+
+        重新获取FRONTIER_MAX_ATTEMPTS次仍失败的微博不再保留，以免队列无法结束。
+        """
+        self.crawler.stats.inc_value('ajax/detail_failed')
+
+    def get_detail(self, response):
+        """从微博详情接口的返回中提取需要缓存的字段，返回异常时返回None"""
+        try:
+            data = json.loads(response.body)
+        except ValueError:
+            return None
+        if not isinstance(data, dict) or (data.get('ok') != 1
+                                          and 'region_name' not in data):
+            return None
+        return {'region_name': data.get('region_name', '')}
+
+    def get_ip(self, detail):
+        """从详情中获取IP属地"""
+        ip_str = detail.get('region_name', '')
         if ip_str:
             ip_str = ip_str.split()[-1]
         return ip_str
@@ -362,6 +708,27 @@ class SearchSpider(scrapy.Spider):
     def parse_weibo(self, response):
         """解析网页中的微博信息"""
         keyword = response.meta.get('keyword')
+        if self.search_mode == 'ajax':
+            yield from self.parse_mids(response)
+            return
+        if self.settings.get('PARSER') == 'lxml':
+            cards = lxml_parser.parse_cards(response.selector.root)
+        else:
+            cards = self.parse_cards(response)
+        for weibo, retweet in cards:
+            if self.incremental and self.watermark.is_known(
+                    keyword, weibo['id']):
+                self.crawler.stats.inc_value('incremental/known')
+                continue
+            self.watermark.add(keyword, weibo['id'], weibo['created_at'])
+            if retweet is not None:
+                yield {'weibo': retweet, 'keyword': keyword}
+            print(weibo)
+            # IP属地补全后再输出该微博
+            yield self.fill_ip({'weibo': weibo, 'keyword': keyword})
+
+    def parse_cards(self, response):
+        """用XPath逐个解析网页中的微博，返回(微博, 被转发的微博)"""
         for sel in response.xpath("//div[@class='card-wrap']"):
             info = sel.xpath(
                 "div[@class='card']/div[@class='card-feed']/div[@class='content']/div[@class='info']"
@@ -473,6 +840,7 @@ class SearchSpider(scrapy.Spider):
                     weibo['pics'] = ''
                     weibo['video_url'] = ''
                 weibo['retweet_id'] = ''
+                retweet = None
                 if retweet_sel and retweet_sel[0].xpath(
                         './/div[@node-type="feed_list_forwardContent"]/a[1]'):
                     retweet = WeiboItem()
@@ -532,9 +900,7 @@ class SearchSpider(scrapy.Spider):
                     retweet['pics'] = pics
                     retweet['video_url'] = video_url
                     retweet['retweet_id'] = ''
-                    yield {'weibo': retweet, 'keyword': keyword}
                     weibo['retweet_id'] = retweet['id']
-                weibo["ip"] = self.get_ip(bid)
 
                 avator = sel.xpath(
                     "div[@class='card']/div[@class='card-feed']/div[@class='avator']"
@@ -552,5 +918,4 @@ class SearchSpider(scrapy.Spider):
                         weibo['user_authentication'] = '金V'
                     else:
                         weibo['user_authentication'] = '普通用户'
-                print(weibo)
-                yield {'weibo': weibo, 'keyword': keyword}
+                yield weibo, retweet
@@ -0,0 +1,80 @@
+import re
+from urllib.parse import urlparse
+
+LOGIN = 'login'
+REDIRECT = 'redirect'
+CAPTCHA = 'captcha'
+EMPTY_SHELL = 'empty_shell'
+
+LOGIN_HOSTS = ('passport.weibo.com', 'passport.weibo.cn', 'login.sina.com.cn')
+LOGIN_TITLES = ('Sina Visitor System', '新浪通行证')
+CAPTCHA_MARKERS = (b'geetest', b'captcha', '验证码'.encode('utf-8'))
+TITLE_RE = re.compile(rb'<title>(.*?)</title>', re.S | re.I)
+# 只检查页面开头，避免把微博正文中的“验证码”等文字当作验证页面
+HEAD_BYTES = 4096
+
+
+def is_login_url(url):
+    parsed = urlparse(url)
+    return parsed.hostname in LOGIN_HOSTS or 'login' in parsed.path
+
+
+def classify(request, response, is_search=False):
+    """根据状态码、链接和页面开头判断是否是登录、重定向、验证码或空壳页面，正常页面返回None
+
+    is_search为True时，既没有微博也没有无结果提示的搜索结果页算作空壳页面。
+    """
+    if 300 <= response.status < 400:
+        location = response.headers.get('Location', b'').decode(
+            'utf-8', 'ignore')
+        return LOGIN if is_login_url(location) else REDIRECT
+    if response.status == 418:
+        return CAPTCHA
+    if is_login_url(response.url):
+        return LOGIN
+    redirect_urls = request.meta.get('redirect_urls')
+    if redirect_urls and urlparse(redirect_urls[0]).hostname != urlparse(
+            response.url).hostname:
+        return REDIRECT
+    head = response.body[:HEAD_BYTES]
+    title = TITLE_RE.search(head)
+    if title:
+        title = title.group(1).decode('utf-8', 'ignore')
+        # 搜索结果页的标题包含搜索关键词
+        if '微博搜索' not in title and any(text in title
+                                        for text in LOGIN_TITLES):
+            return LOGIN
+    if any(marker in head for marker in CAPTCHA_MARKERS):
+        return CAPTCHA
+    if (is_search and response.status == 200
+            and b'card-wrap' not in response.body
+            and b'card-no-result' not in response.body):
+        return EMPTY_SHELL
+    return None
+
+
+class CircuitBreaker(object):
+    """连续出现threshold个异常页面时断开，正常页面使计数清零"""
+
+    def __init__(self, threshold=3):
+        self.threshold = threshold
+        self.failures = 0
+        self.is_open = False
+        self.trips = 0
+
+    def record(self, kind):
+        """记录页面类型，kind为None表示正常页面，返回是否因此断开"""
+        if kind is None:
+            self.failures = 0
+            return False
+        self.failures += 1
+        if self.is_open or self.failures < self.threshold:
+            return False
+        self.is_open = True
+        self.trips += 1
+        return True
+
+    def half_open(self):
+        """暂停结束后恢复请求，再出现一个异常页面即重新断开"""
+        self.is_open = False
+        self.failures = self.threshold - 1
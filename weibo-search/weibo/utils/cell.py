@@ -0,0 +1,79 @@
+from collections import namedtuple
+from datetime import timedelta
+
+from weibo.utils.region import region_dict
+
+
+def format_hour(time):
+    """将时间转换成搜索链接中timescope使用的格式，如2024-01-01-8"""
+    return time.strftime('%Y-%m-%d-') + str(time.hour)
+
+
+class SearchCell(
+        namedtuple('SearchCell',
+                   ['keyword', 'start', 'end', 'province', 'city'])):
+    """一个搜索单元，即关键词在[start, end)时间段、某一地区内的搜索结果
+
+    province和city为region_dict中的省份和城市名称，为None时表示不限地区。
+    """
+    __slots__ = ()
+
+    @property
+    def hours(self):
+        return int((self.end - self.start).total_seconds() // 3600)
+
+    @property
+    def level(self):
+        """搜索单元的粒度：多个小时、一小时、省份或城市"""
+        if self.city:
+            return 'city'
+        if self.province:
+            return 'province'
+        return 'hour' if self.hours == 1 else 'hours'
+
+    @property
+    def timescope(self):
+        return 'custom:{}:{}'.format(format_hour(self.start),
+                                     format_hour(self.end))
+
+    @property
+    def region(self):
+        if not self.province:
+            return ''
+        province = region_dict[self.province]
+        city = province['city'][self.city] if self.city else 1000
+        return 'custom:{}:{}'.format(province['code'], city)
+
+    def key(self):
+        """搜索单元的唯一标识"""
+        return '|'.join([self.keyword, self.timescope, self.region])
+
+    def url(self, weibo_type, contain_type):
+        url = 'https://s.weibo.com/weibo?q={}'.format(self.keyword)
+        if self.province:
+            url += '&region=' + self.region
+        url += weibo_type
+        url += contain_type
+        url += '&timescope=' + self.timescope
+        return url
+
+    def can_split(self):
+        return self.hours > 1 or not self.city
+
+    def split(self, regions):
+        """将搜索单元拆分为更小的单元
+
+        时间段长于一小时时对半拆分时间段；已是一小时的，按省份拆分，
+        再按城市拆分。regions为不限地区时参与拆分的省份。
+        """
+        if self.hours > 1:
+            middle = self.start + timedelta(hours=self.hours // 2)
+            return [self._replace(end=middle), self._replace(start=middle)]
+        if not self.province:
+            return [self._replace(province=province) for province in regions]
+        if not self.city:
+            return [
+                self._replace(city=city)
+                for city in region_dict[self.province]['city']
+            ]
+        return []
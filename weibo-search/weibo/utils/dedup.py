@@ -0,0 +1,129 @@
+import hashlib
+import math
+import time
+
+import weibo.utils.util as util
+
+
+class BloomFilter(object):
+    """容量为capacity、误判率为error_rate的布隆过滤器"""
+
+    def __init__(self, capacity, error_rate):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.bit_count = int(
+            math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+        self.hash_count = max(
+            1, int(round(self.bit_count / capacity * math.log(2))))
+        self.bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+
+    def __contains__(self, key):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7))
+                   for pos in self._positions(key))
+
+    def add(self, key):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def is_full(self):
+        return self.count >= self.capacity
+
+
+class ScalableBloomFilter(object):
+    """可扩容的布隆过滤器
+
+    当前过滤器写满后追加一个容量翻倍、误判率减半的过滤器，
+    总误判率不超过error_rate。
+    """
+    growth = 2
+    tightening = 0.5
+
+    def __init__(self, capacity, error_rate):
+        self.filters = [
+            BloomFilter(capacity, error_rate * (1 - self.tightening))
+        ]
+
+    def __contains__(self, key):
+        return any(key in bloom for bloom in self.filters)
+
+    def add(self, key):
+        bloom = self.filters[-1]
+        if bloom.is_full():
+            bloom = BloomFilter(bloom.capacity * self.growth,
+                                bloom.error_rate * self.tightening)
+            self.filters.append(bloom)
+        bloom.add(key)
+
+    @property
+    def size(self):
+        """过滤器占用的内存字节数"""
+        return sum(len(bloom.bits) for bloom in self.filters)
+
+
+class DedupStore(object):
+    """跨多次爬取、所有关键词共享的微博id去重库
+
+    id精确保存在SQLite中，内存中只保留布隆过滤器，过滤器判断不存在的id无需查询磁盘。
+    超过retention_days天的id在打开时删除，retention_days为0时永久保留。
+    """
+
+    def __init__(self,
+                 path,
+                 error_rate=0.001,
+                 retention_days=30,
+                 initial_capacity=100000,
+                 commit_interval=100,
+                 autocommit=False):
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.false_positives = 0
+        self.conn = util.connect_sqlite(path, autocommit)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS seen (
+            id TEXT PRIMARY KEY,
+            seen_at REAL NOT NULL)""")
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS seen_seen_at ON seen (seen_at)')
+        if retention_days:
+            self.conn.execute('DELETE FROM seen WHERE seen_at < ?',
+                              (time.time() - retention_days * 86400, ))
+        self.conn.commit()
+        count = self.conn.execute('SELECT COUNT(*) FROM seen').fetchone()[0]
+        self.bloom = ScalableBloomFilter(max(initial_capacity, count * 2),
+                                         error_rate)
+        for row in self.conn.execute('SELECT id FROM seen'):
+            self.bloom.add(row[0])
+
+    def __contains__(self, key):
+        if key not in self.bloom:
+            return False
+        if self.conn.execute('SELECT 1 FROM seen WHERE id = ?',
+                             (key, )).fetchone():
+            return True
+        self.false_positives += 1
+        return False
+
+    def add(self, key):
+        """加入id，返回是否是新的id；多个进程共用去重库时，其它进程已加入的id返回False"""
+        cursor = self.conn.execute(
+            'INSERT OR IGNORE INTO seen (id, seen_at) VALUES (?, ?)',
+            (key, time.time()))
+        self.bloom.add(key)
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.conn.commit()
+            self.pending = 0
+        return bool(cursor.rowcount)
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,82 @@
+import json
+import time
+
+import weibo.utils.util as util
+
+
+class DetailCache(object):
+    """微博详情缓存，以bid为键保存在SQLite中，跨多次爬取共享
+
+    缓存条数超过上限时，按最近访问时间淘汰最久未使用的条目。
+    """
+
+    def __init__(self,
+                 path,
+                 max_size=100000,
+                 commit_interval=100,
+                 autocommit=False):
+        self.max_size = max_size
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.conn = util.connect_sqlite(path, autocommit)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS detail (
+            bid TEXT PRIMARY KEY,
+            mid TEXT,
+            data TEXT NOT NULL,
+            accessed_at REAL NOT NULL)""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS detail_accessed_at
+            ON detail (accessed_at)""")
+        self.conn.commit()
+        self.size = self.conn.execute(
+            'SELECT COUNT(*) FROM detail').fetchone()[0]
+
+    def _load(self, bid):
+        row = self.conn.execute('SELECT data FROM detail WHERE bid = ?',
+                                (bid, )).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get(self, bid):
+        """返回bid对应的详情字典，不存在时返回None"""
+        detail = self._load(bid)
+        if detail is not None:
+            self.conn.execute(
+                'UPDATE detail SET accessed_at = ? WHERE bid = ?',
+                (time.time(), bid))
+            self._written()
+        return detail
+
+    def set(self, bid, mid, detail):
+        """保存详情，与已有的字段合并"""
+        data = self._load(bid)
+        if data is None:
+            data = {}
+            self.size += 1
+        data.update(detail)
+        self.conn.execute(
+            """INSERT OR REPLACE INTO detail (bid, mid, data, accessed_at)
+            VALUES (?, ?, ?, ?)""",
+            (bid, mid, json.dumps(data, ensure_ascii=False), time.time()))
+        if self.size > self.max_size:
+            self.evict()
+        self._written()
+
+    def evict(self):
+        """淘汰最久未访问的条目，多淘汰十分之一以减少淘汰次数"""
+        count = self.size - self.max_size + self.max_size // 10
+        self.conn.execute(
+            """DELETE FROM detail WHERE bid IN (
+            SELECT bid FROM detail ORDER BY accessed_at LIMIT ?)""",
+            (count, ))
+        self.size = self.conn.execute(
+            'SELECT COUNT(*) FROM detail').fetchone()[0]
+
+    def _written(self):
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,42 @@
+import time
+from datetime import datetime, timedelta
+
+import weibo.utils.util as util
+
+
+class EmptyCellCache(object):
+    """搜索结果为空的搜索单元缓存，在重新检查间隔内跳过这些单元
+
+    只缓存时间段已结束一小时以上的单元，避免把尚未被搜索收录的新微博当作空结果。
+    """
+
+    def __init__(self, path, recheck_secs=604800, autocommit=False):
+        self.recheck_secs = recheck_secs
+        self.conn = util.connect_sqlite(path, autocommit)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS empty_cell (
+            key TEXT PRIMARY KEY,
+            checked_at REAL NOT NULL)""")
+        self.conn.commit()
+
+    def is_empty(self, cell):
+        """搜索单元在重新检查间隔内是否确认过结果为空"""
+        row = self.conn.execute(
+            'SELECT checked_at FROM empty_cell WHERE key = ?',
+            (cell.key(), )).fetchone()
+        return bool(row) and time.time() - row[0] < self.recheck_secs
+
+    def add(self, cell):
+        if cell.end > datetime.now() - timedelta(hours=1):
+            return
+        self.conn.execute(
+            'INSERT OR REPLACE INTO empty_cell (key, checked_at) VALUES (?, ?)',
+            (cell.key(), time.time()))
+
+    def discard(self, cell):
+        self.conn.execute('DELETE FROM empty_cell WHERE key = ?',
+                          (cell.key(), ))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
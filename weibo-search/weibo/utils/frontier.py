@@ -0,0 +1,345 @@
+import json
+import os
+import time
+from datetime import datetime
+
+import weibo.utils.util as util
+from weibo.items import WeiboItem
+from weibo.utils.cell import SearchCell
+
+PENDING = 0
+ACTIVE = 1
+DONE = 2
+FAILED = 3
+
+
+class Frontier(object):
+    """待爬搜索单元队列的接口，FRONTIER_BACKEND配置使用的实现
+
+    多个爬虫进程共用一个队列时，各自以不同的FRONTIER_WORKER租用单元。租约到期未续租的
+    单元可被其它进程重新租用；只有持有租约的进程能把单元标记为完成，每个单元只完成一次。
+    """
+
+    @classmethod
+    def from_crawler(cls, crawler, crawl_id):
+        raise NotImplementedError
+
+    def is_empty(self):
+        """是否从未加入过搜索单元，即不是中断后继续的爬取"""
+        raise NotImplementedError
+
+    def is_finished(self):
+        """是否已没有待爬或正被任一进程爬取的单元"""
+        raise NotImplementedError
+
+    def pending_count(self):
+        raise NotImplementedError
+
+    def covered_until(self, keyword):
+        """返回队列中关键词的单元覆盖到的最晚时间，没有单元时返回None"""
+        raise NotImplementedError
+
+    def push(self, cell, depth=0, planned=False, priority=0):
+        raise NotImplementedError
+
+    def lease(self, n):
+        """按优先级从高到低租用至多n个待爬单元，返回[(单元, 拆分深度, 是否预测拆分, 下一页链接)]"""
+        raise NotImplementedError
+
+    def advance(self, cell, page_url):
+        """记录单元下一页的链接并续租，租约已被其它进程取得时返回False"""
+        raise NotImplementedError
+
+    def complete(self, cell):
+        """标记单元完成，租约已被其它进程取得时返回False"""
+        raise NotImplementedError
+
+    def fail(self, cell):
+        """单元请求失败，本次运行不再重试，下次运行时重新爬取"""
+        raise NotImplementedError
+
+    def hold(self, item):
+        """保存还未输出的微博"""
+        raise NotImplementedError
+
+    def release(self, item):
+        """微博已输出"""
+        raise NotImplementedError
+
+    def adopt_held_items(self):
+        """接管已不再运行的进程未输出的微博，返回接管的条数"""
+        raise NotImplementedError
+
+    def held_items(self):
+        """返回本进程上次运行中未输出的微博，每返回一次记为重新获取一次"""
+        raise NotImplementedError
+
+    def drop_held_items(self):
+        """删除已重新获取max_attempts次仍未输出的微博，返回删除的条数"""
+        raise NotImplementedError
+
+    def unfinished_since(self):
+        """返回{关键词: 最早的未爬完的时间}，如2024-01-01 08:00，已爬完的关键词不在其中
+
+        包括未完成的单元的开始时间和所有进程未输出的微博的发布时间，不知道发布时间时为
+        空字符串。已退出的进程的微博由之后运行的进程adopt_held_items接管后重新获取或删除。
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """关闭队列，返回是否所有单元都已爬完"""
+        raise NotImplementedError
+
+
+class SqliteFrontier(Frontier):
+    """保存在SQLite中的待爬队列，同一台机器上的多个爬虫进程可共用
+
+    每个搜索单元记录拆分深度、优先级和下一页的链接，按优先级从高到低租用，翻页时
+    更新下一页的链接并续租。已解析但还在等待IP属地的微博也保存在队列中，继续时重新
+    查询，重新查询max_attempts次仍未输出的微博不再保留；没有未到期租约的进程的微博由
+    打开队列后运行的进程接管。本进程上次运行中租用的单元和
+    请求失败的单元在打开时重新变为待爬；租用max_attempts次仍未完成的单元不再租用。租用立即提交，其它写入每隔checkpoint_secs
+    秒提交一次，多个进程共用时应为0。
+    """
+
+    def __init__(self,
+                 path,
+                 worker='local',
+                 lease_secs=300,
+                 max_attempts=3,
+                 checkpoint_secs=5):
+        self.path = path
+        self.worker = worker
+        self.lease_secs = lease_secs
+        self.max_attempts = max_attempts
+        self.checkpoint_secs = checkpoint_secs
+        self.committed_at = time.time()
+        self.leased = set()
+        self.conn = util.connect_sqlite(path, autocommit=not checkpoint_secs)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS cell (
+            key TEXT PRIMARY KEY,
+            keyword TEXT NOT NULL,
+            start TEXT NOT NULL,
+            end TEXT NOT NULL,
+            province TEXT,
+            city TEXT,
+            depth INTEGER NOT NULL,
+            planned INTEGER NOT NULL,
+            page_url TEXT,
+            status INTEGER NOT NULL,
+            seq INTEGER NOT NULL,
+            worker TEXT,
+            lease_expires REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            priority INTEGER NOT NULL DEFAULT 0)""")
+        columns = [
+            row[1] for row in self.conn.execute('PRAGMA table_info(cell)')
+        ]
+        if 'priority' not in columns:
+            # 之前版本中断的爬取，队列中的单元没有优先级
+            self.conn.execute('ALTER TABLE cell ADD COLUMN priority INTEGER '
+                              'NOT NULL DEFAULT 0')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS cell_priority ON cell '
+                          '(status, priority DESC, seq)')
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS held_item (
+            id TEXT PRIMARY KEY,
+            worker TEXT NOT NULL,
+            data TEXT NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0)""")
+        columns = [
+            row[1]
+            for row in self.conn.execute('PRAGMA table_info(held_item)')
+        ]
+        if 'attempts' not in columns:
+            self.conn.execute('ALTER TABLE held_item ADD COLUMN attempts '
+                              'INTEGER NOT NULL DEFAULT 0')
+        self.conn.execute(
+            """UPDATE cell SET status = ?, worker = NULL, attempts = 0
+            WHERE status = ? OR (status = ? AND worker = ?)""",
+            (PENDING, FAILED, ACTIVE, worker))
+        self.conn.commit()
+
+    @classmethod
+    def from_crawler(cls, crawler, crawl_id):
+        settings = crawler.settings
+        worker = settings.get('FRONTIER_WORKER')
+        return cls(
+            util.get_cache_path(settings, 'frontier_%s.db' % crawl_id),
+            worker or 'local', settings.getfloat('FRONTIER_LEASE_SECS', 300),
+            settings.getint('FRONTIER_MAX_ATTEMPTS', 3),
+            settings.getfloat('FRONTIER_CHECKPOINT_SECS', 0 if worker else 5))
+
+    @property
+    def active(self):
+        """本进程正在爬取的单元数"""
+        return len(self.leased)
+
+    def is_empty(self):
+        return not self.conn.execute('SELECT 1 FROM cell LIMIT 1').fetchone()
+
+    def is_finished(self):
+        return not self.conn.execute(
+            'SELECT 1 FROM cell WHERE status IN (?, ?) LIMIT 1',
+            (PENDING, ACTIVE)).fetchone()
+
+    def pending_count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM cell WHERE status = ?',
+                                 (PENDING, )).fetchone()[0]
+
+    def covered_until(self, keyword):
+        row = self.conn.execute('SELECT MAX(end) FROM cell WHERE keyword = ?',
+                                (keyword, )).fetchone()
+        return datetime.fromisoformat(row[0]) if row[0] else None
+
+    def push(self, cell, depth=0, planned=False, priority=0):
+        self.conn.execute(
+            """INSERT OR IGNORE INTO cell (key, keyword, start, end, province,
+            city, depth, planned, status, seq, priority)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?,
+            (SELECT COALESCE(MAX(seq), 0) + 1 FROM cell), ?)""",
+            (cell.key(), cell.keyword, cell.start.isoformat(),
+             cell.end.isoformat(), cell.province, cell.city, depth,
+             int(planned), PENDING, priority))
+        self._written()
+
+    def lease(self, n):
+        if n <= 0:
+            return []
+        now = time.time()
+        # 先取得写锁再查询，避免多个进程租到同一个单元
+        self.conn.commit()
+        self.conn.execute('BEGIN IMMEDIATE')
+        self.conn.execute(
+            """UPDATE cell SET status = ?, worker = NULL WHERE status = ?
+            AND lease_expires < ? AND attempts >= ?""",
+            (FAILED, ACTIVE, now, self.max_attempts))
+        rows = self.conn.execute(
+            """SELECT key, keyword, start, end, province, city, depth,
+            planned, page_url FROM cell WHERE status = ?
+            OR (status = ? AND lease_expires < ?)
+            ORDER BY priority DESC, seq LIMIT ?""",
+            (PENDING, ACTIVE, now, n)).fetchall()
+        self.conn.executemany(
+            """UPDATE cell SET status = ?, worker = ?, lease_expires = ?,
+            attempts = attempts + 1 WHERE key = ?""",
+            [(ACTIVE, self.worker, now + self.lease_secs, row[0])
+             for row in rows])
+        self.conn.commit()
+        self.committed_at = time.time()
+        self.leased.update(row[0] for row in rows)
+        return [(SearchCell(keyword, datetime.fromisoformat(start),
+                            datetime.fromisoformat(end), province, city),
+                 depth, bool(planned), page_url)
+                for _, keyword, start, end, province, city, depth, planned,
+                page_url in rows]
+
+    def advance(self, cell, page_url):
+        cursor = self.conn.execute(
+            """UPDATE cell SET page_url = ?, lease_expires = ?
+            WHERE key = ? AND status = ? AND worker = ?""",
+            (page_url, time.time() + self.lease_secs, cell.key(), ACTIVE,
+             self.worker))
+        self._written()
+        if not cursor.rowcount:
+            self.leased.discard(cell.key())
+            return False
+        return True
+
+    def complete(self, cell):
+        return self._finish(cell, DONE)
+
+    def fail(self, cell):
+        return self._finish(cell, FAILED)
+
+    def _finish(self, cell, status):
+        cursor = self.conn.execute(
+            """UPDATE cell SET status = ?, worker = NULL
+            WHERE key = ? AND status = ? AND worker = ?""",
+            (status, cell.key(), ACTIVE, self.worker))
+        self.leased.discard(cell.key())
+        self._written()
+        return bool(cursor.rowcount)
+
+    def hold(self, item):
+        data = {'keyword': item['keyword'], 'weibo': dict(item['weibo'])}
+        self.conn.execute(
+            """INSERT OR REPLACE INTO held_item (id, worker, data)
+            VALUES (?, ?, ?)""", (item['weibo']['id'], self.worker,
+                                  json.dumps(data, ensure_ascii=False)))
+        self._written()
+
+    def release(self, item):
+        self.conn.execute('DELETE FROM held_item WHERE id = ?',
+                          (item['weibo']['id'], ))
+        self._written()
+
+    def adopt_held_items(self):
+        """接管没有未到期租约的进程的未输出微博，返回接管的条数
+
+        这些进程已退出或改用了其它FRONTIER_WORKER，不会再重新获取，接管后由本进程
+        重新获取或删除，否则它们一直留在队列中，高水位也一直停在它们的发布时间。
+        """
+        cursor = self.conn.execute(
+            """UPDATE held_item SET worker = ? WHERE worker != ?
+            AND worker NOT IN (SELECT worker FROM cell WHERE status = ?
+            AND lease_expires >= ?)""",
+            (self.worker, self.worker, ACTIVE, time.time()))
+        self._written()
+        return cursor.rowcount
+
+    def held_items(self):
+        rows = self.conn.execute(
+            'SELECT data FROM held_item WHERE worker = ?',
+            (self.worker, )).fetchall()
+        self.conn.execute(
+            'UPDATE held_item SET attempts = attempts + 1 WHERE worker = ?',
+            (self.worker, ))
+        self._written()
+        for row in rows:
+            data = json.loads(row[0])
+            yield {
+                'weibo': WeiboItem(data['weibo']),
+                'keyword': data['keyword']
+            }
+
+    def drop_held_items(self):
+        cursor = self.conn.execute(
+            'DELETE FROM held_item WHERE worker = ? AND attempts >= ?',
+            (self.worker, self.max_attempts))
+        self._written()
+        return cursor.rowcount
+
+    def unfinished_since(self):
+        result = {}
+        for keyword, start in self.conn.execute(
+                """SELECT keyword, MIN(start) FROM cell WHERE status != ?
+                GROUP BY keyword""", (DONE, )):
+            result[keyword] = datetime.fromisoformat(start).strftime(
+                '%Y-%m-%d %H:%M')
+        for row in self.conn.execute('SELECT data FROM held_item'):
+            data = json.loads(row[0])
+            created_at = data['weibo'].get('created_at', '')
+            keyword = data['keyword']
+            result[keyword] = min(result.get(keyword, created_at), created_at)
+        return result
+
+    def _written(self):
+        if time.time() - self.committed_at >= self.checkpoint_secs:
+            self.conn.commit()
+            self.committed_at = time.time()
+
+    def close(self):
+        """关闭队列，所有单元都已爬完且没有未输出的微博时删除队列文件"""
+        finished = not self.conn.execute(
+            'SELECT 1 FROM cell WHERE status != ? LIMIT 1',
+            (DONE, )).fetchone() and not self.conn.execute(
+                'SELECT 1 FROM held_item LIMIT 1').fetchone()
+        self.conn.commit()
+        self.conn.close()
+        if finished:
+            for suffix in ['', '-wal', '-shm']:
+                if os.path.isfile(self.path + suffix):
+                    os.remove(self.path + suffix)
+        return finished
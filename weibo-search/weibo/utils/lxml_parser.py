@@ -0,0 +1,355 @@
+import re
+from urllib.parse import unquote
+
+from lxml import etree
+
+import weibo.utils.util as util
+from weibo.items import WeiboItem
+
+USER_AUTHENTICATION = {
+    'woo_svg_vblue': '蓝V',
+    'woo_svg_vyellow': '黄V',
+    'woo_svg_vorange': '红V',
+    'woo_svg_vgold': '金V'
+}
+LIKE_ANCHOR_CLASS = 'woo-box-flex woo-box-alignCenter woo-box-justifyCenter'
+
+
+def get_string(element):
+    """元素的字符串值，同XPath的string(.)"""
+    return ''.join(element.itertext())
+
+
+def get_texts(element):
+    """元素的直接文本节点，同XPath的text()"""
+    texts = [element.text] if element.text else []
+    texts.extend(child.tail for child in element if child.tail)
+    return texts
+
+
+def get_first_text(elements):
+    """依次查找元素的直接文本节点，返回第一个，同text()的extract_first()"""
+    for element in elements:
+        texts = get_texts(element)
+        if texts:
+            return texts[0]
+    return None
+
+
+def get_child(element, tag, cls=None, index=0):
+    """返回第index+1个标签为tag的子元素，同XPath的tag[index+1]"""
+    i = 0
+    for child in element:
+        if child.tag == tag and (cls is None or child.get('class') == cls):
+            if i == index:
+                return child
+            i += 1
+    return None
+
+
+def get_icons(a):
+    """返回链接中class为wbicon的i子元素"""
+    return [i for i in a if i.tag == 'i' and i.get('class') == 'wbicon']
+
+
+def first(values):
+    """返回第一个不为None的值，同extract_first()"""
+    for value in values:
+        if value is not None:
+            return value
+    return None
+
+
+def get_path(element, *path):
+    """依次查找class匹配的div子元素"""
+    for cls in path:
+        if element is None:
+            return None
+        element = get_child(element, 'div', cls)
+    return element
+
+
+class Card(object):
+    """一次遍历card-wrap子树收集到的节点，字段与parse_weibo中的XPath一一对应"""
+
+    def __init__(self, card):
+        self.txts = []
+        self.fulls = []
+        self.retweet = None
+        self.retweet_txts = []
+        self.retweet_fulls = []
+        self.retweet_forward_user = None
+        self.retweet_like_data = None
+        self.retweet_froms = []
+        self.retweet_acts = []
+        self.retweet_like_counts = []
+        self.froms = []
+        self.forwards = []
+        self.comments = []
+        self.like_buttons = []
+        self.piclist = None
+        self.video = None
+        self.anchors = {}
+        self.walk(card)
+
+    def walk(self, card):
+        # 正文段落可能嵌套，链接属于所有包含它的段落
+        open_txts = []
+        in_retweet = False
+        in_thumbnail = 0
+        in_like_anchor = 0
+        for event, element in etree.iterwalk(card, events=('start', 'end')):
+            tag = element.tag
+            if event == 'end':
+                if element is self.retweet:
+                    in_retweet = False
+                elif open_txts and element is open_txts[-1]:
+                    open_txts.pop()
+                elif tag == 'div' and element.get('class') == 'thumbnail':
+                    in_thumbnail -= 1
+                elif tag == 'a' and element.get('class') == LIKE_ANCHOR_CLASS:
+                    in_like_anchor -= 1
+                continue
+            cls = element.get('class')
+            if tag == 'a':
+                for txt in open_txts:
+                    self.anchors[txt].append(element)
+                action_type = element.get('action-type')
+                if action_type == 'feed_list_forward':
+                    self.forwards.append(element)
+                elif action_type == 'feed_list_comment':
+                    self.comments.append(element)
+                elif action_type == 'feed_list_like':
+                    self.like_buttons.extend(
+                        button for button in element if button.tag == 'button')
+                    if (in_retweet and self.retweet_like_data is None
+                            and element.get('action-data') is not None):
+                        self.retweet_like_data = element.get('action-data')
+                if cls == LIKE_ANCHOR_CLASS:
+                    in_like_anchor += 1
+            elif tag == 'p':
+                node_type = element.get('node-type')
+                if cls == 'txt' or node_type == 'feed_list_content_full':
+                    open_txts.append(element)
+                    self.anchors[element] = []
+                if cls == 'txt':
+                    self.txts.append(element)
+                    if in_retweet:
+                        self.retweet_txts.append(element)
+                if node_type == 'feed_list_content_full':
+                    self.fulls.append(element)
+                    if in_retweet:
+                        self.retweet_fulls.append(element)
+                if cls == 'from' and in_retweet:
+                    self.retweet_froms.append(element)
+            elif tag == 'div':
+                if cls == 'card-comment' and self.retweet is None:
+                    self.retweet = element
+                    in_retweet = True
+                elif cls == 'from':
+                    self.froms.append(element)
+                elif cls == 'media media-piclist' and self.piclist is None:
+                    self.piclist = element
+                elif cls == 'thumbnail':
+                    in_thumbnail += 1
+                if (in_retweet and self.retweet_forward_user is None and
+                        element.get('node-type') == 'feed_list_forwardContent'):
+                    self.retweet_forward_user = get_child(element, 'a')
+            elif tag == 'ul':
+                if in_retweet and cls == 'act s-fr':
+                    self.retweet_acts.append(element)
+            elif tag == 'span':
+                if (in_retweet and in_like_anchor
+                        and cls == 'woo-like-count'):
+                    self.retweet_like_counts.append(element)
+            elif tag == 'video-player':
+                if in_thumbnail and self.video is None:
+                    self.video = element
+
+    def get_article_url(self, txt):
+        """获取微博头条文章url"""
+        article_url = ''
+        text = get_string(txt).replace('\u200b', '').replace(
+            '\ue627', '').replace('\n', '').replace(' ', '')
+        if text.startswith('发布了头条文章'):
+            for a in self.anchors[txt]:
+                if get_first_text(get_icons(a)) == 'O':
+                    href = a.get('href')
+                    if href and href.startswith('http://t.cn'):
+                        article_url = href
+                    break
+        return article_url
+
+    def get_location(self, txt):
+        """获取微博发布位置"""
+        for a in self.anchors[txt]:
+            if get_first_text(get_icons(a)) == '2':
+                return get_string(a)[1:]
+        return ''
+
+    def get_at_users_and_topics(self, txt):
+        """获取微博中@的用户昵称和参与的话题"""
+        at_list = []
+        topic_list = []
+        for a in self.anchors[txt]:
+            text = get_string(a)
+            href = unquote(a.get('href'))
+            if len(href) > 14 and len(text) > 1:
+                if href[14:] == text[1:]:
+                    if text[1:] not in at_list:
+                        at_list.append(text[1:])
+            if len(text) > 2 and text[0] == '#' and text[-1] == '#':
+                if text[1:-1] not in topic_list:
+                    topic_list.append(text[1:-1])
+        return ','.join(at_list), ','.join(topic_list)
+
+    def get_text(self, weibo, txt, is_long):
+        """提取正文，并获取正文中的头条文章、位置、@用户和话题"""
+        weibo['text'] = get_string(txt).replace('\u200b',
+                                                '').replace('\ue627', '')
+        weibo['article_url'] = self.get_article_url(txt)
+        weibo['location'] = self.get_location(txt)
+        if weibo['location']:
+            weibo['text'] = weibo['text'].replace('2' + weibo['location'], '')
+        weibo['text'] = weibo['text'][2:].replace(' ', '')
+        if is_long:
+            weibo['text'] = weibo['text'][:-4]
+        weibo['at_users'], weibo['topics'] = self.get_at_users_and_topics(txt)
+
+
+def get_count(text):
+    count = re.findall(r'\d+.*', text)
+    return count[0] if count else '0'
+
+
+def parse_card(card):
+    """解析一个card-wrap，返回(微博, 被转发的微博)，不是微博的返回None"""
+    info = get_path(card, 'card', 'card-feed', 'content', 'info')
+    if info is None:
+        return None
+    c = Card(card)
+    weibo = WeiboItem()
+    weibo['id'] = card.get('mid')
+    froms_a1 = [a for a in (get_child(f, 'a') for f in c.froms) if a is not None]
+    froms_a2 = [
+        a for a in (get_child(f, 'a', index=1) for f in c.froms)
+        if a is not None
+    ]
+    bid = first(a.get('href') for a in froms_a1).split('/')[-1].split('?')[0]
+    weibo['bid'] = bid
+    user = get_child(info, 'div', index=1)
+    user_anchors = [a for a in user if a.tag == 'a'] if user is not None else []
+    weibo['user_id'] = first(a.get('href') for a in user_anchors).split(
+        '?')[0].split('/')[-1]
+    weibo['screen_name'] = first(a.get('nick-name') for a in user_anchors)
+    txt = c.txts[0]
+    retweet_txt = c.retweet_txts[0] if c.retweet_txts else ''
+    is_long_weibo = False
+    is_long_retweet = False
+    if c.fulls:
+        if c.retweet is None:
+            txt = c.fulls[0]
+            is_long_weibo = True
+        elif len(c.fulls) == 2:
+            txt = c.fulls[0]
+            retweet_txt = c.fulls[1]
+            is_long_weibo = True
+            is_long_retweet = True
+        elif c.retweet_fulls:
+            retweet_txt = c.retweet_fulls[0]
+            is_long_retweet = True
+        else:
+            txt = c.fulls[0]
+            is_long_weibo = True
+    c.get_text(weibo, txt, is_long_weibo)
+    reposts_count = ''.join(text for a in c.forwards for text in get_texts(a))
+    weibo['reposts_count'] = get_count(reposts_count)
+    weibo['comments_count'] = get_count(get_first_text(c.comments))
+    weibo['attitudes_count'] = get_count(
+        get_first_text(
+            span for span in (get_child(button, 'span', index=1)
+                              for button in c.like_buttons)
+            if span is not None))
+    created_at = get_first_text(froms_a1).replace(' ', '').replace(
+        '\n', '').split('前')[0]
+    weibo['created_at'] = util.standardize_date(created_at)
+    source = get_first_text(froms_a2)
+    weibo['source'] = source if source else ''
+    pics = ''
+    if c.piclist is not None:
+        ul = get_child(c.piclist, 'ul')
+        pics = []
+        if ul is not None:
+            for li in ul:
+                if li.tag != 'li':
+                    continue
+                pics.extend(img.get('src') for img in li
+                            if img.tag == 'img' and img.get('src') is not None)
+        pics = [pic[8:] for pic in pics]
+        pics = [re.sub(r'/.*?/', '/large/', pic, 1) for pic in pics]
+        pics = ['https://' + pic for pic in pics]
+    video_url = ''
+    if c.video is not None:
+        video = etree.tostring(c.video,
+                               method='html',
+                               encoding='unicode',
+                               with_tail=False)
+        video_url = re.findall(r'src:\'(.*?)\'', video)[0]
+        video_url = video_url.replace('&amp;', '&')
+        video_url = 'http:' + video_url
+    if c.retweet is None:
+        weibo['pics'] = pics
+        weibo['video_url'] = video_url
+    else:
+        weibo['pics'] = ''
+        weibo['video_url'] = ''
+    weibo['retweet_id'] = ''
+    retweet = None
+    if c.retweet is not None and c.retweet_forward_user is not None:
+        retweet = WeiboItem()
+        retweet['id'] = c.retweet_like_data[4:]
+        retweet['bid'] = first(a.get('href') for f in c.retweet_froms
+                               for a in f if a.tag == 'a').split('/')[-1].split(
+                                   '?')[0]
+        user = c.retweet_forward_user
+        retweet['user_id'] = user.get('href').split('/')[-1]
+        retweet['screen_name'] = user.get('nick-name')
+        c.get_text(retweet, retweet_txt, is_long_retweet)
+        acts_li1 = [get_child(ul, 'li') for ul in c.retweet_acts]
+        acts_li2 = [get_child(ul, 'li', index=1) for ul in c.retweet_acts]
+        retweet['reposts_count'] = get_count(
+            get_first_text(
+                get_child(li, 'a') for li in acts_li1
+                if li is not None and get_child(li, 'a') is not None))
+        retweet['comments_count'] = get_count(
+            get_first_text(
+                get_child(li, 'a') for li in acts_li2
+                if li is not None and get_child(li, 'a') is not None))
+        retweet['attitudes_count'] = get_count(
+            get_first_text(c.retweet_like_counts))
+        created_at = get_first_text(
+            a for a in (get_child(f, 'a') for f in c.retweet_froms)
+            if a is not None).replace(' ', '').replace('\n', '').split('前')[0]
+        retweet['created_at'] = util.standardize_date(created_at)
+        source = get_first_text(
+            a for a in (get_child(f, 'a', index=1) for f in c.retweet_froms)
+            if a is not None)
+        retweet['source'] = source if source else ''
+        retweet['pics'] = pics
+        retweet['video_url'] = video_url
+        retweet['retweet_id'] = ''
+        weibo['retweet_id'] = retweet['id']
+    avator = get_path(card, 'card', 'card-feed', 'avator')
+    if avator is not None:
+        user_auth = first(svg.get('id') for svg in avator.iter('svg'))
+        weibo['user_authentication'] = USER_AUTHENTICATION.get(
+            user_auth, '普通用户')
+    return weibo, retweet
+
+
+def parse_cards(root):
+    """解析搜索结果页中的所有微博，root为已解析的页面根节点"""
+    for card in root.xpath("//div[@class='card-wrap']"):
+        result = parse_card(card)
+        if result:
+            yield result
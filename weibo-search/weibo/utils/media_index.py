@@ -0,0 +1,37 @@
+import weibo.utils.util as util
+
+
+class MediaIndex(object):
+    """已下载的图片和视频，以链接为键保存文件内容的sha1和保存路径，跨多次爬取共享"""
+
+    def __init__(self, path, commit_interval=100, autocommit=False):
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.conn = util.connect_sqlite(path, autocommit)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS media (
+            url TEXT PRIMARY KEY,
+            sha1 TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER NOT NULL)""")
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS media_sha1 ON media (sha1)')
+        self.conn.commit()
+
+    def get(self, url):
+        """返回(sha1, 保存路径)，链接没有下载过时返回None"""
+        return self.conn.execute('SELECT sha1, path FROM media WHERE url = ?',
+                                 (url, )).fetchone()
+
+    def add(self, url, sha1, path, size):
+        self.conn.execute(
+            """INSERT OR REPLACE INTO media (url, sha1, path, size)
+            VALUES (?, ?, ?, ?)""", (url, sha1, path, size))
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,80 @@
+from datetime import timedelta
+
+import weibo.utils.util as util
+
+
+class DensityPlanner(object):
+    """根据历史搜索结果的页数，预测搜索单元的起始拆分粒度
+
+    每个搜索单元第一页返回的总页数会按小时平摊后保存，预测时取同一关键词、
+    同一地区在该时间段及之前history_days天内相同钟点的平均页数。
+    """
+
+    def __init__(self, path, history_days=14, autocommit=False):
+        self.history_days = history_days
+        self.conn = util.connect_sqlite(path, autocommit)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS density (
+            keyword TEXT NOT NULL,
+            region TEXT NOT NULL,
+            hour TEXT NOT NULL,
+            pages REAL NOT NULL,
+            PRIMARY KEY (keyword, region, hour))""")
+        self.conn.commit()
+        self.history = {}
+
+    def record(self, cell, pages):
+        """记录搜索单元的总页数，结果达到阈值时pages为阈值本身，即页数下限"""
+        per_hour = pages / cell.hours
+        hour = cell.start
+        rows = []
+        while hour < cell.end:
+            rows.append((cell.keyword, cell.region,
+                         hour.strftime('%Y-%m-%d %H'), per_hour))
+            hour += timedelta(hours=1)
+        self.conn.executemany(
+            """INSERT OR REPLACE INTO density (keyword, region, hour, pages)
+            VALUES (?, ?, ?, ?)""", rows)
+
+    def _load_history(self, cell):
+        """读取与搜索单元同一关键词、同一地区的历史页数，按钟点取平均"""
+        key = (cell.keyword, cell.region)
+        if key not in self.history:
+            since = cell.start - timedelta(days=self.history_days)
+            rows = self.conn.execute(
+                """SELECT substr(hour, 12, 2), AVG(pages) FROM density
+                WHERE keyword = ? AND region = ? AND hour >= ? AND hour < ?
+                GROUP BY substr(hour, 12, 2)""",
+                (cell.keyword, cell.region, since.strftime('%Y-%m-%d %H'),
+                 cell.end.strftime('%Y-%m-%d %H'))).fetchall()
+            self.history[key] = {int(hour): pages for hour, pages in rows}
+        return self.history[key]
+
+    def estimate(self, cell):
+        """预测搜索单元的总页数，没有历史记录时返回None"""
+        history = self._load_history(cell)
+        if not history:
+            return None
+        pages = 0
+        hour = cell.start
+        while hour < cell.end:
+            pages += history.get(hour.hour, 0)
+            hour += timedelta(hours=1)
+        return pages
+
+    def plan(self, cell, threshold, depth=0):
+        """返回预测结果数不会达到阈值的搜索单元及其拆分深度
+
+        只按时间拆分，地区的拆分仍在爬取时根据实际结果进行。
+        """
+        pages = self.estimate(cell)
+        if pages is None or pages < threshold or cell.hours <= 1:
+            return [(cell, depth)]
+        cells = []
+        for child in cell.split(None):
+            cells.extend(self.plan(child, threshold, depth + 1))
+        return cells
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
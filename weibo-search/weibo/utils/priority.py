@@ -0,0 +1,66 @@
+from urllib.parse import parse_qs, urlparse
+
+import weibo.utils.util as util
+
+# 获取已解析微博的IP属地、详情和全文的请求，优先于所有搜索请求
+ITEM_PRIORITY = 100
+# 省份、城市粒度的单元优先级更低，翻页时优先级下降得更快
+LEVEL_PENALTY = {'hours': 0, 'hour': 0, 'province': 10, 'city': 20}
+COUNT_FIELDS = ('reposts_count', 'comments_count', 'attitudes_count')
+
+
+def get_page(url):
+    """搜索链接中的页码，没有page参数时为第一页"""
+    page = parse_qs(urlparse(url).query).get('page')
+    try:
+        return int(page[0]) if page else 1
+    except ValueError:
+        return 1
+
+
+def get_engagement(weibos):
+    """一页微博的平均转评赞数之和"""
+    if not weibos:
+        return 0
+    return sum(
+        util.get_count(weibo.get(field, 0)) for weibo in weibos
+        for field in COUNT_FIELDS) / len(weibos)
+
+
+class PriorityPolicy(object):
+    """计算搜索请求的优先级，数值越大越先爬取
+
+    时间段结束得越晚优先级越高，比latest早recent_hours小时以上的时间段不再区分；
+    每个单元的第一页优先于后面的页，每往后一页优先级降低page_step；上一页微博的
+    平均转评赞数达到engagement_threshold时，下一页的优先级提高engagement_bonus。
+    """
+
+    def __init__(self,
+                 latest,
+                 recent_hours=24,
+                 page_step=5,
+                 engagement_threshold=100,
+                 engagement_bonus=10):
+        self.latest = latest
+        self.recent_hours = recent_hours
+        self.page_step = page_step
+        self.engagement_threshold = engagement_threshold
+        self.engagement_bonus = engagement_bonus
+
+    @classmethod
+    def from_settings(cls, settings, latest):
+        return cls(latest, settings.getint('PRIORITY_RECENT_HOURS', 24),
+                   settings.getint('PRIORITY_PAGE_STEP', 5),
+                   settings.getfloat('PRIORITY_ENGAGEMENT_THRESHOLD', 100),
+                   settings.getint('PRIORITY_ENGAGEMENT_BONUS', 10))
+
+    def cell_priority(self, cell, page=1, engagement=0):
+        hours_ago = max(0, (self.latest - cell.end).total_seconds() // 3600)
+        priority = max(0, self.recent_hours - hours_ago)
+        penalty = LEVEL_PENALTY[cell.level]
+        priority -= penalty
+        priority -= (page - 1) * self.page_step * (1 + penalty // 10)
+        if engagement >= self.engagement_threshold:
+            priority += self.engagement_bonus
+        return int(priority)
+
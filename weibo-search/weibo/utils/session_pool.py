@@ -0,0 +1,121 @@
+import time
+from collections import deque
+
+OK = 0
+ERROR = 1
+REDIRECT = 2
+
+SLOT_PREFIX = 'weibo_session_'
+
+
+def slot_name(index):
+    """第index个cookie使用的下载槽"""
+    return SLOT_PREFIX + str(index)
+
+
+class Session(object):
+    """cookie池中的一个cookie及其最近请求的结果"""
+
+    def __init__(self, index, cookie, window):
+        self.index = index
+        self.cookie = cookie
+        self.slot = slot_name(index)
+        self.outcomes = deque(maxlen=window)
+        self.active = 0
+        self.requests = 0
+        self.errors = 0
+        self.redirects = 0
+        self.quarantines = 0
+        self.quarantined_until = 0
+
+    def rate(self, outcome):
+        """最近请求中结果为outcome的比例"""
+        if not self.outcomes:
+            return 0
+        return self.outcomes.count(outcome) / len(self.outcomes)
+
+    def health(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'redirects': self.redirects,
+            'quarantines': self.quarantines,
+            'error_rate': round(self.rate(ERROR), 3),
+            'redirect_rate': round(self.rate(REDIRECT), 3)
+        }
+
+
+class SessionPool(object):
+    """cookie池，每个请求使用正在进行的请求最少的健康cookie，请求数相同时轮换
+
+    每个cookie统计最近window个请求中出错和被重定向的比例，请求数不少于min_requests且
+    比例超过上限时隔离quarantine_secs秒，每多隔离一次时间加倍。隔离期满后清空统计重新使用；
+    所有cookie都被隔离时使用最早期满的cookie。
+    """
+
+    def __init__(self,
+                 cookies,
+                 window=20,
+                 max_error_rate=0.3,
+                 max_redirect_rate=0.2,
+                 quarantine_secs=600,
+                 min_requests=5):
+        self.sessions = [
+            Session(i, cookie, window) for i, cookie in enumerate(cookies)
+        ]
+        self.max_error_rate = max_error_rate
+        self.max_redirect_rate = max_redirect_rate
+        self.quarantine_secs = quarantine_secs
+        self.min_requests = min(min_requests, window)
+        self.next_index = 0
+
+    def acquire(self, exclude=()):
+        """选择cookie并计入正在进行的请求，尽量不选exclude中的cookie，
+        返回(cookie, 是否所有cookie都被隔离)"""
+        now = time.time()
+        healthy = []
+        for session in self.sessions:
+            if session.quarantined_until and session.quarantined_until <= now:
+                session.quarantined_until = 0
+                session.outcomes.clear()
+            if not session.quarantined_until:
+                healthy.append(session)
+        healthy = [s for s in healthy if s.index not in exclude] or healthy
+        exhausted = not healthy
+        if exhausted:
+            session = min(self.sessions, key=lambda s: s.quarantined_until)
+        else:
+            count = len(self.sessions)
+            session = min(healthy,
+                          key=lambda s:
+                          (s.active, (s.index - self.next_index) % count))
+            self.next_index = (session.index + 1) % count
+        session.active += 1
+        session.requests += 1
+        return session, exhausted
+
+    def record(self, session, outcome):
+        """记录请求结果，返回cookie是否因此被隔离"""
+        session.active -= 1
+        session.outcomes.append(outcome)
+        if outcome == ERROR:
+            session.errors += 1
+        elif outcome == REDIRECT:
+            session.redirects += 1
+        if session.quarantined_until or len(
+                session.outcomes) < self.min_requests:
+            return False
+        if (session.rate(ERROR) > self.max_error_rate
+                or session.rate(REDIRECT) > self.max_redirect_rate):
+            session.quarantines += 1
+            session.quarantined_until = time.time() + self.quarantine_secs * 2**(
+                session.quarantines - 1)
+            return True
+        return False
+
+    def health(self):
+        """每个cookie的请求统计，不包含cookie本身"""
+        return {
+            str(session.index): session.health()
+            for session in self.sessions
+        }
@@ -1,4 +1,9 @@
+import os
+import shutil
+import sqlite3
 import sys
+import time
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 
 from weibo.utils.region import region_dict
@@ -54,6 +59,25 @@ def get_keyword_list(file_name):
     return keyword_list
 
 
+def escape_keyword(keyword):
+    """话题关键词#话题#在搜索链接、结果目录和文件名中写作%23话题%23"""
+    if len(keyword) > 2 and keyword[0] == '#' and keyword[-1] == '#':
+        return '%23' + keyword[1:-1] + '%23'
+    return keyword
+
+
+def get_cookie_pool(settings):
+    """获取cookie池，COOKIE_POOL可以是cookie列表，也可以是每行一个cookie的txt文件"""
+    cookies = settings.get('COOKIE_POOL') or []
+    if isinstance(cookies, str):
+        if not os.path.isabs(cookies):
+            cookies = os.getcwd() + os.sep + cookies
+        if not os.path.isfile(cookies):
+            sys.exit('不存在%s文件' % cookies)
+        cookies = get_keyword_list(cookies)
+    return [cookie.strip() for cookie in cookies if cookie.strip()]
+
+
 def get_regions(region):
     """根据区域筛选条件返回符合要求的region"""
     new_region = {}
@@ -100,7 +124,80 @@ def standardize_date(created_at):
     return created_at
 
 
+def get_count(text):
+    """将转评赞数转换成整数，如'1万+'为10000，无法识别时为0"""
+    text = str(text).strip().rstrip('+')
+    try:
+        if text.endswith('万'):
+            return int(float(text[:-1]) * 10000)
+        return int(text)
+    except ValueError:
+        return 0
+
+
 def str_to_time(text):
     """将字符串转换成时间类型"""
     result = datetime.strptime(text, '%Y-%m-%d')
     return result
+
+
+def get_cache_path(settings, file_name):
+    """获取缓存文件路径，缓存目录不存在时自动创建"""
+    cache_dir = settings.get('CACHE_DIR', '缓存文件')
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir + os.sep + file_name
+
+
+def is_cache_shared(settings):
+    """缓存是否被多个爬虫共用：多进程分担同一次爬取，或同一进程中同时运行多次爬取"""
+    return bool(settings.get('FRONTIER_WORKER')) or settings.getbool(
+        'CACHE_SHARED')
+
+
+def connect_sqlite(path, autocommit=False):
+    """连接SQLite数据库并启用WAL模式，便于多个进程同时读写
+
+    多个进程共用数据库时autocommit应为True，每次写入立即提交，不长时间占用写锁。
+    """
+    conn = sqlite3.connect(path,
+                           timeout=30,
+                           isolation_level=None if autocommit else '')
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+
+@contextmanager
+def file_lock(path, stale_secs=60):
+    """以创建锁文件的方式在多个进程间加锁，锁文件超过stale_secs秒视为持有者已退出"""
+    while True:
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL))
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > stale_secs:
+                    os.remove(path)
+                    continue
+            except OSError:
+                continue
+            time.sleep(0.1)
+    try:
+        yield
+    finally:
+        os.remove(path)
+
+
+def merge_csv(part_path, file_path):
+    """将part_path中的数据行追加到file_path后删除part_path，file_path不存在时保留表头"""
+    with file_lock(file_path + '.lock'):
+        with open(part_path, encoding='utf-8-sig', newline='') as src:
+            header = src.readline()
+            is_first_write = not os.path.isfile(file_path)
+            with open(file_path, 'a', encoding='utf-8-sig',
+                      newline='') as dst:
+                if is_first_write:
+                    dst.write(header)
+                shutil.copyfileobj(src, dst)
+        os.remove(part_path)
@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+import weibo.utils.util as util
+
+
+class HighWaterMark(object):
+    """每个关键词的爬取高水位，即已爬到的最新发布时间和最近爬到的微博id
+
+    增量爬取时从高水位所在小时的前overlap_hours小时开始搜索，补上搜索收录较晚的微博；
+    重叠时间段内之前爬到过的微博按id跳过。判断是否爬到过只看之前几次爬取的结果。
+    """
+
+    def __init__(self,
+                 path,
+                 overlap_hours=1,
+                 commit_interval=100,
+                 autocommit=False):
+        self.overlap_hours = overlap_hours
+        self.commit_interval = commit_interval
+        self.pending = 0
+        self.conn = util.connect_sqlite(path, autocommit)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS high_water (
+            keyword TEXT PRIMARY KEY,
+            created_at TEXT NOT NULL)""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS recent_mid (
+            keyword TEXT NOT NULL,
+            mid TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (keyword, mid))""")
+        self.conn.commit()
+        self.known = {}
+        self.latest = {}
+
+    def get(self, keyword):
+        """返回关键词已爬到的最新发布时间，如2024-01-01 08:30，没有记录时返回None"""
+        row = self.conn.execute(
+            'SELECT created_at FROM high_water WHERE keyword = ?',
+            (keyword, )).fetchone()
+        return row[0] if row else None
+
+    def crawl_start(self, keyword):
+        """返回增量爬取的起始时间，没有高水位时返回None"""
+        created_at = self.get(keyword)
+        if created_at is None:
+            return None
+        hour = datetime.strptime(created_at[:13], '%Y-%m-%d %H')
+        return hour - timedelta(hours=self.overlap_hours)
+
+    def _load_known(self, keyword):
+        if keyword not in self.known:
+            rows = self.conn.execute(
+                'SELECT mid FROM recent_mid WHERE keyword = ?', (keyword, ))
+            self.known[keyword] = {row[0] for row in rows}
+        return self.known[keyword]
+
+    def is_known(self, keyword, mid):
+        """微博是否在之前的爬取中爬到过"""
+        return mid in self._load_known(keyword)
+
+    def add(self, keyword, mid, created_at):
+        # 先读入之前的结果，本次爬到的微博不计入is_known
+        self._load_known(keyword)
+        self.conn.execute(
+            """INSERT OR IGNORE INTO recent_mid (keyword, mid, created_at)
+            VALUES (?, ?, ?)""", (keyword, mid, created_at))
+        if created_at > self.latest.get(keyword, ''):
+            self.latest[keyword] = created_at
+        self.pending += 1
+        if self.pending >= self.commit_interval:
+            self.conn.commit()
+            self.pending = 0
+
+    def close(self, unfinished=None):
+        """提升高水位，并删除增量爬取不会再用到的微博id
+
+        unfinished为{关键词: 最早的未爬完的时间}，高水位不超过该时间，以免爬取时限内
+        没爬到的较早时间段在之后的增量爬取中被跳过；时间未知（空字符串）时不提升。
+        """
+        unfinished = unfinished or {}
+        for keyword, created_at in self.latest.items():
+            if keyword in unfinished:
+                created_at = min(created_at, unfinished[keyword])
+                if not created_at:
+                    continue
+            self.conn.execute(
+                """INSERT INTO high_water (keyword, created_at) VALUES (?, ?)
+                ON CONFLICT (keyword) DO UPDATE SET
+                created_at = MAX(created_at, excluded.created_at)""",
+                (keyword, created_at))
+            start = self.crawl_start(keyword)
+            self.conn.execute(
+                'DELETE FROM recent_mid WHERE keyword = ? AND created_at < ?',
+                (keyword, start.strftime('%Y-%m-%d %H:%M')))
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,173 @@
+import weibo.utils.util as util
+
+# weibo表的列，转评赞数为整数，发布时间为可按字符串比较的'YYYY-MM-DD HH:MM'
+STORE_COLUMNS = [
+    'id', 'bid', 'user_id', 'screen_name', 'text', 'article_url', 'location',
+    'at_users', 'topics', 'reposts_count', 'comments_count', 'attitudes_count',
+    'created_at', 'source', 'pics', 'video_url', 'retweet_id', 'ip',
+    'user_authentication'
+]
+STORE_COUNT_COLUMNS = ('reposts_count', 'comments_count', 'attitudes_count')
+# 再次爬到同一微博时更新的列
+STORE_UPDATE_COLUMNS = STORE_COUNT_COLUMNS + ('ip', 'user_authentication')
+# trigram分词按连续3个字符建立索引，更短的词改用LIKE在筛选后的微博中查找
+MIN_MATCH_CHARS = 3
+
+
+def get_store_row(weibo):
+    row = []
+    for column in STORE_COLUMNS:
+        value = weibo.get(column, '')
+        if column in STORE_COUNT_COLUMNS:
+            value = util.get_count(value)
+        elif column == 'pics':
+            value = ','.join(value or [])
+        row.append(value)
+    return tuple(row)
+
+
+class WeiboStore(object):
+    """保存历史微博的SQLite数据库，可按关键词、时间、用户和正文、话题中的词查询
+
+    正文和话题建有trigram分词的FTS5全文索引，中文不需要另行分词；关键词、发布时间和
+    用户建有B树索引。写入的微博先缓冲，每batch_size条在一个事务中写入。
+    """
+
+    def __init__(self, path, batch_size=1000):
+        self.batch_size = batch_size
+        self.rows = []
+        self.keywords = []
+        self.conn = util.connect_sqlite(path)
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS weibo (
+            id TEXT PRIMARY KEY,
+            bid TEXT,
+            user_id TEXT,
+            screen_name TEXT,
+            text TEXT,
+            article_url TEXT,
+            location TEXT,
+            at_users TEXT,
+            topics TEXT,
+            reposts_count INTEGER,
+            comments_count INTEGER,
+            attitudes_count INTEGER,
+            created_at TEXT,
+            source TEXT,
+            pics TEXT,
+            video_url TEXT,
+            retweet_id TEXT,
+            ip TEXT,
+            user_authentication TEXT);
+            CREATE INDEX IF NOT EXISTS weibo_created_at ON weibo (created_at);
+            CREATE INDEX IF NOT EXISTS weibo_user_id
+            ON weibo (user_id, created_at);
+            CREATE TABLE IF NOT EXISTS weibo_keyword (
+            keyword TEXT NOT NULL,
+            id TEXT NOT NULL,
+            created_at TEXT,
+            PRIMARY KEY (keyword, id)) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS weibo_keyword_created_at
+            ON weibo_keyword (keyword, created_at);
+            CREATE VIRTUAL TABLE IF NOT EXISTS weibo_fts USING fts5 (
+            text, topics, content='weibo', content_rowid='rowid',
+            tokenize='trigram');
+            CREATE TRIGGER IF NOT EXISTS weibo_fts_insert
+            AFTER INSERT ON weibo BEGIN
+            INSERT INTO weibo_fts (rowid, text, topics)
+            VALUES (new.rowid, new.text, new.topics);
+            END;
+            CREATE TRIGGER IF NOT EXISTS weibo_fts_delete
+            AFTER DELETE ON weibo BEGIN
+            INSERT INTO weibo_fts (weibo_fts, rowid, text, topics)
+            VALUES ('delete', old.rowid, old.text, old.topics);
+            END;
+            CREATE TRIGGER IF NOT EXISTS weibo_fts_update
+            AFTER UPDATE OF text, topics ON weibo BEGIN
+            INSERT INTO weibo_fts (weibo_fts, rowid, text, topics)
+            VALUES ('delete', old.rowid, old.text, old.topics);
+            INSERT INTO weibo_fts (rowid, text, topics)
+            VALUES (new.rowid, new.text, new.topics);
+            END;""")
+        self.insert_sql = """INSERT INTO weibo ({columns}) VALUES ({values})
+            ON CONFLICT (id) DO UPDATE SET {update}""".format(
+            columns=', '.join(STORE_COLUMNS),
+            values=', '.join(['?'] * len(STORE_COLUMNS)),
+            update=', '.join('{column} = excluded.{column}'.format(
+                column=column) for column in STORE_UPDATE_COLUMNS))
+
+    def add(self, keyword, weibo):
+        row = get_store_row(weibo)
+        self.rows.append(row)
+        self.keywords.append(
+            (keyword, row[0], row[STORE_COLUMNS.index('created_at')]))
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """在一个事务中写入缓冲的微博"""
+        if not self.rows:
+            return
+        with self.conn:
+            self.conn.executemany(self.insert_sql, self.rows)
+            self.conn.executemany(
+                """INSERT OR IGNORE INTO weibo_keyword (keyword, id, created_at)
+                VALUES (?, ?, ?)""", self.keywords)
+        self.rows = []
+        self.keywords = []
+
+    def search(self,
+               match=None,
+               keyword=None,
+               since=None,
+               until=None,
+               user_id=None,
+               limit=100):
+        """按条件查询微博，按发布时间从新到旧返回字典列表
+
+        match为正文或话题中包含的词，多个词以空格分隔，须全部包含；since、until为
+        发布时间的起止，如'2025-10-01'，只有日期的until包含当天的微博。
+        """
+        created_at = 'k.created_at' if keyword else 'w.created_at'
+        sql = 'SELECT w.* FROM weibo w'
+        where = []
+        args = []
+        if keyword:
+            sql += ' JOIN weibo_keyword k ON k.id = w.id'
+            where.append('k.keyword = ?')
+            args.append(keyword)
+        phrases = []
+        for word in (match or '').split():
+            if len(word) >= MIN_MATCH_CHARS:
+                phrases.append('"%s"' % word.replace('"', '""'))
+            else:
+                like = '%' + word.replace('\\', '\\\\').replace(
+                    '%', '\\%').replace('_', '\\_') + '%'
+                where.append("(w.text LIKE ? ESCAPE '\\' OR "
+                             "w.topics LIKE ? ESCAPE '\\')")
+                args.extend([like, like])
+        if phrases:
+            where.append('w.rowid IN (SELECT rowid FROM weibo_fts '
+                         'WHERE weibo_fts MATCH ?)')
+            args.append(' AND '.join(phrases))
+        if since:
+            where.append(created_at + ' >= ?')
+            args.append(since)
+        if until:
+            where.append(created_at + ' < ?')
+            args.append(until + ' 99' if len(until) == 10 else until)
+        if user_id:
+            where.append('w.user_id = ?')
+            args.append(user_id)
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY %s DESC LIMIT ?' % created_at
+        args.append(limit)
+        cursor = self.conn.execute(sql, args)
+        columns = [column[0] for column in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+    def close(self):
+        self.flush()
+        self.conn.execute('PRAGMA optimize')
+        self.conn.close()